@@ -3,14 +3,17 @@
 
 import os
 import sys
+import json
 import argparse
 import colorama
 from colorama import Fore, Style
 
 import config
 from core.model_llama_cpp import ModelWrapper
-from core.conversation import ConversationManager
+from core.conversation import ConversationManager, make_summarizer
+from core.tokenizer import TokenCounter
 from core.utils import setup_logging, save_chat_log, get_model_info
+from core.log_sink import compress_leftover_logs
 
 colorama.init(autoreset=True)
 
@@ -48,7 +51,18 @@ class ChatApp:
         
         try:
             self.model_wrapper = ModelWrapper()
-            self.conversation_manager = ConversationManager(self.config)
+            if self.config.get('model_warmup'):
+                self.model_wrapper.warm_up()
+            summarizer = None
+            if self.config.get('history_summarize'):
+                summarizer = make_summarizer(lambda p, n: self.model_wrapper.generate(p, max_tokens=n),
+                                             template=self.model_wrapper.chat_template)
+            self.conversation_manager = ConversationManager(
+                self.config,
+                token_counter=TokenCounter(llama=self.model_wrapper.model),
+                summarizer=summarizer,
+                template=self.model_wrapper.chat_template
+            )
             print(f"{Fore.GREEN}✓ Sẵn sàng!")
         except Exception as e:
             print(f"{Fore.RED}Lỗi: {e}")
@@ -102,19 +116,108 @@ class ChatApp:
             save_chat_log(user_input, response, self.config.get('log_dir', 'logs'))
             
             if self.conversation_manager.is_history_full():
-                self.conversation_manager.trim_history(keep_turns=3)
+                self.conversation_manager.trim_history()
             
         except Exception as e:
             print(f"{Fore.RED}Lỗi: {e}")
 
 
+def run_batch(args):
+    # Chạy prompt hàng loạt từ file JSONL (python app.py batch ...)
+    from core.batch_runner import BatchRunner, create_backend
+
+    conf = config.get_config()
+    setup_logging(conf.get('log_dir', 'logs'))
+    if args.stub:
+        mode = 'stub'
+    elif args.mode:
+        mode = args.mode
+    elif args.workers > 1:
+        mode = 'batched' if conf.get('inference_mode') == 'batched' else 'pool'
+    else:
+        mode = 'single'
+    # Một ModelWrapper chỉ phục vụ được một lời gọi mỗi lúc
+    workers = 1 if mode in ('single', 'stub') else max(1, args.workers)
+
+    if args.input != '-' and not os.path.exists(args.input):
+        print(f"{Fore.RED}Không tìm thấy file: {args.input}")
+        sys.exit(1)
+
+    constraint = {}
+    try:
+        if args.json_schema:
+            with open(args.json_schema, encoding='utf-8') as f:
+                constraint = {'json_schema': json.load(f)}
+        elif args.grammar:
+            with open(args.grammar, encoding='utf-8') as f:
+                constraint = {'grammar': f.read()}
+    except (OSError, ValueError) as e:
+        print(f"{Fore.RED}Không đọc được grammar/JSON schema: {e}")
+        sys.exit(1)
+
+    print(f"{Fore.CYAN}Chế độ {mode}, {workers} worker, seed {args.seed}")
+    try:
+        backend = create_backend(mode, workers)
+    except Exception as e:
+        print(f"{Fore.RED}Lỗi: {e}")
+        sys.exit(1)
+
+    runner = BatchRunner(
+        backend,
+        workers=workers,
+        seed=args.seed,
+        raw=args.raw,
+        max_tokens=args.max_tokens,
+        temperature=args.temperature,
+        top_p=args.top_p,
+        report_every=args.report_every,
+        constraint=constraint,
+    )
+    try:
+        stats = runner.run(args.input, args.output, resume=args.resume)
+    except KeyboardInterrupt:
+        print(f"\n{Fore.YELLOW}Đã dừng, chạy lại với --resume để tiếp tục")
+        sys.exit(130)
+    finally:
+        if hasattr(backend, 'close'):
+            backend.close()
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+    if stats['failed']:
+        sys.exit(2)
+
+
 def main():
     # Hàm main làm điểm bắt đầu chương trình
     parser = argparse.ArgumentParser(description='Chat AI Offline')
     parser.add_argument('--gui', action='store_true', help='Chạy GUI')
+    subparsers = parser.add_subparsers(dest='command')
+
+    batch = subparsers.add_parser('batch', help='Chạy prompt hàng loạt từ file JSONL')
+    batch.add_argument('input', help="File JSONL đầu vào, mỗi dòng một object có trường prompt ('-' để đọc stdin)")
+    batch.add_argument('-o', '--output', required=True, help='File JSONL kết quả (ghi dần từng dòng)')
+    batch.add_argument('--workers', type=int, default=1, help='Số request chạy song song')
+    batch.add_argument('--mode', choices=['single', 'pool', 'batched'], default=None,
+                       help='single: một model; pool: N tiến trình model; batched: N chuỗi chung một batch '
+                            '(mặc định theo --workers và INFERENCE_MODE)')
+    batch.add_argument('--seed', type=int, default=0, help='Seed gốc, dòng thứ i dùng seed + i')
+    batch.add_argument('--resume', action='store_true', help='Bỏ qua các dòng đã có kết quả trong file output')
+    batch.add_argument('--max-tokens', type=int, default=None, help='Ghi đè MAX_TOKENS')
+    batch.add_argument('--temperature', type=float, default=None, help='Ghi đè TEMPERATURE (0: greedy)')
+    batch.add_argument('--top-p', type=float, default=None, help='Ghi đè TOP_P')
+    batch.add_argument('--raw', action='store_true', help='Gửi nguyên prompt, không ghép theo chat template của model')
+    constraint = batch.add_mutually_exclusive_group()
+    constraint.add_argument('--json-schema', default=None, help='File JSON schema, câu trả lời luôn là JSON đúng schema')
+    constraint.add_argument('--grammar', default=None, help='File grammar GBNF của llama.cpp để ràng buộc câu trả lời')
+    batch.add_argument('--report-every', type=float, default=10.0, help='Số giây giữa hai lần báo tiến độ')
+    batch.add_argument('--stub', action='store_true', help='Dùng model giả lập (không cần GGUF)')
     
     args = parser.parse_args()
-    
+
+    if args.command == 'batch':
+        run_batch(args)
+        return
+
+    compress_leftover_logs(config.get_config().get('log_dir', 'logs'))
     app = ChatApp()
     
     if args.gui:
@@ -0,0 +1 @@
+ # Bộ công cụ đo hiệu năng cho pipeline suy luận và chat
@@ -0,0 +1,293 @@
+ # Chạy benchmark cho pipeline suy luận và chat
+ # Ví dụ:
+ #   python -m bench.run_bench --stub                                  (không cần model, chạy offline)
+ #   python -m bench.run_bench --threads 2,4,8 --batch 16,64 --flask   (model GGUF thật trong config.py)
+ #   python -m bench.run_bench --compare bench/results/a.json bench/results/b.json
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import platform
+import itertools
+import threading
+from datetime import datetime
+
+import config
+from core.conversation import ConversationManager
+from core.tokenizer import TokenCounter
+from bench.workloads import get_workload, WORKLOADS
+
+
+def percentile(values, p):
+    # Percentile theo cách lấy phần tử gần nhất (đủ cho báo cáo benchmark)
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4),
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(max(values), 4),
+    }
+
+
+def peak_rss_mb():
+    # RSS lớn nhất của tiến trình từ lúc chạy tới giờ
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux trả về KB, macOS trả về byte
+        return round(peak / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+    except ImportError:
+        import psutil
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / (1024 * 1024), 1)
+
+
+def create_wrapper(stub, overrides):
+    if stub:
+        from bench.stub_model import StubModelWrapper
+        return StubModelWrapper(overrides)
+    from core.model_llama_cpp import ModelWrapper
+    return ModelWrapper(overrides)
+
+
+def run_model_workload(wrapper, conversations, max_tokens):
+    # Chạy các kịch bản trực tiếp qua ModelWrapper và ConversationManager.build_prompt
+    cfg = wrapper.get_config()
+    token_counter = TokenCounter(llama=wrapper.model)
+    turns = []
+
+    for script in conversations:
+        conv_id = str(uuid.uuid4())
+        manager = ConversationManager(cfg, token_counter=token_counter,
+                                      template=getattr(wrapper, "chat_template", None))
+        for user_input in script:
+            t0 = time.perf_counter()
+            prompt = manager.build_prompt(user_input, max_tokens=max_tokens)
+            build_seconds = time.perf_counter() - t0
+
+            prompt_tokens = token_counter.count(prompt)
+            first_token_at = None
+            parts = []
+            start = time.perf_counter()
+            for delta in wrapper.generate(prompt, max_tokens=max_tokens, stream=True, conv_id=conv_id):
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                parts.append(delta)
+            end = time.perf_counter()
+
+            response = "".join(parts).strip()
+            completion_tokens = max(len(parts), token_counter.count(response))
+            ttft = (first_token_at or end) - start
+            decode_seconds = end - (first_token_at or end)
+
+            turns.append({
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "build_prompt_seconds": build_seconds,
+                "ttft_seconds": ttft,
+                "latency_seconds": end - start,
+                # TTFT xấp xỉ thời gian đánh giá prompt, phần còn lại là thời gian sinh token
+                "prompt_eval_tps": prompt_tokens / ttft if ttft > 0 else 0.0,
+                "generation_tps": (completion_tokens - 1) / decode_seconds if decode_seconds > 0 else 0.0,
+            })
+
+            manager.add_user_message(user_input)
+            manager.add_assistant_message(response)
+            if manager.is_history_full():
+                manager.trim_history()
+
+    return {
+        "turns": len(turns),
+        "prompt_tokens_total": sum(t["prompt_tokens"] for t in turns),
+        "completion_tokens_total": sum(t["completion_tokens"] for t in turns),
+        "build_prompt_seconds": summarize([t["build_prompt_seconds"] for t in turns]),
+        "ttft_seconds": summarize([t["ttft_seconds"] for t in turns]),
+        "latency_seconds": summarize([t["latency_seconds"] for t in turns]),
+        "prompt_eval_tps": summarize([t["prompt_eval_tps"] for t in turns]),
+        "generation_tps": summarize([t["generation_tps"] for t in turns]),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _import_web_app(stub, sqlite_path):
+    # Nạp web_app với backend SQLite tạm để không cần MongoDB; chế độ stub thay ModelWrapper bằng model giả
+    config.STORAGE_BACKEND = "sqlite"
+    config.SQLITE_PATH = sqlite_path
+    if stub:
+        import core.model_llama_cpp
+        from bench.stub_model import StubModelWrapper
+        core.model_llama_cpp.ModelWrapper = StubModelWrapper
+    import web_app
+    return web_app
+
+
+def _flask_client_session(web_app, client_id, conversations, results, lock):
+    client = web_app.app.test_client()
+    username = f"bench_{client_id}_{uuid.uuid4().hex[:6]}"
+    password = "bench12345"
+    client.post("/register", json={"username": username, "password": password, "confirm_password": password})
+    client.post("/login", json={"username": username, "password": password})
+
+    for script in conversations:
+        client.post("/new_chat")
+        for user_input in script:
+            start = time.perf_counter()
+            response = client.post("/get_response_stream", json={"msg": user_input}, buffered=False)
+            first_token_at = None
+            status = response.status_code
+            for chunk in response.response:
+                if first_token_at is None and b"event: token" in chunk:
+                    first_token_at = time.perf_counter()
+            response.close()
+            end = time.perf_counter()
+            with lock:
+                results.append({
+                    "status": status,
+                    "ttft_seconds": (first_token_at or end) - start,
+                    "latency_seconds": end - start,
+                })
+
+
+def run_flask_workload(stub, conversations, clients):
+    # Chạy kịch bản qua các endpoint Flask (đăng ký, đăng nhập, /get_response_stream), nhiều client song song
+    web_app = _import_web_app(stub, os.path.join(tempfile.mkdtemp(prefix="bench_"), "bench.db"))
+    if not web_app.model_loader.wait():
+        raise RuntimeError(f"Không tải được model: {web_app.model_loader.error}")
+    results = []
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=_flask_client_session, args=(web_app, i, conversations, results, lock))
+        for i in range(clients)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    ok = [r for r in results if r["status"] == 200]
+    return {
+        "clients": clients,
+        "requests": len(results),
+        "rejected": len(results) - len(ok),
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(len(ok) / wall, 3) if wall > 0 else 0.0,
+        "ttft_seconds": summarize([r["ttft_seconds"] for r in ok]),
+        "latency_seconds": summarize([r["latency_seconds"] for r in ok]),
+        "queue": web_app.scheduler.stats(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _int_list(text):
+    return [int(x) for x in text.split(",") if x.strip()]
+
+
+def compare(path_a, path_b):
+    # In chênh lệch các chỉ số chính giữa hai lần chạy (so khớp theo tham số)
+    with open(path_a, encoding="utf-8") as f:
+        a = json.load(f)
+    with open(path_b, encoding="utf-8") as f:
+        b = json.load(f)
+
+    def key(run):
+        p = run["params"]
+        return (p["n_threads"], p["n_batch"], p["n_ctx"])
+
+    runs_b = {key(r): r for r in b["runs"]}
+    metrics = [("ttft_seconds", "p50"), ("latency_seconds", "p95"),
+               ("prompt_eval_tps", "mean"), ("generation_tps", "mean")]
+    for run_a in a["runs"]:
+        run_b = runs_b.get(key(run_a))
+        if run_b is None:
+            continue
+        print(f"threads={key(run_a)[0]} batch={key(run_a)[1]} ctx={key(run_a)[2]}")
+        for name, stat in metrics:
+            va = run_a["model"][name].get(stat, 0.0)
+            vb = run_b["model"][name].get(stat, 0.0)
+            change = (vb - va) / va * 100 if va else 0.0
+            print(f"  {name}.{stat}: {va:.4f} -> {vb:.4f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pipeline chat AI')
+    parser.add_argument('--stub', action='store_true', help='Dùng model giả lập (không cần GGUF)')
+    parser.add_argument('--workload', default='mixed', choices=sorted(WORKLOADS), help='Kịch bản hội thoại')
+    parser.add_argument('--threads', default=str(config.N_THREADS), help='Danh sách N_THREADS, ví dụ 2,4,8')
+    parser.add_argument('--batch', default=str(config.N_BATCH), help='Danh sách N_BATCH, ví dụ 16,64,256')
+    parser.add_argument('--ctx', default=str(config.N_CTX), help='Danh sách N_CTX, ví dụ 2048,4096')
+    parser.add_argument('--max-tokens', type=int, default=64, help='MAX_TOKENS mỗi lượt')
+    parser.add_argument('--flask', action='store_true', help='Chạy thêm kịch bản qua các endpoint Flask')
+    parser.add_argument('--clients', type=int, default=4, help='Số client song song khi chạy --flask')
+    parser.add_argument('--output', default=None, help='File JSON kết quả (mặc định bench/results/<thời gian>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('A', 'B'), help='So sánh hai file kết quả')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    conversations = get_workload(args.workload)
+    results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+    os.makedirs(results_dir, exist_ok=True)
+    output = args.output or os.path.join(results_dir, f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+
+    report = {
+        "started_at": datetime.now().isoformat(),
+        "mode": "stub" if args.stub else "gguf",
+        "model_path": config.MODEL_PATH,
+        "workload": args.workload,
+        "max_tokens": args.max_tokens,
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        "runs": [],
+    }
+
+    for n_threads, n_batch, n_ctx in itertools.product(
+            _int_list(args.threads), _int_list(args.batch), _int_list(args.ctx)):
+        params = {"n_threads": n_threads, "n_batch": n_batch, "n_ctx": n_ctx, "max_tokens": args.max_tokens}
+        print(f"▶ threads={n_threads} batch={n_batch} ctx={n_ctx}")
+        wrapper = create_wrapper(args.stub, params)
+        result = run_model_workload(wrapper, conversations, args.max_tokens)
+        del wrapper
+        report["runs"].append({"params": params, "model": result})
+        print(f"  TTFT p50={result['ttft_seconds']['p50']}s  "
+              f"prompt={result['prompt_eval_tps']['mean']:.1f} tok/s  "
+              f"gen={result['generation_tps']['mean']:.1f} tok/s  "
+              f"latency p95={result['latency_seconds']['p95']}s")
+
+    if args.flask:
+        # web_app dùng cấu hình đầu tiên trong danh sách quét
+        first = report["runs"][0]["params"]
+        config.N_THREADS, config.N_BATCH, config.N_CTX = first["n_threads"], first["n_batch"], first["n_ctx"]
+        config.MAX_TOKENS = args.max_tokens
+        print(f"▶ Flask: {args.clients} client song song")
+        report["flask"] = run_flask_workload(args.stub, conversations, args.clients)
+        print(f"  {report['flask']['requests_per_second']} req/s  "
+              f"TTFT p50={report['flask']['ttft_seconds'].get('p50')}s  "
+              f"bị từ chối={report['flask']['rejected']}")
+
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Đã lưu kết quả: {output}")
+
+
+if __name__ == "__main__":
+    main()
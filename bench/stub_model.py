@@ -0,0 +1,95 @@
+ # Model giả lập để chạy benchmark khi không có file GGUF hoặc chưa cài llama_cpp
+ # Giả lập chi phí đánh giá prompt và sinh token theo số token, số luồng và kích thước batch
+import time
+import zlib
+import random
+
+from core.model_llama_cpp import ModelWrapper
+
+
+_WORDS = (
+    "def return python list dict vòng lặp hàm biến giá trị kết quả ví dụ "
+    "import class self print range len if else for while True False None"
+).split()
+
+
+class StubLlama:
+    # Có cùng các hàm ModelWrapper/TokenCounter cần: tokenize, detokenize và __call__ (kể cả stream)
+
+    def __init__(self, model_path=None, n_ctx=2048, n_threads=4, n_batch=16,
+                 prompt_ms_per_token=2.0, decode_ms_per_token=40.0, batch_overhead_ms=1.0, seed=0, **kwargs):
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.n_threads = n_threads
+        self.n_batch = n_batch
+        self.prompt_ms_per_token = prompt_ms_per_token
+        self.decode_ms_per_token = decode_ms_per_token
+        self.batch_overhead_ms = batch_overhead_ms
+        self.seed = seed
+        self.n_tokens = 0  # Số token đã đánh giá, như Llama.n_tokens
+
+    def tokenize(self, text, add_bos=True, special=False):
+        # Mỗi từ là một token, id lấy theo crc32 để ổn định giữa các lần chạy
+        tokens = [zlib.crc32(word) % 32000 for word in text.split()]
+        return ([1] if add_bos else []) + tokens
+
+    def detokenize(self, tokens):
+        return b" ".join(str(t).encode() for t in tokens)
+
+    def _speedup(self):
+        # Đánh giá prompt gần như tăng tuyến tính theo số luồng, sinh token bị giới hạn bởi băng thông bộ nhớ
+        return max(1, self.n_threads) ** 0.9, max(1, self.n_threads) ** 0.5
+
+    def _prompt_eval_seconds(self, n_prompt):
+        prompt_speedup, _ = self._speedup()
+        n_calls = -(-n_prompt // max(1, self.n_batch))
+        return (n_prompt * self.prompt_ms_per_token / prompt_speedup + n_calls * self.batch_overhead_ms) / 1000
+
+    def __call__(self, prompt, max_tokens=16, temperature=0.8, top_p=0.95, stop=None,
+                 echo=False, stream=False, stopping_criteria=None, **kwargs):
+        n_prompt = len(self.tokenize(prompt.encode("utf-8") if isinstance(prompt, str) else prompt))
+        if n_prompt + max_tokens > self.n_ctx:
+            raise ValueError(f"Requested tokens ({n_prompt + max_tokens}) exceed context window of {self.n_ctx}")
+
+        rng = random.Random(self.seed + n_prompt)
+        n_completion = rng.randint(max(1, max_tokens // 4), max_tokens)
+        _, decode_speedup = self._speedup()
+        decode_seconds = self.decode_ms_per_token / decode_speedup / 1000
+
+        def chunks():
+            time.sleep(self._prompt_eval_seconds(n_prompt))
+            self.n_tokens = n_prompt
+            for _ in range(n_completion):
+                time.sleep(decode_seconds)
+                if stopping_criteria is not None and stopping_criteria(None, None):
+                    return
+                yield {"choices": [{"text": rng.choice(_WORDS) + " "}]}
+                self.n_tokens += 1
+
+        if stream:
+            return chunks()
+
+        text = "".join(chunk["choices"][0]["text"] for chunk in chunks())
+        return {
+            "choices": [{"text": text}],
+            "usage": {"prompt_tokens": n_prompt, "completion_tokens": n_completion},
+        }
+
+
+class StubModelWrapper(ModelWrapper):
+    # ModelWrapper dùng StubLlama thay vì tải file GGUF
+
+    def __init__(self, overrides=None):
+        # Model giả không có trạng thái KV nên tắt cache KV
+        overrides = dict(overrides or {})
+        overrides["kv_cache_max_mb"] = 0
+        overrides["kv_disk_cache_max_mb"] = 0
+        super().__init__(overrides=overrides)
+
+    def _initialize_model(self):
+        self.model = StubLlama(
+            model_path=self.config.get('model_path'),
+            n_ctx=self.config.get('n_ctx', 1024),
+            n_threads=self.config.get('n_threads', 4),
+            n_batch=self.config.get('n_batch', 16),
+        )
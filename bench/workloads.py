@@ -0,0 +1,39 @@
+ # Kịch bản hội thoại nhiều lượt dùng cho benchmark
+ # Mỗi kịch bản là danh sách câu hỏi của người dùng theo thứ tự
+
+SHORT_CHAT = [
+    "Xin chào, bạn là ai?",
+    "Python là gì?",
+    "Cho ví dụ một vòng lặp for.",
+    "Cảm ơn bạn!",
+]
+
+CODING_CHAT = [
+    "Viết hàm Python tính giai thừa của n bằng đệ quy.",
+    "Viết lại hàm trên không dùng đệ quy.",
+    "Thêm kiểm tra đầu vào âm và ném ValueError.",
+    "Viết unittest cho hàm đó.",
+    "Giải thích độ phức tạp thời gian của hai cách.",
+    "Dùng functools.lru_cache thì có nhanh hơn không?",
+]
+
+LONG_PASTE_CHAT = [
+    "Đọc đoạn code sau và tìm lỗi:\n" + "\n".join(
+        f"def ham_{i}(x):\n    return x * {i} + ham_{i - 1}(x) if {i} > 0 else x" for i in range(40)
+    ),
+    "Sửa lỗi đó giúp tôi.",
+    "Tóm tắt lại những gì bạn đã sửa.",
+]
+
+WORKLOADS = {
+    "short": [SHORT_CHAT],
+    "coding": [CODING_CHAT],
+    "long_paste": [LONG_PASTE_CHAT],
+    "mixed": [SHORT_CHAT, CODING_CHAT, LONG_PASTE_CHAT],
+}
+
+
+def get_workload(name):
+    if name not in WORKLOADS:
+        raise ValueError(f"Không có kịch bản '{name}', chọn một trong: {', '.join(WORKLOADS)}")
+    return WORKLOADS[name]
@@ -3,46 +3,173 @@
 
  # Cấu hình liên quan đến model
 MODEL_PATH = "models/python.gguf"
+# Các model web app có thể dùng (tên -> file GGUF), người dùng chọn trong phần cài đặt
+# Ví dụ: {"python": MODEL_PATH, "nhanh": "models/small.gguf", "chất lượng": "models/large.gguf"}
+MODELS = {"python": MODEL_PATH}
+DEFAULT_MODEL = "python"     # Model dùng khi người dùng chưa chọn
+MODEL_RAM_BUDGET_MB = 0      # Tổng dung lượng các model được giữ trong RAM cùng lúc (0 = 75% RAM máy)
+CHAT_TEMPLATE = "auto"       # Định dạng prompt: "auto" (đọc từ metadata file GGUF), "legacy" (### Human/### Assistant),
+                             # "chatml", "llama3", "gemma", "mistral" hoặc "phi3"
 N_CTX = 2048          # Kích thước cửa sổ ngữ cảnh
 N_THREADS = 4         # Số luồng CPU sử dụng khi suy luận
 N_BATCH = 16          # Kích thước batch khi suy luận
+USE_MMAP = True       # Ánh xạ file model vào bộ nhớ (các tiến trình dùng chung một bản trọng số)
+USE_MLOCK = False     # Khóa trọng số trong RAM, không cho hệ điều hành đẩy ra swap (cần đủ RAM và quyền mlock)
+MODEL_WARMUP = True   # Đọc trước file model và chạy thử một lần decode ngay khi tải xong
+WORKER_POOL_SIZE = 0  # Số tiến trình model cho web app (0 hoặc 1: chạy model ngay trong tiến trình web)
+                      # Khi > 1, N_THREADS được chia đều cho các worker
+KV_CACHE_MAX_MB = 512 # RAM tối đa cho cache KV theo cuộc trò chuyện (0 = tắt)
+KV_DISK_CACHE_DIR = "cache/kv_state"  # Thư mục lưu trạng thái KV của các cuộc trò chuyện để mở lại không phải đánh giá lại
+KV_DISK_CACHE_MAX_MB = 2048           # Dung lượng đĩa tối đa cho thư mục trên, đầy thì xóa file lâu không dùng nhất (0 = tắt)
+KV_DISK_CACHE_MIN_TOKENS = 256        # Chỉ lưu xuống đĩa cuộc trò chuyện có từ chừng này token trở lên
+SPECULATIVE_MODE = "off"    # "off", "draft" (model nháp DRAFT_MODEL_PATH) hoặc "prompt_lookup" (lấy nháp từ n-gram trong prompt)
+DRAFT_MODEL_PATH = ""       # Model GGUF nhỏ cùng bộ từ vựng với MODEL_PATH, dùng khi SPECULATIVE_MODE = "draft" (model khác bộ từ vựng chạy không có nháp)
+DRAFT_NUM_TOKENS = 8        # Số token nháp đề xuất mỗi lần
+INFERENCE_MODE = "single"   # "single": mỗi request chạy riêng; "batched": gộp các request đồng thời vào một lần decode
+BATCH_MAX_SEQUENCES = 4     # Số request tối đa chạy chung một batch (mỗi request có cửa sổ N_CTX riêng)
+BATCH_MAX_TOKENS = 512      # Số token tối đa mỗi lần decode ở chế độ batched
+GRAMMAR_CACHE_SIZE = 32     # Số grammar/JSON schema đã biên dịch giữ trong bộ nhớ (request lặp lại không biên dịch lại)
 
 # Cấu hình sinh văn bản
 TEMPERATURE = 0.8     # Mức độ sáng tạo
 TOP_P = 0.95         # Lấy mẫu top-p
 MAX_TOKENS = 512      # Độ dài tối đa của văn bản sinh
 
-# Cấu hình số lượt hội thoại lưu lại
-HISTORY_MAX_TURNS = 6  # Số lượt hội thoại lưu lại
+# Cấu hình lịch sử hội thoại
+# Lịch sử được xếp vào prompt theo số token thật, vừa với N_CTX - MAX_TOKENS
+HISTORY_MAX_TURNS = 0       # Giới hạn thêm theo số lượt (0 = chỉ giới hạn theo số token)
+HISTORY_SUMMARIZE = False   # Tóm tắt các lượt cũ bằng model thay vì bỏ hẳn
+LOAD_CHAT_PAGE_SIZE = 10    # Số lượt tải mỗi lần khi mở lại cuộc trò chuyện cũ (trang đầu cũng là context cho model)
+
+# Cấu hình hàng đợi suy luận cho web app
+QUEUE_MAX_DEPTH = 16      # Số request tối đa được chờ cùng lúc (vượt quá sẽ trả 503)
+QUEUE_MAX_PER_USER = 2    # Số request tối đa mỗi user được chờ (vượt quá sẽ trả 429)
+QUEUE_TIMEOUT = 120       # Số giây tối đa chờ model phản hồi
+STREAM_HEARTBEAT = 2      # Số giây giữa các dòng giữ kết nối SSE khi chưa có token (để phát hiện client đã đóng tab)
+
+# Cấu hình chạy web app cho môi trường thật (serve.py)
+SERVER_HOST = "0.0.0.0"         # Địa chỉ lắng nghe
+SERVER_PORT = 5000              # Cổng lắng nghe
+SERVER_WORKERS = 1              # Số tiến trình web (mỗi tiến trình giữ một bản model, trọng số dùng chung qua mmap)
+SERVER_THREADS = 8              # Số luồng xử lý request trong mỗi tiến trình (mỗi stream WSGI giữ một luồng)
+SERVER_GRACEFUL_TIMEOUT = 60    # Số giây chờ các câu trả lời đang sinh hoàn tất khi tắt server
+
+# Cấu hình cache câu trả lời cho web app (câu hỏi lặp lại được trả ngay, không cần chạy model)
+RESPONSE_CACHE_SIZE = 0                 # Số câu trả lời tối đa trong cache (0 = tắt)
+RESPONSE_CACHE_TTL = 86400              # Số giây một câu trả lời còn hiệu lực (0 = không hết hạn)
+RESPONSE_CACHE_MAX_TEMPERATURE = 0.5    # Chỉ dùng cache khi TEMPERATURE không vượt quá ngưỡng này
+RESPONSE_CACHE_PATH = "logs/response_cache.json"  # File lưu cache khi tắt ứng dụng ("" = chỉ giữ trong RAM)
+RESPONSE_CACHE_SEMANTIC = False         # Trả lời câu hỏi gần giống bằng embedding của model (chỉ lượt đầu của cuộc trò chuyện)
+RESPONSE_CACHE_SIMILARITY = 0.92        # Ngưỡng cosine để coi hai câu hỏi là giống nhau
+
+# Cấu hình lưu trạng thái chat của từng user phía server (cuộc trò chuyện hiện tại, model, context)
+SESSION_BACKEND = "memory"          # "memory" (RAM của tiến trình) hoặc "sqlite" (dùng chung giữa nhiều tiến trình web)
+SESSION_IDLE_TTL = 3600             # Số giây không hoạt động trước khi trạng thái của user bị xóa (0 = không hết hạn)
+SESSION_MAX_ENTRIES = 1000          # Số user tối đa giữ cùng lúc, vượt quá thì bỏ user lâu không dùng nhất
+SESSION_SQLITE_PATH = "logs/sessions.db"  # File database khi dùng SESSION_BACKEND = "sqlite"
+
+# Cấu hình lưu trữ tài khoản và lịch sử chat
+STORAGE_BACKEND = "mongo"       # "mongo" (cần MongoDB đang chạy) hoặc "sqlite" (file nhúng, không cần dịch vụ ngoài)
+SQLITE_PATH = "chat_history.db" # File database khi dùng STORAGE_BACKEND = "sqlite"
+
+# Cấu hình ghi lịch sử chat vào database (ghi nền theo lô)
+WRITE_BATCH_SIZE = 50         # Số tin nhắn tối đa mỗi lần ghi
+WRITE_FLUSH_INTERVAL = 1.0    # Số giây tối đa giữ tin nhắn trước khi ghi
+WRITE_MAX_PENDING = 1000      # Số tin nhắn tối đa chờ ghi trong RAM
+WRITE_SPILL_PATH = "logs/pending_writes.jsonl"  # File lưu tạm khi không ghi được database
 
 # Cấu hình thư mục lưu log
 LOG_DIR = "logs"      # Thư mục lưu file log
+LOG_MAX_MB = 64               # Dung lượng tối đa một file log JSON dòng trước khi đổi sang file mới
+LOG_COMPRESSION = "gzip"      # Nén file log đã đóng: "gzip", "zstd" (cần cài zstandard) hoặc "" (không nén)
+LOG_FLUSH_INTERVAL = 1.0      # Số giây tối đa bản ghi log nằm trong hàng đợi trước khi được ghi ra file
+LOG_FSYNC_INTERVAL = 5.0      # Số giây giữa các lần fsync file log xuống đĩa
+
+# Cấu hình số liệu vận hành (Prometheus) và trace từng request
+METRICS_ENABLED = True  # Mở GET /metrics cho Prometheus (số token, thời gian eval/decode, hàng đợi, database, RAM)
+TRACE_LOG = False       # Ghi thời gian từng bước của mỗi lượt chat vào LOG_DIR/trace_<ngày>.jsonl
 
 # Trả về toàn bộ cấu hình dưới dạng dict (dùng cho các module khác)
 def get_config():
     return {
         "model_path": MODEL_PATH,
+        "models": dict(MODELS),
+        "default_model": DEFAULT_MODEL,
+        "chat_template": CHAT_TEMPLATE,
+        "model_ram_budget_mb": MODEL_RAM_BUDGET_MB,
         "n_ctx": N_CTX,
         "n_threads": N_THREADS,
         "n_batch": N_BATCH,
+        "use_mmap": USE_MMAP,
+        "use_mlock": USE_MLOCK,
+        "model_warmup": MODEL_WARMUP,
+        "worker_pool_size": WORKER_POOL_SIZE,
+        "kv_cache_max_mb": KV_CACHE_MAX_MB,
+        "kv_disk_cache_dir": KV_DISK_CACHE_DIR,
+        "kv_disk_cache_max_mb": KV_DISK_CACHE_MAX_MB,
+        "kv_disk_cache_min_tokens": KV_DISK_CACHE_MIN_TOKENS,
+        "speculative_mode": SPECULATIVE_MODE,
+        "draft_model_path": DRAFT_MODEL_PATH,
+        "draft_num_tokens": DRAFT_NUM_TOKENS,
+        "inference_mode": INFERENCE_MODE,
+        "batch_max_sequences": BATCH_MAX_SEQUENCES,
+        "batch_max_tokens": BATCH_MAX_TOKENS,
+        "grammar_cache_size": GRAMMAR_CACHE_SIZE,
         "temperature": TEMPERATURE,
         "top_p": TOP_P,
         "max_tokens": MAX_TOKENS,
         "history_max_turns": HISTORY_MAX_TURNS,
-        "log_dir": LOG_DIR
+        "history_summarize": HISTORY_SUMMARIZE,
+        "load_chat_page_size": LOAD_CHAT_PAGE_SIZE,
+        "queue_max_depth": QUEUE_MAX_DEPTH,
+        "queue_max_per_user": QUEUE_MAX_PER_USER,
+        "queue_timeout": QUEUE_TIMEOUT,
+        "stream_heartbeat": STREAM_HEARTBEAT,
+        "server_host": SERVER_HOST,
+        "server_port": SERVER_PORT,
+        "server_workers": SERVER_WORKERS,
+        "server_threads": SERVER_THREADS,
+        "server_graceful_timeout": SERVER_GRACEFUL_TIMEOUT,
+        "response_cache_size": RESPONSE_CACHE_SIZE,
+        "response_cache_ttl": RESPONSE_CACHE_TTL,
+        "response_cache_max_temperature": RESPONSE_CACHE_MAX_TEMPERATURE,
+        "response_cache_path": RESPONSE_CACHE_PATH,
+        "response_cache_semantic": RESPONSE_CACHE_SEMANTIC,
+        "response_cache_similarity": RESPONSE_CACHE_SIMILARITY,
+        "session_backend": SESSION_BACKEND,
+        "session_idle_ttl": SESSION_IDLE_TTL,
+        "session_max_entries": SESSION_MAX_ENTRIES,
+        "session_sqlite_path": SESSION_SQLITE_PATH,
+        "storage_backend": STORAGE_BACKEND,
+        "sqlite_path": SQLITE_PATH,
+        "write_batch_size": WRITE_BATCH_SIZE,
+        "write_flush_interval": WRITE_FLUSH_INTERVAL,
+        "write_max_pending": WRITE_MAX_PENDING,
+        "write_spill_path": WRITE_SPILL_PATH,
+        "log_dir": LOG_DIR,
+        "log_max_mb": LOG_MAX_MB,
+        "log_compression": LOG_COMPRESSION,
+        "log_flush_interval": LOG_FLUSH_INTERVAL,
+        "log_fsync_interval": LOG_FSYNC_INTERVAL,
+        "metrics_enabled": METRICS_ENABLED,
+        "trace_log": TRACE_LOG
     }
 
  # Hàm kiểm tra cấu hình có hợp lệ không
-def validate_config():
-    # Kiểm tra file model có tồn tại không
+def validate_config(model_path=None):
+    # Kiểm tra file model có tồn tại không (mặc định là MODEL_PATH)
     import os
-    if not os.path.exists(MODEL_PATH):
-        return False, f"Model file not found: {MODEL_PATH}"
+    model_path = model_path or MODEL_PATH
+    if not os.path.exists(model_path):
+        return False, f"Model file not found: {model_path}"
     
     # Kiểm tra các giá trị cấu hình có nằm trong khoảng cho phép
     if N_CTX < 256 or N_CTX > 8192:
         return False, "N_CTX should be between 256-8192"
     
+    if SPECULATIVE_MODE == "draft" and not os.path.exists(DRAFT_MODEL_PATH):
+        return False, f"Draft model file not found: {DRAFT_MODEL_PATH}"
+
     if TEMPERATURE < 0 or TEMPERATURE > 2:
         return False, "TEMPERATURE should be between 0-2"
         
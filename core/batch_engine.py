@@ -0,0 +1,408 @@
+ # Suy luận theo lô liên tục (continuous batching) cho nhiều request đồng thời
+ # Mọi chuỗi đang chạy được gộp vào một lần llama_decode, mỗi chuỗi có slot KV (seq_id) riêng
+ # Request mới được nhận vào ở ranh giới token, request xong được trả slot ngay
+import time
+import codecs
+import queue
+import threading
+
+from core.model_llama_cpp import ModelWrapper
+from core.grammar import get_grammar_cache, GrammarSamplerCache, TOKEN_DATA, grammar_allows, grammar_mask
+from core.chat_template import StopMatcher
+
+# Đánh dấu kết thúc luồng text của một chuỗi
+_END = object()
+
+
+def _llama_api():
+    # Import tại đây để module nạp được khi chưa cài llama_cpp
+    import llama_cpp
+    return llama_cpp
+
+
+def _seq_rm(lib, ctx, seq_id):
+    # Xóa KV của một chuỗi, tên hàm thay đổi theo phiên bản llama.cpp
+    if hasattr(lib, "llama_memory_seq_rm"):
+        lib.llama_memory_seq_rm(lib.llama_get_memory(ctx), seq_id, -1, -1)
+    elif hasattr(lib, "llama_kv_self_seq_rm"):
+        lib.llama_kv_self_seq_rm(ctx, seq_id, -1, -1)
+    else:
+        lib.llama_kv_cache_seq_rm(ctx, seq_id, -1, -1)
+
+
+def sample_token(logits, temperature, top_p, rng):
+    # Lấy mẫu một token từ logits bằng NumPy (temperature + top-p)
+    import numpy as np
+
+    if temperature <= 0:
+        return int(np.argmax(logits))
+
+    scaled = logits.astype(np.float64) / temperature
+    scaled -= scaled.max()
+    probs = np.exp(scaled)
+    probs /= probs.sum()
+
+    if top_p < 1.0:
+        order = np.argsort(-probs)
+        cumulative = np.cumsum(probs[order])
+        keep = order[:int(np.searchsorted(cumulative, top_p)) + 1]
+        kept = probs[keep]
+        return int(keep[rng.choice(len(keep), p=kept / kept.sum())])
+    return int(rng.choice(len(probs), p=probs))
+
+
+class _Sequence:
+    # Một request đang chờ hoặc đang chạy trong engine
+
+    def __init__(self, prompt_tokens, max_tokens, temperature, top_p, stop, cancel=None, trace=None, seed=None,
+                 grammar=None, stop_ids=()):
+        import numpy as np
+
+        self.tokens = list(prompt_tokens)   # Prompt + các token đã sinh
+        self.n_past = 0                     # Số token đã nằm trong KV
+        self.generated = 0
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop = StopMatcher(stop)       # Dò stop string tăng dần trên text đã sinh
+        self.stop_ids = set(stop_ids)       # Token kết thúc lượt (EOS/EOT của template)
+        self.rng = np.random.default_rng(seed)  # Bộ sinh số ngẫu nhiên riêng mỗi chuỗi, cùng seed cho cùng mẫu
+        self.seq_id = None
+        self.cancelled = False
+        self.cancel_event = cancel          # threading.Event của bên gọi (hủy từ bên ngoài)
+        self.out = queue.Queue()
+        self.trace = trace                  # RequestTrace của bên gọi (có thể None)
+        self.grammar = grammar              # CompiledGrammar hoặc None
+        self.grammar_sampler = None         # Sampler grammar của llama.cpp, tạo khi chuỗi được nhận vào slot
+        self.submitted_at = time.perf_counter()
+        self.admitted_at = None
+        self.first_token_at = None
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+
+    def is_cancelled(self):
+        return self.cancelled or (self.cancel_event is not None and self.cancel_event.is_set())
+
+    def feed(self, piece):
+        # Nhận bytes của token mới, gửi phần text chắc chắn không thuộc stop string
+        # Trả về True nếu gặp stop string
+        text, stopped = self.stop.feed(self._decoder.decode(piece))
+        if text:
+            self.out.put(text)
+        return stopped
+
+    def _record_trace(self):
+        # batch_wait: chờ slot trống, eval: từ lúc vào slot tới token đầu tiên, sample: các token còn lại
+        end = time.perf_counter()
+        admitted = self.admitted_at or end
+        first = self.first_token_at or end
+        self.trace.add("batch_wait", admitted - self.submitted_at)
+        self.trace.add("eval", max(0.0, first - admitted))
+        self.trace.add("sample", end - first)
+        self.trace.set("completion_tokens", self.generated)
+
+    def close(self, error=None):
+        if self.trace is not None:
+            self._record_trace()
+        if error is None:
+            # Phần text còn giữ lại (chưa đủ để biết có phải stop string) được trả ra nốt
+            text, _ = self.stop.feed(self._decoder.decode(b"", final=True))
+            text += self.stop.flush()
+            if text:
+                self.out.put(text)
+        else:
+            self.out.put(error)
+        self.out.put(_END)
+
+
+class BatchEngine:
+    # Luồng nền giữ context llama.cpp riêng, chạy vòng: nhận request -> gộp batch -> decode -> lấy mẫu
+    # llama: đối tượng llama_cpp.Llama đã tải trọng số (dùng model và tokenizer của nó)
+
+    def __init__(self, llama, n_ctx=2048, n_batch=512, n_threads=4, max_sequences=4, grammar_samplers=None):
+        lib = _llama_api()
+        self.lib = lib
+        self.llama = llama
+        self.n_ctx = n_ctx                  # Cửa sổ ngữ cảnh của mỗi chuỗi
+        self.max_sequences = max_sequences
+        # Mỗi bước decode có ít nhất một token cho mỗi chuỗi đang sinh
+        self.n_batch = max(n_batch, max_sequences)
+        self.n_vocab = llama.n_vocab()
+        self.eos = llama.token_eos()
+        # Sampler grammar gốc dùng chung với wrapper, mỗi chuỗi nhận bản clone khi được nhận vào slot
+        self.grammar_samplers = grammar_samplers
+
+        params = lib.llama_context_default_params()
+        params.n_ctx = n_ctx * max_sequences
+        params.n_batch = self.n_batch
+        if hasattr(params, "n_ubatch"):
+            params.n_ubatch = self.n_batch
+        params.n_seq_max = max_sequences
+        params.n_threads = n_threads
+        params.n_threads_batch = n_threads
+        new_context = getattr(lib, "llama_init_from_model", None) or lib.llama_new_context_with_model
+        self.ctx = new_context(llama.model, params)
+        if not self.ctx:
+            raise RuntimeError("Không tạo được context llama.cpp cho batch engine")
+        self.batch = lib.llama_batch_init(self.n_batch, 0, max_sequences)
+
+        self._incoming = queue.Queue()
+        self._active = []
+        self._free_slots = list(range(max_sequences))
+        self._running = True
+        self._candidates = None  # Mảng TOKEN_DATA cả bộ từ vựng, dùng lại cho mỗi lần áp grammar
+        self.steps = 0
+        self.tokens_decoded = 0
+
+        self._thread = threading.Thread(target=self._loop, name="batch-engine", daemon=True)
+        self._thread.start()
+
+    def submit(self, seq):
+        if len(seq.tokens) + seq.max_tokens > self.n_ctx:
+            raise ValueError(
+                f"Requested tokens ({len(seq.tokens) + seq.max_tokens}) exceed context window of {self.n_ctx}"
+            )
+        if not self._running:
+            raise RuntimeError("Batch engine đã dừng")
+        self._incoming.put(seq)
+
+    def _admit(self):
+        # Nhận request mới vào các slot trống; khi không có chuỗi nào đang chạy thì chờ
+        while self._free_slots:
+            try:
+                seq = self._incoming.get(block=not self._active, timeout=0.5)
+            except queue.Empty:
+                return
+            if seq is None:
+                continue
+            if seq.is_cancelled():
+                seq.close()
+                continue
+            if seq.grammar is not None:
+                try:
+                    if self.grammar_samplers is not None:
+                        seq.grammar_sampler = self.grammar_samplers.acquire(seq.grammar)
+                except ValueError as e:
+                    seq.close(RuntimeError(f"Lỗi khi sinh text: {e}"))
+                    continue
+                if seq.grammar_sampler is None:
+                    seq.close(RuntimeError("Bản llama-cpp-python đang cài không hỗ trợ grammar ở chế độ batched"))
+                    continue
+            seq.seq_id = self._free_slots.pop()
+            seq.admitted_at = time.perf_counter()
+            self._active.append(seq)
+
+    def _release(self, seq, error=None):
+        if seq.grammar_sampler is not None:
+            self.grammar_samplers.release(seq.grammar_sampler)
+            seq.grammar_sampler = None
+        _seq_rm(self.lib, self.ctx, seq.seq_id)
+        self._free_slots.append(seq.seq_id)
+        self._active.remove(seq)
+        seq.close(error)
+
+    def _loop(self):
+        while self._running:
+            try:
+                self._admit()
+                for seq in [s for s in self._active if s.is_cancelled()]:
+                    self._release(seq)
+                if self._active:
+                    self._step()
+            except Exception as e:
+                print(f"Lỗi batch engine: {e}")
+                for seq in list(self._active):
+                    self._release(seq, RuntimeError(f"Lỗi khi sinh text: {e}"))
+
+        for seq in list(self._active):
+            self._release(seq, RuntimeError("Batch engine đã dừng"))
+
+    def _step(self):
+        # Gộp token cần đánh giá của mọi chuỗi vào một batch:
+        # chuỗi đang sinh góp 1 token, chuỗi mới góp một đoạn prompt (chia nhỏ theo n_batch)
+        batch = self.batch
+        n = 0
+        planned = []  # (seq, số token đưa vào batch, vị trí logits hoặc None)
+        ordered = sorted(self._active, key=lambda s: s.n_past < len(s.tokens) - 1)
+        for seq in ordered:
+            room = self.n_batch - n
+            if room <= 0:
+                break
+            chunk = seq.tokens[seq.n_past:seq.n_past + room]
+            for j, token in enumerate(chunk):
+                batch.token[n + j] = token
+                batch.pos[n + j] = seq.n_past + j
+                batch.n_seq_id[n + j] = 1
+                batch.seq_id[n + j][0] = seq.seq_id
+                batch.logits[n + j] = False
+            n += len(chunk)
+            logits_at = None
+            if seq.n_past + len(chunk) == len(seq.tokens):
+                # Đã đưa hết token của chuỗi: lấy logits ở token cuối để sinh token tiếp theo
+                logits_at = n - 1
+                batch.logits[logits_at] = True
+            planned.append((seq, len(chunk), logits_at))
+
+        batch.n_tokens = n
+        ret = self.lib.llama_decode(self.ctx, batch)
+        if ret != 0:
+            raise RuntimeError(f"llama_decode trả về {ret}")
+        self.steps += 1
+        self.tokens_decoded += n
+
+        import numpy as np
+        for seq, count, logits_at in planned:
+            seq.n_past += count
+            if logits_at is None:
+                continue
+            logits = np.ctypeslib.as_array(self.lib.llama_get_logits_ith(self.ctx, logits_at), shape=(self.n_vocab,))
+            token = self._sample(seq, logits)
+            seq.generated += 1
+            if seq.first_token_at is None:
+                seq.first_token_at = time.perf_counter()
+
+            if token == self.eos or token in seq.stop_ids:
+                self._release(seq)
+                continue
+            if seq.grammar_sampler is not None:
+                self.lib.llama_sampler_accept(seq.grammar_sampler, token)
+            seq.tokens.append(token)
+            hit_stop = seq.feed(self.llama.detokenize([token]))
+            if hit_stop or seq.generated >= seq.max_tokens:
+                self._release(seq)
+
+    def _sample(self, seq, logits):
+        sampler = seq.grammar_sampler
+        if sampler is None:
+            return sample_token(logits, seq.temperature, seq.top_p, seq.rng)
+        if seq.temperature <= 0 or seq.top_p >= 1.0:
+            # Argmax hoặc lấy mẫu theo toàn bộ phân phối: lấy mẫu trước rồi chỉ kiểm tra token đó (đa số được nhận),
+            # bị loại thì lấy mẫu lại trên logits đã lọc; đây là lấy mẫu loại bỏ nên phân phối đúng bằng
+            # phân phối chỉ gồm các token grammar cho phép
+            token = sample_token(logits, seq.temperature, seq.top_p, seq.rng)
+            if grammar_allows(sampler, token, logits):
+                return token
+        # Với top_p < 1 tập nucleus phải tính sau khi lọc grammar (nucleus của logits gốc có thể chỉ gồm token
+        # bị loại, lấy mẫu lại sẽ cho phân phối khác), nên lọc cả bộ từ vựng trước khi lấy mẫu
+        return sample_token(self._grammar_mask(sampler, logits), seq.temperature, seq.top_p, seq.rng)
+
+    def _grammar_mask(self, sampler, logits):
+        import numpy as np
+
+        if self._candidates is None:
+            self._candidates = np.zeros(self.n_vocab, dtype=TOKEN_DATA)
+        return grammar_mask(sampler, logits, self._candidates)
+
+    def active_count(self):
+        return len(self._active)
+
+    def stats(self):
+        return {
+            "active_sequences": len(self._active),
+            "max_sequences": self.max_sequences,
+            "waiting": self._incoming.qsize(),
+            "decode_steps": self.steps,
+            "tokens_decoded": self.tokens_decoded,
+            "avg_tokens_per_step": round(self.tokens_decoded / self.steps, 2) if self.steps else 0.0,
+        }
+
+    def shutdown(self, timeout=10):
+        self._running = False
+        self._incoming.put(None)
+        self._thread.join(timeout)
+        self.lib.llama_batch_free(self.batch)
+        self.lib.llama_free(self.ctx)
+
+
+class BatchedModelWrapper(ModelWrapper):
+    # Cùng giao diện với ModelWrapper nhưng các lời gọi generate đồng thời được gộp vào BatchEngine
+    # Mỗi request giữ temperature/top_p/max_tokens và stop string riêng (mặc định theo chat template của model)
+
+    def __init__(self, overrides=None):
+        # KV của từng chuỗi nằm trong slot của engine, không dùng cache snapshot theo cuộc trò chuyện
+        overrides = dict(overrides or {})
+        overrides["kv_cache_max_mb"] = 0
+        overrides["kv_disk_cache_max_mb"] = 0
+        self.engine = None
+        super().__init__(overrides=overrides)
+
+    def _initialize_model(self):
+        # Llama chỉ dùng để tải trọng số và tokenizer nên context của nó để nhỏ,
+        # context thật (n_ctx x số chuỗi) do BatchEngine tạo
+        self._validate_config()
+        model_path = self.config.get('model_path')
+        print(f"Đang tải model (chế độ batch) từ: {model_path}")
+        try:
+            from llama_cpp import Llama
+            self.model = Llama(
+                model_path=model_path,
+                n_ctx=512,
+                n_threads=self.config.get('n_threads', 4),
+                n_batch=self.config.get('n_batch', 16),
+                use_mmap=self.config.get('use_mmap', True),
+                use_mlock=self.config.get('use_mlock', False),
+                verbose=False
+            )
+            self.grammar_samplers = GrammarSamplerCache(self.model, self.config.get('grammar_cache_size', 32))
+            self.engine = BatchEngine(
+                self.model,
+                n_ctx=self.config.get('n_ctx', 1024),
+                n_batch=self.config.get('batch_max_tokens', 512),
+                n_threads=self.config.get('n_threads', 4),
+                max_sequences=self.config.get('batch_max_sequences', 4),
+                grammar_samplers=self.grammar_samplers,
+            )
+            print("Model đã được tải thành công!")
+        except Exception as e:
+            raise RuntimeError(f"Lỗi khi tải model: {e}")
+
+    def generate(self, prompt, max_tokens=None, temperature=None, top_p=None, stream=None, conv_id=None, stop=None,
+                 cancel=None, trace=None, seed=None, grammar=None, json_schema=None):
+        if self.engine is None:
+            raise RuntimeError("Model chưa được khởi tạo")
+
+        max_tokens = max_tokens or self.config.get('max_tokens', 256)
+        temperature = temperature if temperature is not None else self.config.get('temperature', 0.7)
+        top_p = top_p or self.config.get('top_p', 0.9)
+        stream = stream if stream is not None else self.config.get('stream', False)
+
+        start = time.perf_counter()
+        tokens = self.model.tokenize(prompt.encode("utf-8"), special=True)
+        if trace is not None:
+            trace.add("tokenize", time.perf_counter() - start)
+            trace.set("prompt_tokens", len(tokens))
+        try:
+            compiled = get_grammar_cache().get(grammar, json_schema)
+        except ValueError as e:
+            raise RuntimeError(f"Lỗi khi sinh text: {e}")
+        seq = _Sequence(tokens, max_tokens, temperature, top_p, stop or self.chat_template.stop_strings, cancel, trace,
+                        seed, compiled, self.stop_token_ids)
+        try:
+            self.engine.submit(seq)
+        except Exception as e:
+            raise RuntimeError(f"Lỗi khi sinh text: {e}")
+
+        if stream:
+            return self._iter_sequence(seq)
+        return "".join(self._iter_sequence(seq)).strip()
+
+    def _iter_sequence(self, seq):
+        try:
+            while True:
+                item = seq.out.get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Bên đọc dừng giữa chừng (client ngắt kết nối): engine sẽ giải phóng slot ở bước kế tiếp
+            seq.cancelled = True
+
+    def stats(self):
+        return self.engine.stats() if self.engine else {}
+
+    def close(self):
+        if self.engine is not None:
+            self.engine.shutdown()
+            self.engine = None
+        super().close()
@@ -0,0 +1,275 @@
+ # Chạy suy luận hàng loạt từ file JSONL (đánh giá model, sinh dữ liệu, kiểm tra hồi quy)
+ # Đọc từng dòng qua hàng đợi có giới hạn và ghi kết quả ngay khi mỗi dòng xong, nên bộ nhớ không tăng theo
+ # kích thước file; cùng ModelWrapper và cùng định dạng prompt với chat
+ #   python app.py batch prompts.jsonl -o results.jsonl --workers 4 --seed 42
+ #   python app.py batch prompts.jsonl -o results.jsonl --resume      (chạy tiếp sau khi bị dừng giữa chừng)
+ # Mỗi dòng vào: {"id": ..., "prompt": "...", "history": [{"role": "user", "content": "..."}, ...],
+ #                "max_tokens": ..., "temperature": ..., "top_p": ..., "seed": ...,
+ #                "json_schema": {...} hoặc "grammar": "<GBNF>"} (chỉ "prompt" là bắt buộc)
+ # Mỗi dòng ra: {"line": ..., "id": ..., "response": "...", "prompt_tokens": ..., "completion_tokens": ...,
+ #               "seconds": ..., "seed": ...} hoặc {"line": ..., "id": ..., "error": "..."}
+import os
+import sys
+import json
+import time
+import queue
+import threading
+
+from core.conversation import ConversationManager
+from core.metrics import RequestTrace
+from core.tokenizer import TokenCounter
+
+_END = object()
+
+
+def create_backend(mode, workers, overrides=None):
+    # single: một ModelWrapper (một luồng gọi model); pool: N tiến trình model; batched: N chuỗi chung một batch
+    overrides = dict(overrides or {})
+    if mode == "pool":
+        from core.worker_pool import ModelWorkerPool
+        return ModelWorkerPool(workers, n_threads=overrides.get("n_threads"), model_path=overrides.get("model_path"))
+    if mode == "batched":
+        from core.batch_engine import BatchedModelWrapper
+        overrides["batch_max_sequences"] = workers
+        return BatchedModelWrapper(overrides)
+    if mode == "stub":
+        from bench.stub_model import StubModelWrapper
+        return StubModelWrapper(overrides)
+    from core.model_llama_cpp import ModelWrapper
+    return ModelWrapper(overrides)
+
+
+def _count_lines(path):
+    # Đếm số dòng có nội dung (đọc lần lượt, không giữ lại) để báo tiến độ
+    with open(path, "rb") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def load_checkpoint(output_path):
+    # Đọc file kết quả của lần chạy trước, trả về tập số dòng đã xong
+    # Dòng ghi dở (tiến trình bị dừng giữa lúc ghi) bị cắt bỏ; dòng lỗi được bỏ khỏi file để chạy lại
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+
+    failed = 0
+    with open(output_path, "rb+") as f:
+        data_end = 0
+        for raw in iter(f.readline, b""):
+            if not raw.endswith(b"\n"):
+                break
+            data_end += len(raw)
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                failed += 1
+                continue
+            if "error" in record or record.get("line") is None:
+                failed += 1
+            else:
+                done.add(record["line"])
+        f.truncate(data_end)
+
+    if failed:
+        # Viết lại file (theo luồng, từng dòng) chỉ giữ các dòng thành công
+        tmp = output_path + ".tmp"
+        with open(output_path, "rb") as src, open(tmp, "wb") as dst:
+            for raw in src:
+                try:
+                    record = json.loads(raw)
+                    if "error" not in record and record.get("line") is not None:
+                        dst.write(raw)
+                except ValueError:
+                    pass
+        os.replace(tmp, output_path)
+    return done
+
+
+class BatchRunner:
+    # backend: đối tượng có generate(prompt, stream=False, trace=..., seed=..., ...) như ModelWrapper
+    # workers: số luồng gửi request song song (nên bằng số worker/số chuỗi của backend)
+    # seed: seed gốc, dòng thứ i dùng seed + i (trừ khi dòng tự ghi "seed") nên kết quả không phụ thuộc
+    # thứ tự chạy, số worker hay việc chạy tiếp từ checkpoint
+
+    # constraint: {"json_schema": ...} hoặc {"grammar": ...} áp dụng cho mọi dòng không tự ghi ràng buộc riêng
+
+    def __init__(self, backend, workers=1, seed=0, raw=False, max_tokens=None, temperature=None, top_p=None,
+                 report_every=10.0, token_counter=None, constraint=None):
+        self.backend = backend
+        self.config = backend.get_config()
+        self.workers = max(1, workers)
+        self.seed = seed
+        self.raw = raw
+        self.params = {"max_tokens": max_tokens, "temperature": temperature, "top_p": top_p}
+        self.report_every = report_every
+        self.constraint = constraint or {}
+        if token_counter is None:
+            model = getattr(backend, "model", None)
+            token_counter = TokenCounter(llama=model) if model is not None else TokenCounter(
+                self.config.get("model_path"))
+        self.token_counter = token_counter
+
+        self._lock = threading.Lock()
+        self._out = None
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.busy_seconds = 0.0
+
+    def build_prompt(self, record):
+        # Cùng định dạng với chat (chat template của model): lịch sử (nếu có) + câu hỏi + phần mở lượt trả lời
+        if self.raw:
+            return record["prompt"]
+        manager = ConversationManager(self.config, token_counter=self.token_counter,
+                                      template=getattr(self.backend, "chat_template", None))
+        for message in record.get("history", ()):
+            if message.get("role") == "user":
+                manager.add_user_message(message.get("content", ""))
+            else:
+                manager.add_assistant_message(message.get("content", ""))
+        return manager.build_prompt(record["prompt"], max_tokens=self._param(record, "max_tokens"))
+
+    def _constraint(self, record):
+        # Ràng buộc riêng của dòng được ưu tiên hơn ràng buộc chung
+        if record.get("json_schema") is not None:
+            return {"json_schema": record["json_schema"]}
+        if record.get("grammar"):
+            return {"grammar": record["grammar"]}
+        return self.constraint
+
+    def _param(self, record, name):
+        value = record.get(name)
+        return value if value is not None else self.params[name]
+
+    def _read(self, input_path, jobs, done):
+        # Luồng đọc: đưa từng dòng vào hàng đợi có giới hạn (chặn khi các worker chưa kịp xử lý)
+        f = sys.stdin if input_path == "-" else open(input_path, encoding="utf-8")
+        try:
+            for line_no, line in enumerate(f):
+                if not line.strip():
+                    continue
+                if line_no in done:
+                    self.skipped += 1
+                    continue
+                jobs.put((line_no, line))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+            for _ in range(self.workers):
+                jobs.put(_END)
+
+    def _process(self, line_no, line):
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            return {"line": line_no, "id": line_no, "error": f"Dòng JSON không hợp lệ: {e}"}
+        if not isinstance(record, dict) or not isinstance(record.get("prompt"), str):
+            return {"line": line_no, "id": line_no, "error": "Thiếu trường prompt"}
+
+        record_id = record.get("id", line_no)
+        seed = record.get("seed")
+        if seed is None:
+            seed = self.seed + line_no
+        trace = RequestTrace()
+        start = time.perf_counter()
+        try:
+            response = self.backend.generate(
+                self.build_prompt(record),
+                max_tokens=self._param(record, "max_tokens"),
+                temperature=self._param(record, "temperature"),
+                top_p=self._param(record, "top_p"),
+                stream=False,
+                trace=trace,
+                seed=seed,
+                **self._constraint(record),
+            )
+        except Exception as e:
+            return {"line": line_no, "id": record_id, "seed": seed, "error": str(e)}
+        return {
+            "line": line_no,
+            "id": record_id,
+            "response": response,
+            "prompt_tokens": trace.values.get("prompt_tokens", 0),
+            "completion_tokens": trace.values.get("completion_tokens", 0),
+            "seconds": round(time.perf_counter() - start, 4),
+            "seed": seed,
+        }
+
+    def _write(self, result):
+        # Ghi và flush từng dòng: bị dừng bất kỳ lúc nào thì mọi dòng đã ghi đều dùng được khi chạy tiếp
+        data = (json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            if self._out is None:
+                return
+            self._out.write(data)
+            self._out.flush()
+            if "error" in result:
+                self.failed += 1
+                print(f"Lỗi dòng {result['line']}: {result['error']}")
+            else:
+                self.completed += 1
+                self.prompt_tokens += result["prompt_tokens"]
+                self.completion_tokens += result["completion_tokens"]
+                self.busy_seconds += result["seconds"]
+
+    def _work(self, jobs):
+        while True:
+            item = jobs.get()
+            if item is _END:
+                return
+            self._write(self._process(*item))
+
+    def _report(self, start, total, final=False):
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        with self._lock:
+            finished = self.completed + self.failed
+            stats = {
+                "completed": self.completed,
+                "failed": self.failed,
+                "skipped": self.skipped,
+                "elapsed_seconds": round(elapsed, 2),
+                "requests_per_second": round(finished / elapsed, 3),
+                "prompt_tokens_per_second": round(self.prompt_tokens / elapsed, 1),
+                "completion_tokens_per_second": round(self.completion_tokens / elapsed, 1),
+                "avg_seconds_per_request": round(self.busy_seconds / self.completed, 3) if self.completed else 0.0,
+            }
+        progress = f"{finished + self.skipped}/{total}" if total else str(finished + self.skipped)
+        print(f"{'Xong' if final else 'Tiến độ'}: {progress} dòng ({self.failed} lỗi) | "
+              f"{stats['requests_per_second']} request/s | {stats['completion_tokens_per_second']} token/s")
+        return stats
+
+    def run(self, input_path, output_path, resume=False):
+        # Trả về thống kê thông lượng của lần chạy
+        done = load_checkpoint(output_path) if resume else set()
+        if done:
+            print(f"Chạy tiếp: bỏ qua {len(done)} dòng đã có kết quả")
+        total = _count_lines(input_path) if input_path != "-" else None
+
+        out_dir = os.path.dirname(os.path.abspath(output_path))
+        os.makedirs(out_dir, exist_ok=True)
+        self._out = open(output_path, "ab" if resume else "wb")
+        # Hàng đợi nhỏ: chỉ vài dòng nằm trong bộ nhớ cùng lúc dù file vào lớn bao nhiêu
+        jobs = queue.Queue(maxsize=self.workers * 2)
+        reader = threading.Thread(target=self._read, args=(input_path, jobs, done), name="batch-reader",
+                                  daemon=True)
+        threads = [threading.Thread(target=self._work, args=(jobs,), name=f"batch-worker-{i}", daemon=True)
+                   for i in range(self.workers)]
+
+        start = time.perf_counter()
+        reader.start()
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(self.report_every)
+                    if thread.is_alive():
+                        self._report(start, total)
+        finally:
+            with self._lock:
+                os.fsync(self._out.fileno())
+                self._out.close()
+                self._out = None
+        return self._report(start, total, final=True)
@@ -0,0 +1,293 @@
+ # Định dạng prompt theo chat template của model và phát hiện điểm dừng của câu trả lời
+ # Template được nhận ra từ metadata tokenizer.chat_template trong file GGUF (đọc thẳng phần header, không cần tải model),
+ # kèm các token kết thúc lượt (EOS/EOT) để dừng decode ngay khi model kết thúc câu trả lời
+ # StopMatcher dò các stop string trên luồng text từng token bằng automaton Aho-Corasick (trie + liên kết thất bại)
+import os
+import struct
+import functools
+
+
+# Mỗi họ template: định dạng từng vai, phần mở lượt trả lời, stop string và các token kết thúc lượt
+# "legacy" là định dạng ### Human/### Assistant dùng từ trước tới nay
+TEMPLATES = {
+    "legacy": {
+        "roles": {
+            "system": "### System: {content}\n",
+            "user": "### Human: {content}\n",
+            "assistant": "### Assistant: {content}\n",
+        },
+        "generation": "### Assistant:",
+        "stop": ["### Human:", "\n### Human:", "Human:", "\nHuman:"],
+        "end_tokens": [],
+    },
+    "chatml": {
+        "roles": {
+            "system": "<|im_start|>system\n{content}<|im_end|>\n",
+            "user": "<|im_start|>user\n{content}<|im_end|>\n",
+            "assistant": "<|im_start|>assistant\n{content}<|im_end|>\n",
+        },
+        "generation": "<|im_start|>assistant\n",
+        "stop": ["<|im_end|>", "<|im_start|>"],
+        "end_tokens": ["<|im_end|>", "<|endoftext|>"],
+    },
+    "llama3": {
+        "roles": {
+            "system": "<|start_header_id|>system<|end_header_id|>\n\n{content}<|eot_id|>",
+            "user": "<|start_header_id|>user<|end_header_id|>\n\n{content}<|eot_id|>",
+            "assistant": "<|start_header_id|>assistant<|end_header_id|>\n\n{content}<|eot_id|>",
+        },
+        "generation": "<|start_header_id|>assistant<|end_header_id|>\n\n",
+        "stop": ["<|eot_id|>", "<|eom_id|>", "<|start_header_id|>"],
+        "end_tokens": ["<|eot_id|>", "<|eom_id|>", "<|end_of_text|>"],
+    },
+    "gemma": {
+        # Gemma không có vai system: nội dung system được đưa vào như một lượt của user
+        "roles": {
+            "system": "<start_of_turn>user\n{content}<end_of_turn>\n",
+            "user": "<start_of_turn>user\n{content}<end_of_turn>\n",
+            "assistant": "<start_of_turn>model\n{content}<end_of_turn>\n",
+        },
+        "generation": "<start_of_turn>model\n",
+        "stop": ["<end_of_turn>", "<start_of_turn>"],
+        "end_tokens": ["<end_of_turn>"],
+    },
+    "mistral": {
+        "roles": {
+            "system": "[INST] {content} [/INST]",
+            "user": "[INST] {content} [/INST]",
+            "assistant": " {content}</s>",
+        },
+        "generation": "",
+        "stop": ["[INST]", "</s>"],
+        "end_tokens": [],
+    },
+    "phi3": {
+        "roles": {
+            "system": "<|system|>\n{content}<|end|>\n",
+            "user": "<|user|>\n{content}<|end|>\n",
+            "assistant": "<|assistant|>\n{content}<|end|>\n",
+        },
+        "generation": "<|assistant|>\n",
+        "stop": ["<|end|>", "<|user|>", "<|endoftext|>"],
+        "end_tokens": ["<|end|>", "<|endoftext|>"],
+    },
+}
+
+# Dấu hiệu nhận ra họ template trong mã Jinja của tokenizer.chat_template (kiểm tra theo thứ tự)
+_MARKERS = [
+    ("<|im_start|>", "chatml"),
+    ("<|start_header_id|>", "llama3"),
+    ("<start_of_turn>", "gemma"),
+    ("<|assistant|>", "phi3"),
+    ("[INST]", "mistral"),
+]
+
+# Các khóa metadata GGUF cần đọc
+_GGUF_KEYS = (
+    "tokenizer.chat_template",
+    "tokenizer.ggml.eos_token_id",
+    "tokenizer.ggml.eot_token_id",
+    "tokenizer.ggml.eom_token_id",
+)
+
+# Kiểu giá trị trong header GGUF: mã kiểu -> định dạng struct (8 = chuỗi, 9 = mảng)
+_GGUF_SCALARS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+_GGUF_STRING = 8
+_GGUF_ARRAY = 9
+
+
+def _read(f, fmt):
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("File GGUF bị cắt cụt")
+    return struct.unpack(fmt, data)[0]
+
+
+def _read_string(f):
+    return f.read(_read(f, "<Q")).decode("utf-8", errors="replace")
+
+
+def _skip_value(f, value_type):
+    # Bỏ qua một giá trị không cần đọc (mảng token của tokenizer có thể dài hàng trăm nghìn phần tử)
+    if value_type in _GGUF_SCALARS:
+        f.seek(struct.calcsize(_GGUF_SCALARS[value_type]), os.SEEK_CUR)
+    elif value_type == _GGUF_STRING:
+        f.seek(_read(f, "<Q"), os.SEEK_CUR)
+    elif value_type == _GGUF_ARRAY:
+        item_type = _read(f, "<I")
+        count = _read(f, "<Q")
+        if item_type in _GGUF_SCALARS:
+            f.seek(count * struct.calcsize(_GGUF_SCALARS[item_type]), os.SEEK_CUR)
+        else:
+            for _ in range(count):
+                _skip_value(f, item_type)
+    else:
+        raise ValueError(f"Kiểu metadata GGUF không hỗ trợ: {value_type}")
+
+
+def read_gguf_metadata(path, keys=_GGUF_KEYS):
+    # Đọc các khóa metadata (chuỗi hoặc số) từ header file GGUF v2/v3, dừng ngay khi đã đủ khóa
+    wanted = set(keys)
+    found = {}
+    with open(path, "rb") as f:
+        if f.read(4) != b"GGUF" or _read(f, "<I") < 2:
+            return found
+        _read(f, "<Q")  # Số tensor
+        kv_count = _read(f, "<Q")
+        for _ in range(kv_count):
+            key = _read_string(f)
+            value_type = _read(f, "<I")
+            if key in wanted and value_type in _GGUF_SCALARS:
+                found[key] = _read(f, _GGUF_SCALARS[value_type])
+            elif key in wanted and value_type == _GGUF_STRING:
+                found[key] = _read_string(f)
+            else:
+                _skip_value(f, value_type)
+            if len(found) == len(wanted):
+                break
+    return found
+
+
+def detect_template(source):
+    # Tên họ template ứng với mã Jinja trong GGUF, None nếu không nhận ra
+    for marker, name in _MARKERS:
+        if source and marker in source:
+            return name
+    return None
+
+
+class ChatTemplate:
+    # Định dạng prompt của một model: format_message cho từng tin nhắn (đếm token từng tin nhắn được),
+    # generation_prompt mở lượt trả lời, stop_strings và token_ids để dừng khi model kết thúc lượt
+
+    def __init__(self, name, eog_token_ids=()):
+        spec = TEMPLATES[name]
+        self.name = name
+        self.roles = spec["roles"]
+        self.generation_prompt = spec["generation"]
+        self.stop_strings = list(spec["stop"])
+        self.end_tokens = list(spec["end_tokens"])
+        self.eog_token_ids = set(eog_token_ids)  # Token kết thúc đọc từ metadata GGUF
+
+    def format_message(self, role, content):
+        return self.roles.get(role, self.roles["user"]).format(content=content)
+
+    def render(self, messages):
+        # messages: [(role, content)] -> prompt hoàn chỉnh, kết thúc bằng phần mở lượt trả lời
+        return "".join(self.format_message(role, content) for role, content in messages) + self.generation_prompt
+
+    def token_ids(self, llama):
+        # Tập token id kết thúc lượt: EOS/EOT từ metadata, EOS của tokenizer và các token đặc biệt của template
+        ids = set(self.eog_token_ids)
+        token_eos = getattr(llama, "token_eos", None)
+        if token_eos is not None:
+            ids.add(token_eos())
+        for text in self.end_tokens:
+            try:
+                tokens = llama.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+            except Exception:
+                continue
+            if len(tokens) == 1:
+                ids.add(tokens[0])
+        return ids
+
+
+@functools.lru_cache(maxsize=None)
+def load_chat_template(model_path=None, name="auto"):
+    # name: "auto" (nhận ra từ metadata GGUF, không nhận ra thì dùng "legacy") hoặc tên trong TEMPLATES
+    metadata = {}
+    if model_path and os.path.exists(model_path):
+        try:
+            metadata = read_gguf_metadata(model_path)
+        except (OSError, ValueError) as e:
+            print(f"Không đọc được metadata GGUF của {model_path}: {e}")
+
+    if name == "auto":
+        name = detect_template(metadata.get("tokenizer.chat_template")) or "legacy"
+    elif name not in TEMPLATES:
+        print(f"Không có chat template '{name}', dùng 'legacy'")
+        name = "legacy"
+
+    eog = [metadata[key] for key in _GGUF_KEYS[1:] if isinstance(metadata.get(key), int)]
+    return ChatTemplate(name, eog)
+
+
+def get_chat_template(config):
+    # Template của model trong cấu hình (MODEL_PATH và CHAT_TEMPLATE)
+    return load_chat_template(config.get("model_path"), config.get("chat_template", "auto"))
+
+
+class StopMatcher:
+    # Dò nhiều stop string cùng lúc trên luồng text đến dần: mỗi ký tự chỉ đi một bước trên automaton,
+    # không phải tìm lại trên toàn bộ câu trả lời sau mỗi token
+    # Phần cuối text có thể là đầu của một stop string được giữ lại (chưa trả ra) cho tới khi chắc chắn
+
+    def __init__(self, stops):
+        self._goto = [{}]
+        self._fail = [0]
+        self._depth = [0]
+        self._match = [0]  # Độ dài stop string dài nhất kết thúc tại nút này (kể cả qua liên kết thất bại)
+        for stop in stops:
+            self._insert(stop)
+        self._link()
+        self._state = 0
+        self._pending = ""
+        self.stopped = False
+
+    def _insert(self, stop):
+        node = 0
+        for ch in stop:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._depth.append(self._depth[node] + 1)
+                self._match.append(0)
+                self._goto[node][ch] = nxt
+            node = nxt
+        if stop:
+            self._match[node] = len(stop)
+
+    def _link(self):
+        # Duyệt theo chiều rộng để nút cha luôn có liên kết thất bại trước nút con
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for ch, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._match[child] = max(self._match[child], self._match[self._fail[child]])
+                queue.append(child)
+
+    def feed(self, text):
+        # Trả về (phần text chắc chắn không thuộc stop string, True nếu vừa gặp stop string)
+        if self.stopped:
+            return "", True
+        goto, fail = self._goto, self._fail
+        state = self._state
+        pending = self._pending + text
+        start = len(self._pending)
+        for i in range(start, len(pending)):
+            ch = pending[i]
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if self._match[state]:
+                # Cắt ở đầu stop string dài nhất kết thúc tại đây (ví dụ "\n### Human:" thay vì "Human:")
+                self.stopped = True
+                self._pending = ""
+                return pending[:i + 1 - self._match[state]], True
+        self._state = state
+        hold = self._depth[state]
+        self._pending = pending[len(pending) - hold:] if hold else ""
+        return pending[:len(pending) - hold], False
+
+    def flush(self):
+        # Hết câu trả lời: phần đang giữ lại không phải stop string, trả ra nốt
+        rest = "" if self.stopped else self._pending
+        self._pending = ""
+        self._state = 0
+        return rest
@@ -3,63 +3,202 @@
 from collections import deque
 from typing import List, Dict, Any
 
+from core.tokenizer import TokenCounter
+from core.chat_template import get_chat_template, load_chat_template
+
+
+class PromptTooLongError(ValueError):
+    # Riêng tin nhắn mới đã vượt cửa sổ ngữ cảnh của model (web trả về HTTP 413)
+    pass
+
 
 class ConversationManager:
     # Lớp lưu và quản lý lịch sử hội thoại
-    
-    def __init__(self, config):
+    # Lịch sử được xếp vào prompt theo số token thật (n_ctx - max_tokens), không theo số lượt cố định
+    # template: ChatTemplate của model (mặc định nhận ra từ file GGUF trong cấu hình)
+
+    def __init__(self, config, token_counter=None, summarizer=None, template=None):
         self.config = config
-        self.history = deque(maxlen=config.get('history_max_turns', 6) * 2)
-        
+        # history_max_turns = 0: chỉ giới hạn theo số token
+        max_turns = config.get('history_max_turns', 0)
+        self.history = deque(maxlen=max_turns * 2 if max_turns else None)
+        self.token_counter = token_counter or TokenCounter()
+        # summarizer(summary_cu, cac_tin_nhan_bi_bo) -> str: tóm tắt các lượt cũ thay vì bỏ hẳn
+        self.summarizer = summarizer
+        self.summary = ""
+        self.summary_tokens = 0
+        self.template = template or get_chat_template(config)
+
+    def set_template(self, template):
+        # Đổi định dạng prompt (ví dụ khi cuộc trò chuyện chuyển sang model khác): đếm lại token của lịch sử
+        if template is None or template.name == self.template.name:
+            return
+        self.template = template
+        self._recount()
+
+    def _recount(self):
+        for message in self.history:
+            message["tokens"] = self.token_counter.count(self._format_message(message["role"], message["content"]))
+        if self.summary:
+            self.summary_tokens = self.token_counter.count(self._summary_part())
+
+    def _format_message(self, role, content):
+        # Định dạng một tin nhắn đúng như khi ghép vào prompt
+        return self.template.format_message(role, content)
+
+    def _append(self, role, content):
+        # Đếm token một lần khi thêm tin nhắn, các lượt sau chỉ cộng dồn số đã lưu
+        tokens = self.token_counter.count(self._format_message(role, content))
+        self.history.append({"role": role, "content": content, "tokens": tokens})
+
     def add_user_message(self, message):
         # Thêm tin nhắn của người dùng vào lịch sử
         if message.strip():
-            self.history.append({"role": "user", "content": message.strip()})
-    
+            self._append("user", message.strip())
+
     def add_assistant_message(self, message):
         # Thêm câu trả lời của mô hình vào lịch sử
         if message.strip():
-            self.history.append({"role": "assistant", "content": message.strip()})
-    
-    def build_prompt(self, user_input):
+            self._append("assistant", message.strip())
+
+    def _summary_part(self):
+        return self._format_message("system", f"Tóm tắt các lượt trước: {self.summary}")
+
+    def context_budget(self, max_tokens=None):
+        # Số token còn lại cho lịch sử: n_ctx trừ phần dành cho câu trả lời và token BOS
+        max_tokens = max_tokens or self.config.get('max_tokens', 512)
+        return self.config.get('n_ctx', 2048) - max_tokens - 1
+
+    def build_prompt(self, user_input, max_tokens=None):
         # Xây dựng chuỗi prompt gửi cho mô hình từ lịch sử và câu hỏi mới
+        # Chỉ lấy các tin nhắn gần nhất còn vừa ngân sách token
+        # Tin nhắn mới không vừa cửa sổ ngữ cảnh thì báo lỗi rõ ràng thay vì để llama.cpp từ chối
+        tail = self._format_message("user", user_input) + self.template.generation_prompt
+        tail_tokens = self.token_counter.count(tail)
+        budget = self.context_budget(max_tokens) - tail_tokens
+        if budget < 0:
+            raise PromptTooLongError(
+                f"Tin nhắn quá dài ({tail_tokens} token), tối đa {self.context_budget(max_tokens)} token"
+            )
+        # Bản tóm tắt không vừa cùng tin nhắn mới thì bỏ qua ở lượt này
+        with_summary = bool(self.summary) and self.summary_tokens <= budget
+        if with_summary:
+            budget -= self.summary_tokens
+
+        selected = []
+        for message in reversed(self.history):
+            if message["tokens"] > budget:
+                break
+            budget -= message["tokens"]
+            selected.append(message)
+        selected.reverse()
+        # Không mở đầu bằng câu trả lời mà câu hỏi của nó đã bị cắt khỏi cửa sổ
+        while selected and selected[0]["role"] == "assistant":
+            selected.pop(0)
+
         prompt_parts = []
-        
+        if with_summary:
+            prompt_parts.append(self._summary_part())
+
         # Thêm lịch sử hội thoại (không bao gồm tin nhắn hiện tại)
-        for message in self.history:
-            role = message["role"]
-            content = message["content"]
-            if role == "user":
-                prompt_parts.append(f"### Human: {content}")
-            else:
-                prompt_parts.append(f"### Assistant: {content}")
-        
-        # Thêm câu hỏi mới
-        prompt_parts.append(f"### Human: {user_input}")
-        prompt_parts.append("### Assistant:")
-        
-        return "\n".join(prompt_parts)
-    
+        for message in selected:
+            prompt_parts.append(self._format_message(message["role"], message["content"]))
+
+        # Thêm câu hỏi mới và phần mở lượt trả lời
+        prompt_parts.append(tail)
+
+        # Mỗi tin nhắn đã tự kết thúc theo định dạng của template nên chỉ cần nối liền
+        return "".join(prompt_parts)
+
     def clear_history(self):
         # Xóa toàn bộ lịch sử hội thoại đang lưu
         self.history.clear()
-    
+        self.summary = ""
+        self.summary_tokens = 0
+
+    def to_dict(self):
+        # Trạng thái dạng dict (lưu được ra JSON), số token đã đếm được giữ lại để không phải đếm lại
+        return {
+            "history": [dict(message) for message in self.history],
+            "summary": self.summary,
+            "summary_tokens": self.summary_tokens,
+            "template": self.template.name,
+        }
+
+    @classmethod
+    def from_dict(cls, config, data, token_counter=None, summarizer=None, template=None):
+        # Dựng lại manager từ kết quả to_dict()
+        manager = cls(config, token_counter=token_counter, summarizer=summarizer, template=template)
+        for message in data.get("history", []):
+            manager.history.append(dict(message))
+        manager.summary = data.get("summary", "")
+        manager.summary_tokens = data.get("summary_tokens", 0)
+        # Số token đã lưu được đếm theo template lúc đó (dữ liệu cũ: định dạng legacy)
+        if data.get("template", "legacy") != manager.template.name:
+            manager._recount()
+        return manager
+
     def get_history_count(self):
         # Lấy số lượng tin nhắn đang có trong lịch sử
         return len(self.history)
-    
+
+    def get_history_tokens(self):
+        # Tổng số token của lịch sử đang lưu
+        return sum(message["tokens"] for message in self.history)
+
     def is_history_full(self):
-        # Kiểm tra lịch sử đã đầy đến giới hạn cấu hình hay chưa
-        return len(self.history) >= self.history.maxlen
-    
-    def trim_history(self, keep_turns=3):
-        # Cắt bớt các tin nhắn cũ, chỉ giữ lại một số lượt gần nhất
-        if len(self.history) <= keep_turns * 2:
-            return
-        
+        # Kiểm tra lịch sử đã vượt ngân sách token (hoặc giới hạn số lượt nếu có cấu hình)
+        if self.history.maxlen and len(self.history) >= self.history.maxlen:
+            return True
+        return self.get_history_tokens() > self.context_budget()
+
+    def trim_history(self, keep_turns=None):
+        # Cắt bớt các tin nhắn cũ cho vừa ngân sách token
+        # keep_turns: nếu truyền vào thì giữ đúng số lượt gần nhất như cách cũ
         history_list = list(self.history)
-        trimmed_history = history_list[-(keep_turns * 2):]
-        
+        if keep_turns is not None:
+            cut = max(0, len(history_list) - keep_turns * 2)
+        else:
+            budget = self.context_budget()
+            total = self.get_history_tokens()
+            cut = 0
+            while cut < len(history_list) and total > budget:
+                total -= history_list[cut]["tokens"]
+                cut += 1
+
+        if cut == 0:
+            return
+
+        dropped = history_list[:cut]
+        if self.summarizer:
+            # Gộp các lượt bị bỏ vào bản tóm tắt để không mất hẳn ngữ cảnh
+            try:
+                self.summary = self.summarizer(self.summary, dropped).strip()
+                self.summary_tokens = self.token_counter.count(self._summary_part())
+            except Exception as e:
+                print(f"Lỗi tóm tắt lịch sử: {e}")
+
         self.history.clear()
-        for message in trimmed_history:
+        for message in history_list[cut:]:
             self.history.append(message)
+
+
+def make_summarizer(generate_fn, max_tokens=128, template=None):
+    # Tạo hàm tóm tắt dùng model: generate_fn(prompt, max_tokens) -> str
+    # template: ChatTemplate của model tóm tắt (mặc định định dạng ### Human/### Assistant)
+    template = template or load_chat_template(name="legacy")
+
+    def summarize(previous_summary, messages):
+        lines = []
+        if previous_summary:
+            lines.append(f"Tóm tắt trước đó: {previous_summary}")
+        for message in messages:
+            speaker = "Người dùng" if message["role"] == "user" else "Trợ lý"
+            lines.append(f"{speaker}: {message['content']}")
+
+        prompt = template.render([
+            ("user", "Tóm tắt ngắn gọn đoạn hội thoại sau, giữ lại các thông tin quan trọng:\n" + "\n".join(lines)),
+        ])
+        return generate_fn(prompt, max_tokens)
+
+    return summarize
@@ -0,0 +1,306 @@
+ # Backend lưu trữ nhúng dùng SQLite (chế độ WAL), không cần dịch vụ database bên ngoài
+ # Phù hợp cho cài đặt một máy hoặc thiết bị biên
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from werkzeug.security import generate_password_hash, check_password_hash
+
+import config
+from core.storage import (StorageBackend, merge_pending_messages, merge_pending_page, merge_pending_search,
+                          merge_pending_conversations)
+from core.metrics import timed_storage
+from core.write_behind import WriteBehindBuffer
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    user_message TEXT NOT NULL,
+    assistant_response TEXT NOT NULL,
+    conversation_id TEXT
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    owner TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    title TEXT,
+    last_activity TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (owner, conversation_id)
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_owner_activity ON conversations(owner, last_activity DESC);
+"""
+
+# Đồng bộ bảng tìm kiếm toàn văn FTS5 với chat_history
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS chat_fts USING fts5(
+    user_message, assistant_response, content='chat_history', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS chat_history_ai AFTER INSERT ON chat_history BEGIN
+    INSERT INTO chat_fts(rowid, user_message, assistant_response)
+    VALUES (new.id, new.user_message, new.assistant_response);
+END;
+CREATE TRIGGER IF NOT EXISTS chat_history_ad AFTER DELETE ON chat_history BEGIN
+    INSERT INTO chat_fts(chat_fts, rowid, user_message, assistant_response)
+    VALUES ('delete', old.id, old.user_message, old.assistant_response);
+END;
+"""
+
+INSERT_MESSAGE = (
+    "INSERT INTO chat_history (timestamp, user_message, assistant_response, conversation_id, owner) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+UPSERT_SUMMARY = (
+    "INSERT INTO conversations (owner, conversation_id, title, last_activity, message_count) "
+    "VALUES (?, ?, ?, ?, 1) "
+    "ON CONFLICT(owner, conversation_id) DO UPDATE SET "
+    "last_activity = MAX(last_activity, excluded.last_activity), "
+    "message_count = message_count + 1"
+)
+SELECT_PAGE = (
+    "SELECT id, timestamp, user_message, assistant_response, conversation_id FROM chat_history "
+    "WHERE owner = ? AND conversation_id = ? AND (timestamp < ? OR (timestamp = ? AND id < ?)) "
+    "ORDER BY timestamp DESC, id DESC LIMIT ?"
+)
+
+
+def _ts(value):
+    # Lưu thời gian dạng ISO đủ micro giây để so sánh chuỗi đúng thứ tự thời gian
+    return value.isoformat(timespec="microseconds")
+
+
+def _doc_key(doc):
+    # Tin nhắn chưa ghi chưa có id: lọc trùng theo cuộc trò chuyện và thời điểm (lưu đủ micro giây)
+    return doc["conversation_id"], doc["timestamp"]
+
+
+class SQLiteManager(StorageBackend):
+    # Mỗi luồng dùng một kết nối riêng; WAL cho phép nhiều luồng đọc trong khi luồng nền ghi
+    metrics_backend = "sqlite"  # Nhãn backend của số liệu storage_operation_seconds
+
+    def __init__(self, db_path="chat_history.db"):
+        self.db_path = db_path
+        self._local = threading.local()
+        self.has_fts = False
+        self._init_schema()
+
+        conf = config.get_config()
+        self.writer = WriteBehindBuffer(
+            self._insert_batch,
+            batch_size=conf.get("write_batch_size", 50),
+            flush_interval=conf.get("write_flush_interval", 1.0),
+            max_pending=conf.get("write_max_pending", 1000),
+            spill_path=conf.get("write_spill_path"),
+            name="sqlite-writer"
+        )
+        print(f"[{datetime.now()}] Đã mở SQLite: {db_path}")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # cached_statements: sqlite3 giữ sẵn các câu lệnh đã biên dịch (prepared statement)
+            conn = sqlite3.connect(self.db_path, timeout=10, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        conn = self._conn()
+        with conn:
+            conn.executescript(SCHEMA)
+
+            # File chat_history.db cũ chưa có cột owner
+            columns = [row["name"] for row in conn.execute("PRAGMA table_info(chat_history)")]
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE chat_history ADD COLUMN owner TEXT")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_chat_owner_conv_ts "
+                "ON chat_history(owner, conversation_id, timestamp, id)")
+
+            # Database cũ chưa có bảng tóm tắt: dựng lại một lần từ chat_history
+            if conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0] == 0:
+                conn.execute(
+                    "INSERT OR IGNORE INTO conversations "
+                    "(owner, conversation_id, title, last_activity, message_count) "
+                    "SELECT owner, conversation_id, "
+                    "(SELECT substr(f.user_message, 1, 40) FROM chat_history f "
+                    " WHERE f.owner = h.owner AND f.conversation_id = h.conversation_id "
+                    " ORDER BY f.timestamp, f.id LIMIT 1), "
+                    "MAX(timestamp), COUNT(*) FROM chat_history h "
+                    "WHERE owner IS NOT NULL AND conversation_id IS NOT NULL "
+                    "GROUP BY owner, conversation_id")
+
+            fts_exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'chat_fts'").fetchone() is not None
+            try:
+                conn.executescript(FTS_SCHEMA)
+                if not fts_exists:
+                    # Đánh chỉ mục lại các tin nhắn đã có trước khi tạo bảng FTS
+                    conn.execute("INSERT INTO chat_fts(chat_fts) VALUES ('rebuild')")
+                self.has_fts = True
+            except sqlite3.OperationalError as e:
+                # Bản SQLite được biên dịch không kèm FTS5: tìm kiếm sẽ dùng LIKE
+                print(f"SQLite không hỗ trợ FTS5, tìm kiếm sẽ chậm hơn: {e}")
+
+    # --- QUẢN LÝ USER ---
+    @timed_storage("register_user")
+    def register_user(self, username, password):
+        """Đăng ký user mới"""
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    "INSERT INTO users (username, password, created_at) VALUES (?, ?, ?)",
+                    (username, generate_password_hash(password), _ts(datetime.now())))
+        except sqlite3.IntegrityError:
+            return False, "Tài khoản đã tồn tại!"
+        return True, "Đăng ký thành công!"
+
+    @timed_storage("login_user")
+    def login_user(self, username, password):
+        """Kiểm tra đăng nhập"""
+        row = self._conn().execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+        return bool(row and check_password_hash(row["password"], password))
+
+    # --- QUẢN LÝ CHAT ---
+    @timed_storage("save_message")
+    def save_message(self, user_msg, assistant_resp, conv_id, username):
+        """Lưu tin nhắn kèm theo username người sở hữu (ghi nền, không chờ database)"""
+        self.writer.put({
+            "timestamp": datetime.now(),
+            "user_message": user_msg,
+            "assistant_response": assistant_resp,
+            "conversation_id": conv_id,
+            "owner": username
+        })
+
+    @timed_storage("insert_batch")
+    def _insert_batch(self, docs):
+        """Ghi cả lô tin nhắn và bản tóm tắt cuộc trò chuyện trong một transaction"""
+        with self._conn() as conn:
+            conn.executemany(INSERT_MESSAGE, [
+                (_ts(d["timestamp"]), d["user_message"], d["assistant_response"], d["conversation_id"], d["owner"])
+                for d in docs
+            ])
+            conn.executemany(UPSERT_SUMMARY, [
+                (d["owner"], d["conversation_id"], (d["user_message"] or "")[:40], _ts(d["timestamp"]))
+                for d in docs
+            ])
+
+    def flush(self):
+        """Chờ các tin nhắn đang gom được ghi xong"""
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _row_to_doc(self, row):
+        doc = dict(row)
+        doc["timestamp"] = datetime.fromisoformat(doc["timestamp"])
+        doc["_id"] = doc.pop("id")
+        return doc
+
+    @timed_storage("get_conversation_list")
+    def get_conversation_list(self, username):
+        """Lấy danh sách chat của user (đọc từ bảng tóm tắt có index)"""
+        rows = self._conn().execute(
+            "SELECT conversation_id, title, last_activity, message_count FROM conversations "
+            "WHERE owner = ? ORDER BY last_activity DESC", (username,))
+        conversations = [{
+            "id": row["conversation_id"],
+            "title": row["title"] or "",
+            "last_activity": datetime.fromisoformat(row["last_activity"]),
+            "message_count": row["message_count"]
+        } for row in rows]
+        return merge_pending_conversations(conversations, self.writer.pending(owner=username))
+
+    @timed_storage("get_messages_by_conversation_id")
+    def get_messages_by_conversation_id(self, conv_id, username):
+        """Lấy nội dung chat (bảo mật: phải đúng chủ sở hữu)"""
+        pending = self.writer.pending(owner=username, conversation_id=conv_id)
+        rows = self._conn().execute(
+            "SELECT id, timestamp, user_message, assistant_response, conversation_id FROM chat_history "
+            "WHERE owner = ? AND conversation_id = ? ORDER BY timestamp, id", (username, conv_id))
+        return merge_pending_messages([self._row_to_doc(row) for row in rows], pending, _doc_key)
+
+    @timed_storage("get_messages_page")
+    def get_messages_page(self, conv_id, username, before=None, limit=20):
+        """Lấy một trang tin nhắn cũ dần theo thời gian (con trỏ "<timestamp ISO>|<id>")"""
+        # Tin nhắn chưa ghi xong luôn mới hơn dữ liệu đã ghi nên chỉ được ghép vào trang mới nhất
+        pending = [] if before else self.writer.pending(owner=username, conversation_id=conv_id)
+        if before:
+            ts_text, _, id_text = before.partition("|")
+            try:
+                ts = _ts(datetime.fromisoformat(ts_text))
+                last_id = int(id_text)
+            except ValueError:
+                raise ValueError(f"Con trỏ trang không hợp lệ: {before}")
+        else:
+            # Con trỏ "vô cực": lớn hơn mọi timestamp/id thực tế
+            ts, last_id = "9999-12-31T23:59:59.999999", 2 ** 62
+
+        rows = self._conn().execute(SELECT_PAGE, (username, conv_id, ts, ts, last_id, limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        docs = [self._row_to_doc(row) for row in rows[:limit]]
+        docs.reverse()
+
+        next_before = None
+        if has_more and docs:
+            oldest = docs[0]
+            next_before = f"{oldest['timestamp'].isoformat()}|{oldest['_id']}"
+        if not pending:
+            return docs, next_before
+        page = merge_pending_page(docs, next_before, pending, limit, _doc_key)
+        if page is None:
+            # Tin nhắn chưa ghi (chưa có id) chiếm cả trang: con trỏ lấy thời điểm của tin nhắn cũ nhất trong trang,
+            # id 0 để trang sau gồm mọi tin nhắn cũ hơn (kể cả các tin nhắn chưa ghi lúc này, khi chúng đã được ghi)
+            docs = merge_pending_messages(docs, pending, _doc_key)[-limit:]
+            page = docs, f"{docs[0]['timestamp'].isoformat()}|0"
+        return page
+
+    @timed_storage("search_messages")
+    def search_messages(self, username, query, limit=20):
+        """Tìm tin nhắn của user theo nội dung (FTS5 nếu có)"""
+        pending = self.writer.pending(owner=username)
+        conn = self._conn()
+        if self.has_fts:
+            # Đặt từng từ trong ngoặc kép để ký tự đặc biệt không bị hiểu là cú pháp FTS
+            fts_query = " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+            if not fts_query:
+                return []
+            rows = conn.execute(
+                "SELECT h.id, h.timestamp, h.user_message, h.assistant_response, h.conversation_id "
+                "FROM chat_fts JOIN chat_history h ON h.id = chat_fts.rowid "
+                "WHERE chat_fts MATCH ? AND h.owner = ? ORDER BY rank LIMIT ?",
+                (fts_query, username, limit))
+        else:
+            pattern = f"%{query}%"
+            rows = conn.execute(
+                "SELECT id, timestamp, user_message, assistant_response, conversation_id FROM chat_history "
+                "WHERE owner = ? AND (user_message LIKE ? OR assistant_response LIKE ?) "
+                "ORDER BY timestamp DESC LIMIT ?",
+                (username, pattern, pattern, limit))
+        return merge_pending_search([self._row_to_doc(row) for row in rows], pending, query, limit, _doc_key)
+
+    @timed_storage("delete_all_conversations")
+    def delete_all_conversations(self, username):
+        """Xóa lịch sử của riêng user"""
+        # Ghi hết phần đang chờ trước khi xóa, nếu không chúng sẽ được ghi lại sau khi đã xóa
+        self.flush()
+        with self._conn() as conn:
+            conn.execute("DELETE FROM chat_history WHERE owner = ?", (username,))
+            conn.execute("DELETE FROM conversations WHERE owner = ?", (username,))
@@ -1,21 +1,49 @@
 import os
-from pymongo import MongoClient
+import re
+from pymongo import MongoClient, ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import ObjectId
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
+import config
+from core.storage import (StorageBackend, merge_pending_messages, merge_pending_page, merge_pending_search,
+                          merge_pending_conversations)
+from core.metrics import STORAGE_ERRORS, timed_storage
+from core.write_behind import WriteBehindBuffer
 
 # Cấu hình MongoDB
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/") 
 DB_NAME = "chat_ai_database"
 COLLECTION_CHAT = "chat_history"
 COLLECTION_USERS = "users" 
+COLLECTION_CONVERSATIONS = "conversations"  # Bản tóm tắt mỗi cuộc trò chuyện (tiêu đề, thời gian, số tin nhắn)
+
+def _doc_key(doc):
+    # Mỗi tin nhắn có _id gán từ lúc save_message, dùng để lọc trùng khi ghép với dữ liệu chưa ghi
+    return doc["_id"]
+
+
+class MongoDBManager(StorageBackend):
+    metrics_backend = "mongo"  # Nhãn backend của số liệu storage_operation_seconds
 
-class MongoDBManager:
     def __init__(self):
         self.client = None
         self.db = None
         self.chat_col = None
         self.user_col = None
+        self.conv_col = None
         self._connect()
+
+        # Tin nhắn được ghi nền theo lô, request không phải chờ MongoDB
+        conf = config.get_config()
+        self.writer = WriteBehindBuffer(
+            self._insert_batch,
+            batch_size=conf.get("write_batch_size", 50),
+            flush_interval=conf.get("write_flush_interval", 1.0),
+            max_pending=conf.get("write_max_pending", 1000),
+            spill_path=conf.get("write_spill_path"),
+            name="mongo-writer"
+        )
         
     def _connect(self):
         try:
@@ -24,12 +52,57 @@ class MongoDBManager:
             self.db = self.client[DB_NAME]
             self.chat_col = self.db[COLLECTION_CHAT]
             self.user_col = self.db[COLLECTION_USERS]
+            self.conv_col = self.db[COLLECTION_CONVERSATIONS]
             print(f"[{datetime.now()}] Đã kết nối MongoDB thành công!")
         except Exception as e:
             print(f"Lỗi kết nối MongoDB: {e}")
+            STORAGE_ERRORS.inc(backend=self.metrics_backend, op="connect")
             self.client = None
+            return
+        self._ensure_indexes()
+
+    def _ensure_indexes(self):
+        """Tạo index khi khởi động (create_index bỏ qua nếu index đã tồn tại)"""
+        try:
+            self.chat_col.create_index(
+                [("owner", ASCENDING), ("conversation_id", ASCENDING), ("timestamp", ASCENDING)])
+            self.user_col.create_index("username", unique=True)
+            self.conv_col.create_index(
+                [("owner", ASCENDING), ("conversation_id", ASCENDING)], unique=True)
+            self.conv_col.create_index([("owner", ASCENDING), ("last_activity", DESCENDING)])
+
+            # Database cũ chưa có bản tóm tắt: dựng lại một lần từ chat_history
+            if self.conv_col.estimated_document_count() == 0 and self.chat_col.estimated_document_count() > 0:
+                self._rebuild_conversation_summaries()
+        except Exception as e:
+            print(f"Lỗi tạo index MongoDB: {e}")
+            STORAGE_ERRORS.inc(backend=self.metrics_backend, op="ensure_indexes")
+
+    def _rebuild_conversation_summaries(self):
+        """Tính lại toàn bộ bản tóm tắt cuộc trò chuyện từ chat_history"""
+        print("Đang dựng bản tóm tắt cuộc trò chuyện từ lịch sử cũ...")
+        pipeline = [
+            {"$sort": {"owner": 1, "conversation_id": 1, "timestamp": 1}},
+            {"$group": {
+                "_id": {"owner": "$owner", "conversation_id": "$conversation_id"},
+                "last_activity": {"$max": "$timestamp"},
+                "first_user_message": {"$first": "$user_message"},
+                "message_count": {"$sum": 1}
+            }},
+            {"$project": {
+                "_id": 0,
+                "owner": "$_id.owner",
+                "conversation_id": "$_id.conversation_id",
+                "title": {"$substrCP": ["$first_user_message", 0, 40]},
+                "last_activity": 1,
+                "message_count": 1
+            }},
+            {"$merge": {"into": COLLECTION_CONVERSATIONS, "on": ["owner", "conversation_id"]}}
+        ]
+        self.chat_col.aggregate(pipeline)
 
     # --- QUẢN LÝ USER ---
+    @timed_storage("register_user")
     def register_user(self, username, password):
         """Đăng ký user mới"""
         if not self.client: return False, "Lỗi DB"
@@ -38,13 +111,18 @@ class MongoDBManager:
             return False, "Tài khoản đã tồn tại!"
             
         hashed_password = generate_password_hash(password)
-        self.user_col.insert_one({
-            "username": username,
-            "password": hashed_password,
-            "created_at": datetime.now()
-        })
+        try:
+            self.user_col.insert_one({
+                "username": username,
+                "password": hashed_password,
+                "created_at": datetime.now()
+            })
+        except DuplicateKeyError:
+            # Hai request đăng ký cùng tên cùng lúc: index unique chặn bản ghi thứ hai
+            return False, "Tài khoản đã tồn tại!"
         return True, "Đăng ký thành công!"
 
+    @timed_storage("login_user")
     def login_user(self, username, password):
         """Kiểm tra đăng nhập"""
         if not self.client: return False
@@ -55,52 +133,171 @@ class MongoDBManager:
         return False
 
     # --- QUẢN LÝ CHAT (Đã cập nhật để lọc theo user) ---
+    @timed_storage("save_message")
     def save_message(self, user_msg, assistant_resp, conv_id, username):
-        """Lưu tin nhắn kèm theo username người sở hữu"""
-        if not self.client: return
+        """Lưu tin nhắn kèm theo username người sở hữu (ghi nền, không chờ MongoDB)"""
+        doc = {
+            "_id": ObjectId(),  # Gán sẵn để ghi lại từ file spill không bị trùng và để ghép với dữ liệu chưa ghi
+            "timestamp": datetime.now(),
+            "user_message": user_msg,
+            "assistant_response": assistant_resp,
+            "conversation_id": conv_id,
+            "owner": username  # Quan trọng: Đánh dấu tin nhắn của ai
+        }
+        self.writer.put(doc)
+
+    @timed_storage("insert_batch")
+    def _insert_batch(self, docs):
+        """Ghi một lô tin nhắn (chạy trên luồng nền của WriteBehindBuffer)"""
+        if not self.client:
+            # Mất kết nối lúc khởi động: thử kết nối lại, nếu vẫn lỗi thì lô này được lưu tạm ra file
+            self._connect()
+            if not self.client:
+                raise ConnectionError("Chưa kết nối được MongoDB")
+        for doc in docs:
+            # Lô đọc lại từ file spill có _id dạng chuỗi
+            if isinstance(doc.get("_id"), str):
+                doc["_id"] = ObjectId(doc["_id"])
+        try:
+            self.chat_col.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Bản ghi trùng _id nghĩa là đã được ghi ở lần thử trước, bỏ qua
+            errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+            if errors:
+                raise
+        # Cả bản ghi trùng: lần thử trước có thể đã ghi tin nhắn nhưng lỗi trước khi kịp cập nhật bản tóm tắt
+        self._update_conversation_summaries(docs)
+
+    def _update_conversation_summaries(self, docs):
+        """Cập nhật bản tóm tắt (upsert) cho các cuộc trò chuyện có trong lô vừa ghi.
+
+        message_count được đếm lại từ chat_history (dùng index owner + conversation_id) thay vì cộng dồn,
+        nên ghi lại một lô (kể cả lô đọc từ file spill) không làm lệch số tin nhắn."""
+        summaries = {}
+        for doc in docs:
+            key = (doc["owner"], doc["conversation_id"])
+            summary = summaries.setdefault(key, {
+                "title": (doc.get("user_message") or "")[:40],
+                "last_activity": doc["timestamp"]
+            })
+            summary["last_activity"] = max(summary["last_activity"], doc["timestamp"])
+
         try:
-            doc = {
-                "timestamp": datetime.now(),
-                "user_message": user_msg,
-                "assistant_response": assistant_resp,
-                "conversation_id": conv_id,
-                "owner": username  # Quan trọng: Đánh dấu tin nhắn của ai
-            }
-            self.chat_col.insert_one(doc)
+            ops = []
+            for (owner, conv_id), s in summaries.items():
+                count = self.chat_col.count_documents({"owner": owner, "conversation_id": conv_id})
+                ops.append(UpdateOne(
+                    {"owner": owner, "conversation_id": conv_id},
+                    {
+                        "$setOnInsert": {"title": s["title"]},
+                        # $max: hai tiến trình ghi song song không ghi đè số lớn hơn bằng số đếm cũ hơn
+                        "$max": {"last_activity": s["last_activity"], "message_count": count}
+                    },
+                    upsert=True
+                ))
+            self.conv_col.bulk_write(ops, ordered=False)
         except Exception as e:
-            print(f"Lỗi lưu: {e}")
+            # Bản tóm tắt là dữ liệu dẫn xuất, lỗi ở đây không làm mất tin nhắn đã ghi
+            print(f"Lỗi cập nhật bản tóm tắt cuộc trò chuyện: {e}")
+            STORAGE_ERRORS.inc(backend=self.metrics_backend, op="update_conversation_summaries")
+
+    def flush(self):
+        """Chờ các tin nhắn đang gom được ghi xong"""
+        self.writer.flush()
 
+    def close(self):
+        """Ghi nốt dữ liệu còn trong hàng đợi và đóng kết nối"""
+        self.writer.close()
+        if self.client:
+            self.client.close()
+
+    @timed_storage("get_conversation_list")
     def get_conversation_list(self, username):
-        """Lấy danh sách chat CỦA RIÊNG user đang đăng nhập"""
+        """Lấy danh sách chat CỦA RIÊNG user đang đăng nhập (đọc từ bản tóm tắt có index)"""
         if not self.client: return []
         try:
-            pipeline = [
-                {"$match": {"owner": username}}, # Chỉ lấy tin nhắn của user này
-                {"$sort": {"conversation_id": 1, "timestamp": 1}},
-                {"$group": {
-                    "_id": "$conversation_id",
-                    "last_message_time": {"$max": "$timestamp"}, 
-                    "first_user_message": {"$first": "$user_message"}
-                }},
-                {"$sort": {"last_message_time": -1}},
-                {"$project": {
-                    "_id": 0, "id": "$_id",
-                    "title": {"$substrCP": ["$first_user_message", 0, 40]}, 
-                    "last_activity": "$last_message_time"
-                }}
-            ]
-            return list(self.chat_col.aggregate(pipeline))
-        except Exception: return []
+            cursor = self.conv_col.find(
+                {"owner": username},
+                {"_id": 0, "conversation_id": 1, "title": 1, "last_activity": 1, "message_count": 1}
+            ).sort("last_activity", DESCENDING)
+            conversations = [{
+                "id": c["conversation_id"],
+                "title": c.get("title", ""),
+                "last_activity": c.get("last_activity"),
+                "message_count": c.get("message_count", 0)
+            } for c in cursor]
+            return merge_pending_conversations(conversations, self.writer.pending(owner=username))
+        except Exception:
+            # Lỗi bị nuốt ở đây nên timed_storage không thấy, tự đếm vào số liệu lỗi
+            STORAGE_ERRORS.inc(backend=self.metrics_backend, op="get_conversation_list")
+            return []
 
+    @timed_storage("get_messages_by_conversation_id")
     def get_messages_by_conversation_id(self, conv_id, username):
         """Lấy nội dung chat (bảo mật: phải đúng chủ sở hữu)"""
         if not self.client: return []
-        return list(self.chat_col.find({
+        pending = self.writer.pending(owner=username, conversation_id=conv_id)
+        docs = list(self.chat_col.find({
             "conversation_id": conv_id,
             "owner": username
         }).sort("timestamp", 1))
+        return merge_pending_messages(docs, pending, _doc_key)
+
+    @timed_storage("get_messages_page")
+    def get_messages_page(self, conv_id, username, before=None, limit=20):
+        """Lấy một trang tin nhắn cũ dần theo thời gian (phân trang bằng con trỏ).
+
+        before: con trỏ dạng "<timestamp ISO>|<_id>" của tin nhắn cũ nhất đã có, None = trang mới nhất.
+        Trả về (danh sách tin nhắn theo thứ tự thời gian tăng dần, con trỏ trang kế tiếp hoặc None)."""
+        if not self.client: return [], None
+        # Tin nhắn chưa ghi xong luôn mới hơn dữ liệu đã ghi nên chỉ được ghép vào trang mới nhất
+        pending = [] if before else self.writer.pending(owner=username, conversation_id=conv_id)
+
+        query = {"conversation_id": conv_id, "owner": username}
+        if before:
+            ts_text, _, oid_text = before.partition("|")
+            try:
+                ts = datetime.fromisoformat(ts_text)
+                oid = ObjectId(oid_text)
+            except Exception:
+                raise ValueError(f"Con trỏ trang không hợp lệ: {before}")
+            query["$or"] = [
+                {"timestamp": {"$lt": ts}},
+                {"timestamp": ts, "_id": {"$lt": oid}}
+            ]
+
+        # Lấy dư một bản ghi để biết còn trang cũ hơn hay không
+        docs = list(self.chat_col.find(query)
+                    .sort([("timestamp", DESCENDING), ("_id", DESCENDING)])
+                    .limit(limit + 1))
+        has_more = len(docs) > limit
+        docs = docs[:limit]
+        docs.reverse()
+
+        next_before = None
+        if has_more and docs:
+            oldest = docs[0]
+            next_before = f"{oldest['timestamp'].isoformat()}|{oldest['_id']}"
+        # Tin nhắn chưa ghi đã có _id nên luôn dựng được con trỏ trang kế tiếp
+        return merge_pending_page(docs, next_before, pending, limit, _doc_key)
+
+    @timed_storage("search_messages")
+    def search_messages(self, username, query, limit=20):
+        """Tìm tin nhắn của user theo nội dung (không phân biệt hoa thường)"""
+        if not self.client or not query.strip(): return []
+        pending = self.writer.pending(owner=username)
+        pattern = {"$regex": re.escape(query.strip()), "$options": "i"}
+        results = list(self.chat_col.find({
+            "owner": username,
+            "$or": [{"user_message": pattern}, {"assistant_response": pattern}]
+        }).sort("timestamp", DESCENDING).limit(limit))
+        return merge_pending_search(results, pending, query, limit, _doc_key)
 
+    @timed_storage("delete_all_conversations")
     def delete_all_conversations(self, username):
         """Xóa lịch sử của riêng user"""
         if self.client:
-            self.chat_col.delete_many({"owner": username})
\ No newline at end of file
+            # Ghi hết phần đang chờ trước khi xóa, nếu không chúng sẽ được ghi lại sau khi đã xóa
+            self.flush()
+            self.chat_col.delete_many({"owner": username})
+            self.conv_col.delete_many({"owner": username})
\ No newline at end of file
@@ -0,0 +1,247 @@
+ # Ràng buộc đầu ra của model bằng grammar của llama.cpp: viết trực tiếp dạng GBNF hoặc sinh từ JSON schema
+ # Grammar đã biên dịch được giữ trong LRU theo hash nội dung, request lặp lại cùng schema không phải biên dịch lại
+import json
+import time
+import weakref
+import hashlib
+import threading
+from collections import OrderedDict
+
+import config
+
+# Bố cục struct llama_token_data (id, logit, p) để truyền mảng NumPy thẳng cho sampler của llama.cpp
+TOKEN_DATA = [("id", "<i4"), ("logit", "<f4"), ("p", "<f4")]
+
+
+def grammar_key(grammar=None, json_schema=None):
+    # Hash của nội dung ràng buộc (JSON schema được sắp xếp khóa trước khi băm), None nếu không có ràng buộc
+    if json_schema is not None:
+        if isinstance(json_schema, str):
+            json_schema = json.loads(json_schema)
+        raw = "schema:" + json.dumps(json_schema, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    elif grammar:
+        raw = "gbnf:" + grammar
+    else:
+        return None
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def init_grammar_sampler(llama, gbnf, root="root"):
+    # Sampler grammar mức thấp của llama.cpp, grammar được phân tích tại đây (ném ValueError nếu sai cú pháp)
+    # Trả về None nếu bản llama-cpp-python đang cài chưa có API sampler
+    import llama_cpp as lib
+
+    if not hasattr(lib, "llama_sampler_init_grammar") or not hasattr(lib, "llama_sampler_clone"):
+        return None
+    # Từ bản có llama_vocab, hàm nhận vocab thay vì model
+    target = lib.llama_model_get_vocab(llama.model) if hasattr(lib, "llama_model_get_vocab") else llama.model
+    sampler = lib.llama_sampler_init_grammar(target, gbnf.encode("utf-8"), root.encode("utf-8"))
+    if not sampler:
+        raise ValueError("llama.cpp không phân tích được grammar")
+    return sampler
+
+
+def apply_grammar(sampler, data):
+    # llama.cpp đặt logit của các token grammar không cho phép thành -inf, giữ nguyên thứ tự mảng
+    import ctypes
+    import llama_cpp as lib
+
+    candidates = lib.llama_token_data_array(
+        data=data.ctypes.data_as(lib.llama_token_data_p), size=len(data), selected=-1, sorted=False
+    )
+    lib.llama_sampler_apply(sampler, ctypes.byref(candidates))
+
+
+def grammar_allows(sampler, token, logits):
+    # Thử riêng một token (rẻ hơn nhiều so với lọc cả bộ từ vựng)
+    import numpy as np
+
+    single = np.array([(token, logits[token], 0.0)], dtype=TOKEN_DATA)
+    apply_grammar(sampler, single)
+    return bool(np.isfinite(single["logit"][0]))
+
+
+def grammar_mask(sampler, logits, buffer):
+    # Lọc cả bộ từ vựng, trả về logits (view trên buffer) với token không hợp lệ là -inf
+    # buffer: mảng TOKEN_DATA dài n_vocab, dùng lại giữa các bước để không cấp phát mỗi token
+    import numpy as np
+
+    buffer["id"] = np.arange(len(buffer))
+    buffer["logit"] = logits
+    apply_grammar(sampler, buffer)
+    return buffer["logit"]
+
+
+def _free_sampler(sampler):
+    import llama_cpp
+    llama_cpp.llama_sampler_free(sampler)
+
+
+class GrammarSamplerCache:
+    # Sampler grammar đã khởi tạo của một model, mỗi grammar giữ một bản gốc chưa nhận token nào
+    # Mỗi request/chuỗi nhận bản llama_sampler_clone riêng nên grammar chỉ được phân tích lần đầu
+    # Các bản gốc gắn với bộ từ vựng của model, phải close() trước khi giải phóng model
+
+    def __init__(self, llama, max_entries=32):
+        self.llama = llama
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # grammar_key -> sampler gốc
+        self._lock = threading.Lock()
+
+    def acquire(self, compiled):
+        # Trả về bản clone (người gọi tự giải phóng bằng release) hoặc None nếu không có API sampler
+        # Ném ValueError nếu llama.cpp không phân tích được grammar
+        import llama_cpp as lib
+
+        with self._lock:
+            base = self._entries.get(compiled.key)
+            if base is not None:
+                self._entries.move_to_end(compiled.key)
+                return lib.llama_sampler_clone(base)
+
+        # Phân tích ngoài lock; hai request cùng grammar lần đầu có thể cùng khởi tạo, bản thừa được giải phóng
+        base = init_grammar_sampler(self.llama, compiled.gbnf)
+        if base is None:
+            return None
+        with self._lock:
+            existing = self._entries.get(compiled.key)
+            if existing is not None:
+                _free_sampler(base)
+                base = existing
+            else:
+                self._entries[compiled.key] = base
+                while len(self._entries) > self.max_entries:
+                    _free_sampler(self._entries.popitem(last=False)[1])
+            self._entries.move_to_end(compiled.key)
+            return lib.llama_sampler_clone(base)
+
+    def release(self, sampler):
+        _free_sampler(sampler)
+
+    def close(self):
+        with self._lock:
+            for base in self._entries.values():
+                _free_sampler(base)
+            self._entries.clear()
+
+
+class GrammarLogitsProcessor:
+    # logits_processor cho Llama.__call__: áp sampler grammar (bản clone riêng của request) lên logits mỗi bước
+    # Token đã sinh được đưa cho sampler ở lần gọi kế tiếp (input_ids lúc đó đã gồm token vừa đánh giá)
+
+    def __init__(self, sampler, n_vocab):
+        import numpy as np
+
+        self.sampler = sampler
+        self.n_seen = None  # Số token trong input_ids mà sampler đã biết (lần gọi đầu: độ dài prompt)
+        self.buffer = np.zeros(n_vocab, dtype=TOKEN_DATA)
+        # Bản clone được giải phóng khi close() hoặc khi processor bị thu gom (luồng sinh chưa bao giờ chạy)
+        self._finalizer = weakref.finalize(self, _free_sampler, sampler)
+
+    def __call__(self, input_ids, scores):
+        import llama_cpp
+
+        if self.n_seen is None:
+            self.n_seen = len(input_ids)
+        for token in input_ids[self.n_seen:]:
+            llama_cpp.llama_sampler_accept(self.sampler, int(token))
+        self.n_seen = len(input_ids)
+        scores[:] = grammar_mask(self.sampler, scores, self.buffer)
+        return scores
+
+    def close(self):
+        self._finalizer()
+
+
+class CompiledGrammar:
+    # gbnf: grammar dạng văn bản (JSON schema đã được chuyển sang GBNF)
+    # llama_grammar: đối tượng LlamaGrammar truyền vào Llama.__call__(grammar=...) khi không có API sampler mức thấp
+
+    def __init__(self, key, gbnf, llama_grammar):
+        self.key = key
+        self.gbnf = gbnf
+        self.llama_grammar = llama_grammar
+
+
+def compile_grammar(grammar=None, json_schema=None):
+    # Chỉ chuyển sang GBNF; llama.cpp phân tích grammar khi GrammarSamplerCache khởi tạo sampler gốc
+    from llama_cpp import LlamaGrammar
+    from llama_cpp.llama_grammar import json_schema_to_gbnf
+
+    key = grammar_key(grammar, json_schema)
+    if json_schema is not None:
+        schema_text = json_schema if isinstance(json_schema, str) else json.dumps(json_schema)
+        gbnf = json_schema_to_gbnf(schema_text)
+    else:
+        gbnf = grammar
+    llama_grammar = LlamaGrammar.from_string(gbnf, verbose=False)
+    return CompiledGrammar(key, gbnf, llama_grammar)
+
+
+class GrammarCache:
+    # LRU các grammar đã biên dịch, khóa là grammar_key(); dùng chung cho mọi model trong tiến trình
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.compile_seconds = 0.0
+
+    def get(self, grammar=None, json_schema=None):
+        # Trả về CompiledGrammar (None nếu không có ràng buộc), ném ValueError nếu grammar/schema không hợp lệ
+        try:
+            key = grammar_key(grammar, json_schema)
+        except ValueError as e:
+            raise ValueError(f"JSON schema không hợp lệ: {e}")
+        if key is None:
+            return None
+
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+
+        # Biên dịch ngoài lock: hai request cùng schema lần đầu có thể cùng biên dịch, kết quả như nhau
+        start = time.perf_counter()
+        try:
+            compiled = compile_grammar(grammar, json_schema)
+        except ImportError:
+            raise
+        except Exception as e:
+            raise ValueError(f"Grammar không hợp lệ: {e}")
+
+        with self._lock:
+            self.misses += 1
+            self.compile_seconds += time.perf_counter() - start
+            self._entries[key] = compiled
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return compiled
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "compile_seconds": round(self.compile_seconds, 4),
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_grammar_cache():
+    # Cache dùng chung trong tiến trình, kích thước theo GRAMMAR_CACHE_SIZE
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = GrammarCache(config.get_config().get("grammar_cache_size", 32))
+        return _cache
@@ -0,0 +1,406 @@
+ # Bộ nhớ đệm trạng thái llama.cpp (KV cache) theo từng cuộc trò chuyện
+ # Lượt chat sau chỉ cần đánh giá phần prompt mới thay vì toàn bộ lịch sử
+ # Hai tầng: LRU trong RAM, và (nếu bật) file trạng thái trên đĩa để mở lại cuộc trò chuyện cũ
+ # (sau khi bị loại khỏi RAM hoặc sau khi khởi động lại) mà không phải đánh giá lại cả lịch sử
+import os
+import json
+import mmap
+import time
+import atexit
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def common_prefix_length(a, b):
+    # Số token đầu tiên giống nhau giữa hai dãy token
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def reusable_prefix(tokens, prompt_tokens):
+    # Số token của snapshot dùng lại được cho prompt mới, 0 nếu snapshot đã cũ
+    # Mọi prompt đều mở đầu giống nhau (định dạng template, system...) nên prefix hầu như không bao giờ bằng 0;
+    # snapshot chỉ còn giá trị khi prompt mới phủ ít nhất một nửa số token của nó (lượt tiếp theo của chính
+    # cuộc trò chuyện đó), lịch sử bị tải lại hoặc cắt bớt từ đầu thì coi là trượt
+    prefix = common_prefix_length(tokens, prompt_tokens)
+    return prefix if prefix * 2 >= len(tokens) else 0
+
+
+def compact_state(state):
+    # LlamaState lưu logits của mọi vị trí đã đánh giá (n_tokens x n_vocab số float),
+    # nhưng khi sinh tiếp llama.cpp chỉ dùng logits của token cuối nên chỉ giữ lại một dòng
+    if state.scores is not None and len(state.scores) > 1:
+        state.scores = state.scores[-1:, :].copy()
+    return state
+
+
+def state_nbytes(state):
+    # Dung lượng RAM ước tính của một snapshot
+    size = state.llama_state_size
+    if state.scores is not None:
+        size += state.scores.nbytes
+    if state.input_ids is not None:
+        size += state.input_ids.nbytes
+    return size
+
+
+class ConversationStateCache:
+    # LRU theo conversation_id, giới hạn tổng dung lượng RAM (byte)
+    # Mỗi entry giữ dãy token mà snapshot đã đánh giá, dùng để kiểm tra prefix trước khi nạp lại
+    # disk: DiskStateCache (hoặc None), được tra khi trong RAM không có và nhận bản sao mọi snapshot
+
+    def __init__(self, max_bytes, disk=None):
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self._entries = OrderedDict()  # conv_id -> (tokens, state, size)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, conv_id, prompt_tokens):
+        # Trả về (state, số token prefix dùng lại được) hoặc None
+        with self._lock:
+            entry = self._entries.get(conv_id)
+            if entry is not None:
+                tokens, state, _ = entry
+                prefix = reusable_prefix(tokens, prompt_tokens)
+                if prefix == 0:
+                    # Lịch sử đã bị thay (tải lại / cắt bớt từ đầu): snapshot không còn dùng được
+                    self._remove(conv_id)
+                    self.misses += 1
+                    return None
+                self._entries.move_to_end(conv_id)
+                self.hits += 1
+                return state, prefix
+            self.misses += 1
+
+        # Không có trong RAM: đọc đĩa ngoài lock để các cuộc trò chuyện khác không phải chờ
+        return self.disk.lookup(conv_id, prompt_tokens) if self.disk is not None else None
+
+    def store(self, conv_id, state):
+        state = compact_state(state)
+        size = state_nbytes(state)
+        if self.disk is not None:
+            self.disk.store(conv_id, state)
+        with self._lock:
+            self._remove(conv_id)
+            if size > self.max_bytes:
+                return
+            tokens = state.input_ids[:state.n_tokens].tolist()
+            self._entries[conv_id] = (tokens, state, size)
+            self._total_bytes += size
+
+            # Loại bỏ các cuộc trò chuyện lâu không dùng cho tới khi vừa ngân sách RAM
+            while self._total_bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, conv_id):
+        with self._lock:
+            self._remove(conv_id)
+        if self.disk is not None:
+            self.disk.invalidate(conv_id)
+
+    def close(self):
+        # Ghi nốt các snapshot đang chờ xuống đĩa
+        if self.disk is not None:
+            self.disk.close()
+
+    def _remove(self, conv_id):
+        entry = self._entries.pop(conv_id, None)
+        if entry is not None:
+            self._total_bytes -= entry[2]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "used_mb": round(self._total_bytes / (1024 * 1024), 2),
+                "max_mb": round(self.max_bytes / (1024 * 1024), 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk": self.disk.stats() if self.disk is not None else None,
+            }
+
+
+# Bố cục file trạng thái: magic, độ dài header, header JSON, rồi các mảng (căn 64 byte) nối tiếp nhau:
+# input_ids (n_tokens token đã đánh giá), scores (logits đã thu gọn), dữ liệu trạng thái llama.cpp
+_MAGIC = b"LKVS"
+_PREFIX = struct.Struct("<4sI")
+_ALIGN = 64
+_SUFFIX = ".kvstate"
+
+
+def _aligned(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def model_identity(model_path, n_ctx):
+    # Snapshot chỉ nạp lại được vào đúng model và đúng kích thước context đã tạo ra nó
+    try:
+        st = os.stat(model_path)
+        return f"{os.path.basename(model_path)}:{st.st_size}:{int(st.st_mtime)}:{n_ctx}"
+    except (OSError, TypeError):
+        return f"{model_path}:{n_ctx}"
+
+
+class DiskStateCache:
+    # Mỗi cuộc trò chuyện một file trong directory, tổng dung lượng giới hạn max_bytes (LRU theo mtime,
+    # dùng chung được giữa nhiều tiến trình worker vì file luôn được ghi ra file tạm rồi mới đổi tên)
+    # Ghi trên luồng nền (mỗi cuộc trò chuyện chỉ giữ snapshot mới nhất đang chờ), lượt chat không chờ đĩa
+    # Đọc bằng mmap: dữ liệu trạng thái được chép thẳng từ page cache vào llama.cpp, không qua bản sao bytes
+    # Cuộc trò chuyện ngắn hơn min_tokens không được ghi (đánh giá lại còn nhanh hơn đọc file)
+
+    def __init__(self, directory, max_bytes, model_key, min_tokens=256):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.model_key = model_key
+        self.min_tokens = min_tokens
+        os.makedirs(directory, exist_ok=True)
+
+        self._pending = OrderedDict()  # conv_id -> snapshot chờ ghi
+        self._cond = threading.Condition()
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.write_seconds = 0.0
+
+        self._remove_stale_tmp()
+        self._thread = threading.Thread(target=self._run, name="kv-disk-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _path(self, conv_id):
+        digest = hashlib.sha256(f"{self.model_key}\0{conv_id}".encode("utf-8")).hexdigest()[:40]
+        return os.path.join(self.directory, digest + _SUFFIX)
+
+    def lookup(self, conv_id, prompt_tokens):
+        # Trả về (state, số token prefix dùng lại được) hoặc None
+        with self._cond:
+            state = self._pending.get(conv_id)
+        if state is not None:
+            # Snapshot chưa kịp ghi xuống đĩa
+            prefix = reusable_prefix(state.input_ids[:state.n_tokens].tolist(), prompt_tokens)
+            if prefix:
+                self.hits += 1
+                return state, prefix
+            self.misses += 1
+            return None
+
+        path = self._path(conv_id)
+        try:
+            state = self._read(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except ImportError:
+            raise
+        except Exception as e:
+            # File hỏng, bị cắt cụt, header thiếu khóa...: xóa đi để các lượt sau không gặp lại
+            print(f"Bỏ file trạng thái KV không đọc được {path}: {e}")
+            self._unlink(path)
+            self.misses += 1
+            return None
+
+        prefix = reusable_prefix(state.input_ids[:state.n_tokens].tolist(), prompt_tokens)
+        if prefix == 0:
+            self._unlink(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)  # Đánh dấu vừa dùng cho việc dọn LRU
+        except OSError:
+            pass
+        self.hits += 1
+        return state, prefix
+
+    def _read(self, path):
+        import numpy as np
+        from llama_cpp import LlamaState
+
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_len = _PREFIX.unpack_from(mm, 0)
+        if magic != _MAGIC:
+            raise ValueError("sai định dạng")
+        header = json.loads(mm[_PREFIX.size:_PREFIX.size + header_len])
+        if header["model"] != self.model_key:
+            raise ValueError("snapshot của model khác")
+        if hasattr(mm, "madvise") and hasattr(mmap, "MADV_WILLNEED"):
+            mm.madvise(mmap.MADV_WILLNEED)
+
+        n_tokens = header["n_tokens"]
+        ids_offset = _aligned(_PREFIX.size + header_len)
+        ids_dtype = np.dtype(header["ids_dtype"])
+        input_ids = np.zeros(header["ids_len"], dtype=ids_dtype)
+        input_ids[:n_tokens] = np.frombuffer(mm, dtype=ids_dtype, count=n_tokens, offset=ids_offset)
+
+        scores_offset = _aligned(ids_offset + n_tokens * ids_dtype.itemsize)
+        rows, n_vocab = header["scores_shape"]
+        scores = np.frombuffer(mm, dtype=np.dtype(header["scores_dtype"]), count=rows * n_vocab,
+                               offset=scores_offset).reshape(rows, n_vocab)
+
+        state_offset = _aligned(scores_offset + scores.nbytes)
+        state_size = header["state_size"]
+        if state_offset + state_size > len(mm):
+            raise ValueError("file bị cắt cụt")
+        # memoryview giữ mmap sống tới khi snapshot được nạp xong và bị bỏ đi
+        return LlamaState(
+            input_ids=input_ids,
+            scores=scores,
+            n_tokens=n_tokens,
+            llama_state=memoryview(mm)[state_offset:state_offset + state_size],
+            llama_state_size=state_size,
+            seed=header.get("seed", 0),
+        )
+
+    def store(self, conv_id, state):
+        if state.n_tokens < self.min_tokens:
+            return
+        with self._cond:
+            if self._closed:
+                return
+            self._pending[conv_id] = state
+            self._pending.move_to_end(conv_id)
+            self._cond.notify()
+
+    def invalidate(self, conv_id):
+        with self._cond:
+            self._pending.pop(conv_id, None)
+        self._unlink(self._path(conv_id))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                conv_id, state = self._pending.popitem(last=False)
+            start = time.perf_counter()
+            try:
+                self._write(self._path(conv_id), state)
+                self._enforce_limit()
+            except OSError as e:
+                print(f"Lỗi ghi trạng thái KV của cuộc trò chuyện {conv_id}: {e}")
+            self.write_seconds += time.perf_counter() - start
+
+    def _write(self, path, state):
+        import numpy as np
+
+        n_tokens = state.n_tokens
+        input_ids = state.input_ids[:n_tokens]
+        scores = state.scores
+        header = json.dumps({
+            "model": self.model_key,
+            "n_tokens": n_tokens,
+            "ids_len": len(state.input_ids),
+            "ids_dtype": input_ids.dtype.str,
+            "scores_dtype": scores.dtype.str,
+            "scores_shape": list(scores.shape),
+            "state_size": state.llama_state_size,
+            "seed": getattr(state, "seed", 0),
+        }).encode("utf-8")
+
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(_PREFIX.pack(_MAGIC, len(header)))
+            f.write(header)
+            for chunk in (np.ascontiguousarray(input_ids), np.ascontiguousarray(scores),
+                          memoryview(state.llama_state)[:state.llama_state_size]):
+                f.write(b"\0" * (_aligned(f.tell()) - f.tell()))
+                f.write(chunk)
+        os.replace(tmp, path)
+        self.writes += 1
+
+    def _files(self):
+        # [(mtime, size, path)] của các file trạng thái (mọi model) trong thư mục
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_SUFFIX):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+        return files
+
+    def _enforce_limit(self):
+        # Xóa các file lâu không dùng nhất cho tới khi tổng dung lượng vừa giới hạn
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            if self._unlink(path):
+                self.evictions += 1
+            total -= size
+
+    def _remove_stale_tmp(self):
+        # File tạm của lần ghi bị ngắt giữa chừng (tiến trình bị tắt), bỏ qua file tạm còn mới của tiến trình khác
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                try:
+                    if now - entry.stat().st_mtime > 600:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def prefetch(self, conv_id):
+        # Gợi ý hệ điều hành đọc trước file trạng thái vào page cache (khi người dùng vừa mở lại cuộc trò chuyện)
+        path = self._path(conv_id)
+        if not hasattr(os, "posix_fadvise") or not os.path.exists(path):
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+    def close(self, timeout=30.0):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def stats(self):
+        files = self._files()
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "entries": len(files),
+            "used_mb": round(sum(size for _, size, _ in files) / (1024 * 1024), 2),
+            "max_mb": round(self.max_bytes / (1024 * 1024), 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "pending": pending,
+            "write_seconds": round(self.write_seconds, 3),
+        }
@@ -0,0 +1,344 @@
+ # Ghi log JSON dòng (hội thoại, trace) trên luồng nền
+ # Luồng gọi chỉ đưa bản ghi vào hàng đợi; luồng nền giữ file mở, gom các bản ghi thành một lần ghi,
+ # fsync định kỳ, đổi file theo ngày/dung lượng và nén các file đã đóng (gzip hoặc zstd)
+ # File còn sót từ lần chạy trước được dọn một lần lúc khởi động bởi tiến trình chính (compress_leftover_logs),
+ # không phải bởi từng sink: các worker gunicorn khởi động cùng lúc sẽ tranh nhau cùng một file
+import os
+import re
+import json
+import gzip
+import time
+import queue
+import atexit
+import shutil
+import threading
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import config
+
+
+_STOP = object()
+
+
+class _FlushMarker:
+    # Yêu cầu luồng nền ghi và fsync ngay phần đang có rồi báo lại
+    def __init__(self):
+        self.done = threading.Event()
+
+
+def _dumps(entry):
+    # orjson nhanh hơn json nhiều lần và trả về bytes sẵn; kiểu lạ (ObjectId...) ghi dạng chuỗi
+    if orjson is not None:
+        return orjson.dumps(entry, default=str, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(entry, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+def _zstd_available(method):
+    if method != "zstd":
+        return method
+    try:
+        import zstandard  # noqa: F401
+        return method
+    except ImportError:
+        print("Chưa cài zstandard, nén log bằng gzip")
+        return "gzip"
+
+
+def _compress_file(path, method):
+    # Nén file đã đóng ra file tạm rồi mới đổi tên, để không bao giờ để lại file nén dở
+    target = path + (".zst" if method == "zstd" else ".gz")
+    tmp = f"{target}.{os.getpid()}.tmp"
+    with open(path, "rb") as src:
+        if method == "zstd":
+            import zstandard
+            with open(tmp, "wb") as dst:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+        else:
+            with gzip.open(tmp, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+    os.replace(tmp, target)
+    os.remove(path)
+
+
+def _next_segment(log_dir, prefix, date):
+    # Số thứ tự kế tiếp của file đã đóng trong ngày (tính cả file đã nén)
+    pattern = re.compile(rf"{re.escape(prefix)}_{date}\.(\d+)\.jsonl")
+    numbers = [int(m.group(1)) for m in map(pattern.match, os.listdir(log_dir)) if m]
+    return os.path.join(log_dir, f"{prefix}_{date}.{max(numbers, default=0) + 1}.jsonl")
+
+
+class JsonlLogSink:
+    # File đang ghi: <log_dir>/<prefix>_<ngày>.jsonl (cùng tên như trước đây)
+    # File đã đóng (sang ngày mới hoặc vượt max_bytes): <prefix>_<ngày>.<số thứ tự>.jsonl[.gz|.zst]
+
+    def __init__(self, log_dir="logs", prefix="chat", max_bytes=64 * 1024 * 1024, compression="gzip",
+                 flush_interval=1.0, fsync_interval=5.0, max_pending=10000):
+        self.log_dir = log_dir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.compression = _zstd_available(compression or None)
+
+        # Hàng đợi có giới hạn: khi đầy thì bỏ bản ghi thay vì làm chậm request
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._file = None
+        self._date = None
+        self._size = 0
+        self._dirty = False
+        self._closed = False
+        self._compressors = []
+
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+
+        self._thread = threading.Thread(target=self._run, name=f"log-{prefix}", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, entry):
+        # Đưa một bản ghi (dict) vào hàng đợi, không chờ ghi đĩa
+        if self._closed:
+            return
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=5.0):
+        # Chờ các bản ghi đang chờ được ghi và fsync xong
+        # Trả về False nếu hết timeout (kể cả khi hàng đợi đầy, không chèn được yêu cầu flush)
+        if self._closed or not self._thread.is_alive():
+            return False
+        deadline = time.monotonic() + timeout
+        marker = _FlushMarker()
+        try:
+            self._queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.done.wait(max(0.0, deadline - time.monotonic()))
+
+    def close(self, timeout=10.0):
+        # Ghi nốt hàng đợi, đóng file và chờ các file đang nén
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        for worker in self._compressors:
+            worker.join(timeout)
+
+    def _run(self):
+        last_fsync = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+
+            # Lấy hết những gì đang có trong hàng đợi để ghi một lần
+            batch, markers, stop = [], [], False
+            while item is not None:
+                if item is _STOP:
+                    stop = True
+                elif isinstance(item, _FlushMarker):
+                    markers.append(item)
+                else:
+                    batch.append(item)
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = None
+
+            # Lỗi bất ngờ của một lô chỉ làm mất lô đó, luồng ghi vẫn phải sống cho các bản ghi sau
+            try:
+                if batch:
+                    self._write(batch)
+                if self._dirty and (markers or stop or time.monotonic() - last_fsync >= self.fsync_interval):
+                    self._fsync()
+                    last_fsync = time.monotonic()
+            except Exception as e:
+                print(f"Lỗi luồng ghi log {self.prefix}: {e}")
+                self.dropped += len(batch)
+            for marker in markers:
+                marker.done.set()
+            if stop:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                return
+
+    def _write(self, batch):
+        chunks = []
+        for entry in batch:
+            try:
+                chunks.append(_dumps(entry))
+            except (TypeError, ValueError) as e:
+                print(f"Bỏ bản ghi log {self.prefix} không chuyển được sang JSON: {e}")
+                self.dropped += 1
+        if not chunks:
+            return
+        try:
+            self._open_for_today()
+            data = b"".join(chunks)
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            self._dirty = True
+            self.written += len(chunks)
+            if self._size >= self.max_bytes:
+                self._rotate()
+        except OSError as e:
+            print(f"Lỗi ghi log {self.prefix}, bỏ {len(chunks)} bản ghi: {e}")
+            self.dropped += len(chunks)
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _fsync(self):
+        try:
+            os.fsync(self._file.fileno())
+        except (OSError, AttributeError):
+            pass
+        self._dirty = False
+
+    def _active_path(self, date):
+        return os.path.join(self.log_dir, f"{self.prefix}_{date}.jsonl")
+
+    def _open_for_today(self):
+        today = datetime.now().strftime("%Y-%m-%d")
+        if self._file is not None and today != self._date:
+            self._rotate()
+        if self._file is not None and not self._still_active():
+            # Tiến trình khác (worker gunicorn khác) đã đổi tên file: mở lại file mới thay vì ghi vào file cũ
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            self._date = today
+            self._file = open(self._active_path(today), "ab")
+            self._size = self._file.tell()
+
+    def _still_active(self):
+        try:
+            return os.stat(self._active_path(self._date)).st_ino == os.fstat(self._file.fileno()).st_ino
+        except OSError:
+            return False
+
+    def _next_segment(self, date):
+        return _next_segment(self.log_dir, self.prefix, date)
+
+    def _rotate(self):
+        # Đóng file hiện tại, đổi sang tên có số thứ tự rồi nén trên luồng riêng để không chặn việc ghi
+        if self._dirty:
+            self._fsync()
+        active = self._still_active()
+        self._file.close()
+        self._file = None
+        if not active:
+            return
+        segment = self._next_segment(self._date)
+        try:
+            os.replace(self._active_path(self._date), segment)
+        except OSError as e:
+            # Ví dụ trên Windows khi tiến trình khác còn mở file: ghi tiếp vào file cũ, lần sau thử lại
+            print(f"Không đổi tên được file log {self.prefix}: {e}")
+            return
+        self.rotations += 1
+        self._compress_async(segment)
+
+    def _compress_async(self, path):
+        if not self.compression:
+            return
+
+        def run():
+            try:
+                _compress_file(path, self.compression)
+            except OSError as e:
+                print(f"Lỗi nén log {path}: {e}")
+
+        self._compressors = [w for w in self._compressors if w.is_alive()]
+        worker = threading.Thread(target=run, name=f"log-{self.prefix}-compress", daemon=True)
+        worker.start()
+        self._compressors.append(worker)
+
+    def stats(self):
+        return {
+            "pending": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "rotations": self.rotations,
+            "current_bytes": self._size,
+        }
+
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def get_log_sink(log_dir="logs", prefix="chat"):
+    # Mỗi (thư mục, loại log) dùng chung một sink trong tiến trình, tạo khi cần với tham số LOG_* trong config.py
+    key = (os.path.abspath(log_dir), prefix)
+    with _sinks_lock:
+        sink = _sinks.get(key)
+        if sink is None:
+            conf = config.get_config()
+            sink = _sinks[key] = JsonlLogSink(
+                log_dir,
+                prefix,
+                max_bytes=conf.get("log_max_mb", 64) * 1024 * 1024,
+                compression=conf.get("log_compression", "gzip"),
+                flush_interval=conf.get("log_flush_interval", 1.0),
+                fsync_interval=conf.get("log_fsync_interval", 5.0),
+            )
+        return sink
+
+
+def compress_leftover_logs(log_dir="logs", prefixes=("chat", "trace"), wait=False):
+    # Đổi tên và nén file của các ngày trước (tắt giữa chừng, hoặc từ phiên bản cũ) và file đã đóng mà chưa kịp nén
+    # Chỉ gọi ở tiến trình chính lúc khởi động, trước khi có sink nào ghi (serve.py trước khi tạo worker,
+    # app.py, web_app.py chạy trực tiếp); nén chạy trên luồng nền, wait=True để chờ xong
+    method = _zstd_available(config.get_config().get("log_compression", "gzip") or None)
+    if not method or not os.path.isdir(log_dir):
+        return None
+
+    def run():
+        today = datetime.now().strftime("%Y-%m-%d")
+        for prefix in prefixes:
+            active = re.compile(rf"{re.escape(prefix)}_(\d{{4}}-\d{{2}}-\d{{2}})\.jsonl$")
+            closed = re.compile(rf"{re.escape(prefix)}_\d{{4}}-\d{{2}}-\d{{2}}\.\d+\.jsonl$")
+            for name in sorted(os.listdir(log_dir)):
+                path = os.path.join(log_dir, name)
+                match = active.match(name)
+                # Tiến trình khác có thể đã xử lý file này trước (ví dụ hai lần khởi động chồng nhau): bỏ qua
+                try:
+                    if match and match.group(1) != today:
+                        segment = _next_segment(log_dir, prefix, match.group(1))
+                        os.replace(path, segment)
+                        _compress_file(segment, method)
+                    elif closed.match(name):
+                        _compress_file(path, method)
+                except OSError as e:
+                    print(f"Bỏ qua file log cũ {path}: {e}")
+                    continue
+
+    worker = threading.Thread(target=run, name="log-leftovers", daemon=True)
+    worker.start()
+    if wait:
+        worker.join()
+    return worker
+
+
+def close_log_sinks():
+    # Ghi nốt và đóng mọi sink (khi tắt server)
+    with _sinks_lock:
+        sinks = list(_sinks.values())
+        _sinks.clear()
+    for sink in sinks:
+        sink.close()
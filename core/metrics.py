@@ -0,0 +1,276 @@
+ # Số liệu vận hành dạng Prometheus (GET /metrics) và trace thời gian từng bước của một request
+ # Tự cài đặt counter/gauge/histogram tối giản, không cần prometheus_client: mỗi lần ghi chỉ là
+ # vài phép cộng dưới một lock nên có thể bật thường trực trong môi trường thật
+ # Khi chạy nhiều worker (gunicorn) mỗi tiến trình có số liệu riêng
+import os
+import time
+import threading
+import functools
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Mốc của histogram thời gian (giây) và số token
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    # Một họ số liệu, mỗi bộ giá trị nhãn là một chuỗi số liệu riêng
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # tuple giá trị nhãn -> giá trị
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        # [(hậu tố tên, giá trị nhãn, nhãn thêm, giá trị)]
+        with self._lock:
+            return [("", key, None, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    # Chỉ tăng đếm của một bucket khi ghi, cộng dồn (định dạng le của Prometheus) lúc render
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        result = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                result.append(("_bucket", key, [("le", _format_value(bound))], cumulative))
+            result.append(("_sum", key, None, total))
+            result.append(("_count", key, None, cumulative))
+        return result
+
+
+class CallbackGauge(_Metric):
+    # Giá trị được đọc lúc render (số user đang giữ, độ dài hàng đợi, RAM...)
+    # fn() trả về một số, None (bỏ qua) hoặc dict {tuple giá trị nhãn: số}
+    type = "gauge"
+
+    def __init__(self, name, help, fn, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        if isinstance(value, dict):
+            return [("", key, None, v) for key, v in value.items()]
+        return [("", (), None, value)]
+
+
+class MetricsRegistry:
+    # Danh sách các họ số liệu, đăng ký trùng tên thì thay thế họ cũ
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, fn, labelnames=()):
+        return self.register(CallbackGauge(name, help, fn, labelnames))
+
+    def render(self):
+        # Định dạng text exposition 0.0.4 của Prometheus
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+QUEUE_WAIT = REGISTRY.histogram("chat_queue_wait_seconds", "Thời gian request nằm trong hàng đợi của scheduler")
+JOBS = REGISTRY.counter("llm_jobs_total", "Số job suy luận đã kết thúc theo trạng thái", ["status"])
+PROMPT_TOKENS = REGISTRY.histogram("llm_prompt_tokens", "Số token prompt mỗi request", ["model"], TOKEN_BUCKETS)
+COMPLETION_TOKENS = REGISTRY.histogram("llm_completion_tokens", "Số token sinh ra mỗi request", ["model"],
+                                       TOKEN_BUCKETS)
+PROMPT_EVAL_SECONDS = REGISTRY.histogram("llm_prompt_eval_seconds",
+                                         "Thời gian đánh giá prompt (tới token đầu tiên)", ["model"])
+DECODE_SECONDS = REGISTRY.histogram("llm_decode_seconds", "Thời gian sinh các token sau token đầu tiên", ["model"])
+SPAN_SECONDS = REGISTRY.histogram("chat_span_seconds", "Thời gian từng bước của một lượt chat", ["span"])
+CHAT_TURNS = REGISTRY.counter("chat_turns_total", "Số lượt chat theo kết quả", ["outcome"])
+STORAGE_SECONDS = REGISTRY.histogram("storage_operation_seconds", "Thời gian thao tác database",
+                                     ["backend", "op"])
+STORAGE_ERRORS = REGISTRY.counter("storage_operation_errors_total", "Số thao tác database bị lỗi",
+                                  ["backend", "op"])
+
+
+def _rss_bytes():
+    # RAM thực tế tiến trình đang dùng; psutil nếu có, không thì đọc /proc (Linux)
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+REGISTRY.callback("process_resident_memory_bytes", "RAM thực tế của tiến trình", _rss_bytes)
+
+
+class RequestTrace:
+    # Thời gian từng bước (span, giây) của một request và vài giá trị kèm theo (số token, model)
+    # Các bước của một lượt chat: build_prompt, queue_wait, tokenize, eval (đánh giá prompt),
+    # sample (sinh token), persist (lưu lịch sử)
+
+    def __init__(self):
+        self.spans = {}
+        self.values = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        # Bước lặp lại nhiều lần thì cộng dồn
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def update(self, data):
+        # Gộp trace nhận từ nơi khác (tiến trình worker) ở dạng to_dict()
+        for name, seconds in data.get("spans", {}).items():
+            self.add(name, seconds)
+        self.values.update(data.get("values", {}))
+
+    def to_dict(self):
+        return {
+            "spans": {name: round(seconds, 4) for name, seconds in self.spans.items()},
+            "values": dict(self.values),
+        }
+
+
+def observe_generation(trace):
+    # Ghi số liệu sinh text của một job đã xong (scheduler gọi, áp dụng cho mọi loại backend)
+    model = trace.values.get("model", "default")
+    if "prompt_tokens" in trace.values:
+        PROMPT_TOKENS.observe(trace.values["prompt_tokens"], model=model)
+    if "completion_tokens" in trace.values:
+        COMPLETION_TOKENS.observe(trace.values["completion_tokens"], model=model)
+    if "eval" in trace.spans:
+        PROMPT_EVAL_SECONDS.observe(trace.spans["eval"], model=model)
+    if "sample" in trace.spans:
+        DECODE_SECONDS.observe(trace.spans["sample"], model=model)
+
+
+def observe_spans(trace):
+    for name, seconds in trace.spans.items():
+        SPAN_SECONDS.observe(seconds, span=name)
+
+
+def timed_storage(op):
+    # Decorator đo thời gian một thao tác của backend lưu trữ (nhãn backend lấy từ self.metrics_backend)
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(self, *args, **kwargs)
+            except Exception:
+                STORAGE_ERRORS.inc(backend=self.metrics_backend, op=op)
+                raise
+            finally:
+                STORAGE_SECONDS.observe(time.perf_counter() - start, backend=self.metrics_backend, op=op)
+        return wrapper
+    return decorator
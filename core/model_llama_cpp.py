@@ -1,22 +1,61 @@
  # Lớp bao bọc thư viện llama-cpp-python
  # Chịu trách nhiệm tải model và sinh văn bản
 import os
-from llama_cpp import Llama
+import time
 import config
+from core.metrics import RequestTrace
+from core.grammar import get_grammar_cache, GrammarSamplerCache, GrammarLogitsProcessor
+from core.chat_template import load_chat_template, StopMatcher
+from core.kv_cache import ConversationStateCache, DiskStateCache, common_prefix_length, model_identity
+
+
+def prefetch_file(path, chunk_size=16 * 1024 * 1024):
+    # Đọc tuần tự cả file để hệ điều hành nạp vào page cache (đọc tuần tự nhanh hơn nhiều so với page fault ngẫu nhiên)
+    if not path or not os.path.exists(path):
+        return
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while f.read(chunk_size):
+            pass
 
 
 class ModelWrapper:
     # Lớp quản lý model Llama và các tham số cấu hình
     
-    def __init__(self):
+    def __init__(self, overrides=None):
         # Khởi tạo đối tượng, đọc cấu hình và gọi hàm tải model
+        # overrides: ghi đè một số tham số (ví dụ n_threads riêng cho từng worker)
         self.config = config.get_config()
+        if overrides:
+            self.config.update(overrides)
         self.model = None
+        self.state_cache = None
+        self.draft_model = None
+        self.grammar_samplers = None
         self._initialize_model()
+
+        # Định dạng prompt và điểm dừng của model (chat template trong metadata GGUF hoặc CHAT_TEMPLATE)
+        self.chat_template = load_chat_template(self.config.get('model_path'), self.config.get('chat_template', 'auto'))
+        self.stop_token_ids = self.chat_template.token_ids(self.model)
+
+        # Cache KV theo cuộc trò chuyện (0 MB = tắt), kèm tầng file trên đĩa cho cuộc trò chuyện được mở lại
+        cache_mb = self.config.get('kv_cache_max_mb', 0)
+        disk_mb = self.config.get('kv_disk_cache_max_mb', 0)
+        if cache_mb > 0 or disk_mb > 0:
+            disk = None
+            if disk_mb > 0:
+                disk = DiskStateCache(
+                    self.config.get('kv_disk_cache_dir', 'cache/kv_state'),
+                    disk_mb * 1024 * 1024,
+                    model_identity(self.config.get('model_path'), self.config.get('n_ctx', 1024)),
+                    min_tokens=self.config.get('kv_disk_cache_min_tokens', 256),
+                )
+            self.state_cache = ConversationStateCache(cache_mb * 1024 * 1024, disk=disk)
     
     def _validate_config(self):
         # Kiểm tra cấu hình trong file config.py có hợp lệ không
-        is_valid, message = config.validate_config()
+        is_valid, message = config.validate_config(self.config.get('model_path'))
         if not is_valid:
             raise ValueError(f"Config error: {message}")
     
@@ -32,66 +71,181 @@ class ModelWrapper:
         print(f"Đang tải model từ: {model_path}")
         
         try:
+            # Import tại đây để các công cụ dùng model giả (bench) chạy được khi chưa cài llama_cpp
+            from llama_cpp import Llama
+            if self.config.get('speculative_mode', 'off') != 'off':
+                from core.speculative import create_draft_model
+                self.draft_model = create_draft_model(self.config)
             self.model = Llama(
                 model_path=model_path,
                 n_ctx=self.config.get('n_ctx', 1024),
                 n_threads=self.config.get('n_threads', 4),
                 n_batch=self.config.get('n_batch', 16),
+                use_mmap=self.config.get('use_mmap', True),
+                use_mlock=self.config.get('use_mlock', False),
+                draft_model=self.draft_model,
                 verbose=False
             )
+            if self.draft_model is not None:
+                from core.speculative import check_draft_model
+                self.draft_model = check_draft_model(self.draft_model, self.model, model_path)
+                # Llama đọc draft_model ở mỗi lần sinh nên gỡ ra sau khi tạo được
+                self.model.draft_model = self.draft_model
+            # Sampler grammar gốc theo từng grammar của model này, request nhận bản clone
+            self.grammar_samplers = GrammarSamplerCache(self.model, self.config.get('grammar_cache_size', 32))
             print("Model đã được tải thành công!")
         except Exception as e:
             raise RuntimeError(f"Lỗi khi tải model: {e}")
     
-    def generate(self, prompt, max_tokens=None, temperature=None, top_p=None, stream=None):
+    def generate(self, prompt, max_tokens=None, temperature=None, top_p=None, stream=None, conv_id=None,
+                 cancel=None, trace=None, seed=None, grammar=None, json_schema=None):
         # Gọi model để sinh văn bản từ prompt đầu vào
+        # conv_id: ID cuộc trò chuyện, dùng để định tuyến worker và nạp lại KV cache của cuộc trò chuyện
+        # cancel: threading.Event, khi được đặt thì dừng sinh ở token kế tiếp và trả về phần đã sinh
+        # trace: RequestTrace nhận số token và thời gian các bước tokenize/eval/sample
+        # seed: seed lấy mẫu của riêng request này (None: để llama.cpp tự chọn), cùng seed cho cùng kết quả
+        # grammar / json_schema: grammar GBNF hoặc JSON schema (dict hoặc chuỗi), chỉ cho phép lấy mẫu các token
+        # giữ đầu ra đúng cú pháp; grammar đã biên dịch được cache theo hash nội dung
         if self.model is None:
             raise RuntimeError("Model chưa được khởi tạo")
         
         # Nếu tham số không được truyền vào thì dùng giá trị trong cấu hình
         max_tokens = max_tokens or self.config.get('max_tokens', 256)
-        temperature = temperature or self.config.get('temperature', 0.7)
+        temperature = temperature if temperature is not None else self.config.get('temperature', 0.7)
         top_p = top_p or self.config.get('top_p', 0.9)
         stream = stream if stream is not None else self.config.get('stream', False)
+        trace = trace if trace is not None else RequestTrace()
         
         try:
+            sampling = self._sampling_kwargs(seed, grammar, json_schema, trace)
+            if self.state_cache is not None and conv_id:
+                # Chỉ tokenize trước khi cần so khớp KV cache; nếu không, số token prompt lấy lúc sinh
+                with trace.span("tokenize"):
+                    # special=True: token đặc biệt của template (<|im_start|>...) được tokenize đúng như lúc model học
+                    tokens = self.model.tokenize(prompt.encode("utf-8"), special=True)
+                trace.set("prompt_tokens", len(tokens))
+                with trace.span("restore_state"):
+                    self._restore_state(tokens, conv_id)
+            if self.draft_model is not None:
+                self.draft_model.reset_sequence()
             if stream:
-                return self._generate_stream(prompt, max_tokens, temperature, top_p)
+                return self._generate_stream(prompt, max_tokens, temperature, top_p, conv_id, cancel, trace, sampling)
             else:
-                return self._generate_once(prompt, max_tokens, temperature, top_p)
+                return self._generate_once(prompt, max_tokens, temperature, top_p, conv_id, cancel, trace, sampling)
         except Exception as e:
             raise RuntimeError(f"Lỗi khi sinh text: {e}")
     
-    def _generate_once(self, prompt, max_tokens, temperature, top_p):
+    def _restore_state(self, tokens, conv_id):
+        # Nạp snapshot KV của cuộc trò chuyện trước khi sinh, llama.cpp sẽ tự so khớp prefix
+        # với các token đang có và chỉ đánh giá phần prompt mới
+        cached = self.state_cache.lookup(conv_id, tokens)
+        if cached is None:
+            return
+
+        state, prefix = cached
+        # Model có thể đang giữ sẵn KV của chính cuộc trò chuyện này (lượt liền trước), khi đó không cần nạp
+        current = common_prefix_length(self.model.input_ids[:self.model.n_tokens].tolist(), tokens)
+        if prefix > current:
+            self.model.load_state(state)
+
+    def _save_state(self, conv_id):
+        # Lưu snapshot KV sau khi sinh xong để lượt sau dùng lại
+        if self.state_cache is not None and conv_id:
+            self.state_cache.store(conv_id, self.model.save_state())
+
+    def _stopping_criteria(self, cancel):
+        # llama.cpp gọi hàm này sau mỗi token được lấy mẫu, trả về True để dừng sinh
+        # Dừng khi bị hủy hoặc khi token cuối đã đánh giá là token kết thúc lượt của template (EOT, <|im_end|>...)
+        # mà llama.cpp không coi là EOS
+        stop_ids = self.stop_token_ids
+
+        def should_stop(input_ids, logits):
+            if cancel is not None and cancel.is_set():
+                return True
+            return input_ids is not None and len(input_ids) > 0 and int(input_ids[-1]) in stop_ids
+
+        return should_stop
+
+    def _sampling_kwargs(self, seed, grammar, json_schema, trace):
+        # Tham số lấy mẫu thêm cho Llama.__call__, chỉ truyền khi có để vẫn chạy với các bản llama-cpp-python cũ
+        kwargs = {}
+        if seed is not None:
+            kwargs["seed"] = seed
+        if grammar or json_schema is not None:
+            with trace.span("grammar"):
+                compiled = get_grammar_cache().get(grammar, json_schema)
+                sampler = self.grammar_samplers.acquire(compiled) if self.grammar_samplers is not None else None
+            if sampler is None:
+                # Bản llama-cpp-python chưa có API sampler mức thấp: llama.cpp phân tích lại grammar mỗi request
+                kwargs["grammar"] = compiled.llama_grammar
+            else:
+                from llama_cpp import LogitsProcessorList
+                kwargs["logits_processor"] = LogitsProcessorList([GrammarLogitsProcessor(sampler, self.model.n_vocab())])
+        return kwargs
+
+    def _generate_once(self, prompt, max_tokens, temperature, top_p, conv_id=None, cancel=None, trace=None,
+                       sampling=None):
         # Sinh câu trả lời một lần, trả về toàn bộ chuỗi kết quả
-        response = self.model(
-            prompt,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            stop=["### Human:", "\n### Human:", "Human:", "\nHuman:"],
-            echo=False
-        )
-        
-        return response['choices'][0]['text'].strip()
+        # Đi qua cùng đường sinh từng token để stop string được dò tăng dần và dừng decode ngay khi gặp
+        return "".join(
+            self._generate_stream(prompt, max_tokens, temperature, top_p, conv_id, cancel, trace, sampling)
+        ).strip()
     
-    def _generate_stream(self, prompt, max_tokens, temperature, top_p):
+    def _generate_stream(self, prompt, max_tokens, temperature, top_p, conv_id=None, cancel=None, trace=None,
+                         sampling=None):
         # Sinh câu trả lời dạng từng phần, trả ra luồng văn bản
+        # eval: từ lúc gọi model tới chunk đầu tiên (đánh giá prompt), sample: phần còn lại (mỗi chunk một token)
+        # Stop string được dò bằng StopMatcher thay vì tham số stop của llama-cpp-python (tìm lại trên toàn bộ
+        # câu trả lời sau mỗi token); gặp stop string thì đóng luồng để llama.cpp dừng decode ngay
+        start = time.perf_counter()
+        first = None
+        count = 0
+        matcher = StopMatcher(self.chat_template.stop_strings)
         stream = self.model(
             prompt,
             max_tokens=max_tokens,
             temperature=temperature,
             top_p=top_p,
-            stop=["### Human:", "\n### Human:", "Human:", "\nHuman:"],
+            stop=[],
+            stopping_criteria=self._stopping_criteria(cancel),
             echo=False,
-            stream=True
+            stream=True,
+            **(sampling or {})
         )
         
-        for chunk in stream:
-            if 'choices' in chunk and len(chunk['choices']) > 0:
-                delta = chunk['choices'][0].get('text', '')
-                if delta:
-                    yield delta
+        prompt_tokens = None
+        try:
+            for chunk in stream:
+                if first is None:
+                    first = time.perf_counter()
+                    # Chunk đầu được trả ra ngay sau khi đánh giá prompt: n_tokens lúc này đúng bằng số token prompt
+                    prompt_tokens = self.model.n_tokens
+                count += 1
+                if cancel is not None and cancel.is_set():
+                    stream.close()
+                    return
+                if 'choices' in chunk and len(chunk['choices']) > 0:
+                    delta, stopped = matcher.feed(chunk['choices'][0].get('text', ''))
+                    if delta:
+                        yield delta
+                    if stopped:
+                        stream.close()
+                        break
+            rest = matcher.flush()
+            if rest:
+                yield rest
+        finally:
+            for processor in (sampling or {}).get("logits_processor") or []:
+                processor.close()
+            if trace is not None:
+                end = time.perf_counter()
+                trace.add("eval", (first or end) - start)
+                trace.add("sample", end - first if first is not None else 0.0)
+                trace.set("completion_tokens", count)
+                if "prompt_tokens" not in trace.values:
+                    trace.set("prompt_tokens", prompt_tokens if prompt_tokens is not None else self.model.n_tokens)
+
+        self._save_state(conv_id)
     
     def get_config(self):
         # Trả về bản sao cấu hình hiện tại của model
@@ -102,6 +256,41 @@ class ModelWrapper:
         # Lưu ý: không ghi lại vào file config.py
         self.config.update(new_config)
     
+    def warm_up(self):
+        # Đọc trước file model vào page cache rồi chạy thử một lần decode,
+        # để request đầu tiên không phải chờ nạp trọng số từ đĩa (page fault của mmap)
+        start = time.monotonic()
+        prefetch_file(self.config.get('model_path'))
+        self.generate(self.chat_template.render([("user", "Xin chào")]), max_tokens=1, stream=False)
+        elapsed = time.monotonic() - start
+        print(f"Đã làm nóng model trong {elapsed:.1f}s")
+        return elapsed
+
+    def prefetch_state(self, conv_id):
+        # Người dùng vừa mở lại cuộc trò chuyện cũ: cho hệ điều hành đọc trước file trạng thái KV của nó
+        if self.state_cache is not None and self.state_cache.disk is not None and conv_id:
+            self.state_cache.disk.prefetch(conv_id)
+
+    def speculative_stats(self):
+        # Tỉ lệ token nháp được chấp nhận (None nếu không bật speculative decoding)
+        return self.draft_model.stats() if self.draft_model is not None else None
+
+    def close(self):
+        # Giải phóng model (dùng khi registry loại model khỏi bộ nhớ)
+        # Sampler grammar giữ con trỏ tới bộ từ vựng của model nên được giải phóng trước
+        if self.grammar_samplers is not None:
+            self.grammar_samplers.close()
+        self.grammar_samplers = None
+        if self.model is not None and hasattr(self.model, "close"):
+            self.model.close()
+        self.model = None
+        if self.draft_model is not None:
+            self.draft_model.close()
+        self.draft_model = None
+        if self.state_cache is not None:
+            self.state_cache.close()
+        self.state_cache = None
+
     def is_ready(self):
         # Kiểm tra model đã được tải thành công hay chưa
         return self.model is not None
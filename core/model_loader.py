@@ -0,0 +1,57 @@
+ # Tải model trên luồng nền để tiến trình web trả lời health check ngay khi khởi động
+ # Các route cần model kiểm tra is_ready() và trả 503 trong lúc model còn đang tải
+import time
+import threading
+
+
+class BackgroundLoader:
+    # factory(): hàm tải model (và làm nóng), giá trị trả về được giữ trong .value
+
+    def __init__(self, factory, name="model-loader"):
+        self.factory = factory
+        self.name = name
+        self.value = None
+        self.error = None
+        self.started_at = None
+        self.load_seconds = None
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self.started_at = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self.value = self.factory()
+        except Exception as e:
+            self.error = e
+            print(f"Lỗi tải model: {e}")
+        finally:
+            self.load_seconds = time.monotonic() - self.started_at
+            self._done.set()
+
+    def is_ready(self):
+        return self._done.is_set() and self.error is None
+
+    def wait(self, timeout=None):
+        # Chờ tải xong, trả về True nếu model sẵn sàng
+        self._done.wait(timeout)
+        return self.is_ready()
+
+    def status(self):
+        if not self._done.is_set():
+            state = "loading" if self._thread is not None else "not_started"
+        else:
+            state = "error" if self.error is not None else "ready"
+        info = {"status": state}
+        if self.load_seconds is not None:
+            info["load_seconds"] = round(self.load_seconds, 2)
+        elif self.started_at is not None:
+            info["elapsed_seconds"] = round(time.monotonic() - self.started_at, 2)
+        if self.error is not None:
+            info["error"] = str(self.error)
+        return info
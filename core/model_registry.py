@@ -0,0 +1,255 @@
+ # Quản lý nhiều model GGUF: chỉ tải model khi có request cần tới,
+ # khi vượt ngân sách RAM thì bỏ model lâu không dùng nhất (LRU)
+ # Request đang chạy giữ tham chiếu tới model nên model bị loại chỉ được giải phóng khi request cuối cùng xong
+import gc
+import time
+import threading
+from collections import OrderedDict
+
+from core.utils import get_model_info
+
+
+def _total_ram_mb():
+    try:
+        import psutil
+        return psutil.virtual_memory().total / (1024 * 1024)
+    except ImportError:
+        return None
+
+
+def _available_ram_mb():
+    try:
+        import psutil
+        return psutil.virtual_memory().available / (1024 * 1024)
+    except ImportError:
+        return None
+
+
+class _ModelEntry:
+    # Một model đã (hoặc đang) được tải
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.size_mb = get_model_info(path).get("size_mb", 0)
+        self.wrapper = None
+        self.error = None
+        self.refs = 0
+        self.retired = False    # Đã bị loại khỏi registry, chờ request cuối cùng xong để giải phóng
+        self.loaded_at = None
+        self.last_used = time.time()
+        self.ready = threading.Event()
+
+
+class ModelRegistry:
+    # models: dict tên -> đường dẫn GGUF; factory(path) -> wrapper có generate/get_config/update_config/close
+    # budget_mb: tổng dung lượng model được giữ cùng lúc (0 = 75% RAM máy)
+
+    def __init__(self, models, default_model, factory, budget_mb=0, base_config=None):
+        if default_model not in models:
+            raise ValueError(f"DEFAULT_MODEL '{default_model}' không có trong MODELS")
+        self.models = dict(models)
+        self.default_model = default_model
+        self.factory = factory
+        total = _total_ram_mb()
+        self.budget_mb = budget_mb or (total * 0.75 if total else float("inf"))
+
+        # Tham số sinh chung cho mọi model (cập nhật từ /api/settings)
+        self.config = dict(base_config or {})
+        self._overrides = {}
+
+        self._lock = threading.Lock()
+        self._loaded = OrderedDict()  # tên -> _ModelEntry, thứ tự LRU (cũ nhất ở đầu)
+        self._retired = []
+        self.loads = 0
+        self.evictions = 0
+
+    def resolve(self, name):
+        # Tên model hợp lệ, None hoặc tên không có trong MODELS thì dùng model mặc định
+        return name if name in self.models else self.default_model
+
+    def acquire(self, name=None):
+        # Lấy model (tải nếu chưa có) và giữ tham chiếu; phải gọi release() khi dùng xong
+        name = self.resolve(name)
+        to_unload = []
+        with self._lock:
+            entry = self._loaded.get(name)
+            is_loader = entry is None
+            if is_loader:
+                entry = _ModelEntry(name, self.models[name])
+                to_unload = self._make_room(entry)
+                self._loaded[name] = entry
+            entry.refs += 1
+            entry.last_used = time.time()
+            self._loaded.move_to_end(name)
+
+        for old in to_unload:
+            self._unload(old)
+
+        if is_loader:
+            self._load(entry)
+        else:
+            entry.ready.wait()
+
+        if entry.error is not None:
+            self.release(entry)
+            raise RuntimeError(f"Không tải được model '{name}': {entry.error}")
+        return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.refs -= 1
+            entry.last_used = time.time()
+            free_now = entry.retired and entry.refs == 0
+            if free_now and entry in self._retired:
+                self._retired.remove(entry)
+        if free_now:
+            self._unload(entry)
+
+    def _load(self, entry):
+        print(f"Đang tải model '{entry.name}' ({entry.size_mb} MB)...")
+        try:
+            wrapper = self.factory(entry.path)
+            if self._overrides:
+                wrapper.update_config(self._overrides)
+            entry.wrapper = wrapper
+            entry.loaded_at = time.time()
+            self.loads += 1
+        except Exception as e:
+            entry.error = e
+            with self._lock:
+                if self._loaded.get(entry.name) is entry:
+                    del self._loaded[entry.name]
+        finally:
+            entry.ready.set()
+
+    def _make_room(self, new_entry):
+        # Chọn các model cần loại để model mới vừa ngân sách (gọi khi đang giữ lock)
+        # Ưu tiên model rảnh; model đang có request thì đánh dấu loại, giải phóng khi request xong
+        to_unload = []
+
+        def used_mb():
+            return sum(e.size_mb for e in self._loaded.values()) + sum(e.size_mb for e in self._retired)
+
+        while self._loaded and used_mb() + new_entry.size_mb > self.budget_mb:
+            victim = next((e for e in self._loaded.values() if e.refs == 0), None)
+            if victim is None:
+                victim = next(iter(self._loaded.values()))
+            self._evict(victim, to_unload)
+
+        # Ngân sách còn nhưng RAM thực tế không đủ (tiến trình khác đang dùng): loại thêm model rảnh
+        available = _available_ram_mb()
+        if available is not None:
+            freed = 0
+            for e in list(self._loaded.values()):
+                if available + freed >= new_entry.size_mb:
+                    break
+                if e.refs == 0:
+                    self._evict(e, to_unload)
+                    freed += e.size_mb
+
+        if used_mb() + new_entry.size_mb > self.budget_mb:
+            print(f"Cảnh báo: model '{new_entry.name}' vượt ngân sách RAM ({self.budget_mb:.0f} MB) "
+                  f"do các model khác vẫn đang xử lý request")
+        return to_unload
+
+    def _evict(self, entry, to_unload):
+        del self._loaded[entry.name]
+        self.evictions += 1
+        print(f"Loại model '{entry.name}' khỏi bộ nhớ (ít dùng nhất)")
+        if entry.refs == 0:
+            to_unload.append(entry)
+        else:
+            entry.retired = True
+            self._retired.append(entry)
+
+    def _unload(self, entry):
+        # Chờ model tải xong (nếu đang tải) rồi đóng để giải phóng RAM
+        entry.ready.wait()
+        wrapper, entry.wrapper = entry.wrapper, None
+        if wrapper is not None:
+            try:
+                wrapper.close()
+            except Exception as e:
+                print(f"Lỗi khi giải phóng model '{entry.name}': {e}")
+        gc.collect()
+
+    def generate(self, prompt, model=None, stream=None, **params):
+        # Giao diện giống ModelWrapper.generate, có thêm tham số model để chọn model theo request
+        entry = self.acquire(model)
+        if params.get("trace") is not None:
+            params["trace"].set("model", entry.name)
+        try:
+            result = entry.wrapper.generate(prompt, stream=stream, **params)
+        except Exception:
+            self.release(entry)
+            raise
+        if not stream:
+            self.release(entry)
+            return result
+        return self._stream_with_lease(entry, result)
+
+    def _stream_with_lease(self, entry, stream):
+        # Giữ tham chiếu model tới khi đọc hết stream (hoặc bên đọc dừng giữa chừng)
+        try:
+            for delta in stream:
+                yield delta
+        finally:
+            self.release(entry)
+
+    def warm_up(self):
+        # Tải sẵn model mặc định để request đầu tiên không phải chờ
+        self.release(self.acquire(self.default_model))
+
+    def close(self):
+        # Giải phóng mọi model khi tắt server (gọi sau khi các request đã xong)
+        with self._lock:
+            entries = list(self._loaded.values()) + self._retired
+            self._loaded.clear()
+            self._retired = []
+        for entry in entries:
+            self._unload(entry)
+
+    def get_config(self):
+        return dict(self.config, **self._overrides)
+
+    def update_config(self, new_config):
+        # Áp dụng cho các model đang tải và các model được tải sau này
+        self._overrides.update(new_config)
+        with self._lock:
+            entries = list(self._loaded.values())
+        for entry in entries:
+            if entry.wrapper is not None:
+                entry.wrapper.update_config(new_config)
+
+    def loaded_wrapper(self, name=None):
+        # Wrapper của model nếu đang nằm trong bộ nhớ (không tải mới), dùng cho thống kê
+        with self._lock:
+            entry = self._loaded.get(self.resolve(name))
+        return entry.wrapper if entry is not None else None
+
+    def list_models(self):
+        with self._lock:
+            loaded = set(self._loaded)
+        return [{
+            "name": name,
+            "size_mb": get_model_info(path).get("size_mb"),
+            "loaded": name in loaded,
+            "default": name == self.default_model,
+        } for name, path in self.models.items()]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "budget_mb": round(self.budget_mb, 1) if self.budget_mb != float("inf") else None,
+                "used_mb": round(sum(e.size_mb for e in self._loaded.values()), 1),
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "loaded": [{
+                    "name": e.name,
+                    "size_mb": e.size_mb,
+                    "in_flight": e.refs,
+                    "last_used": e.last_used,
+                } for e in self._loaded.values()],
+                "retiring": [{"name": e.name, "in_flight": e.refs} for e in self._retired],
+            }
@@ -0,0 +1,296 @@
+ # Bộ nhớ đệm câu trả lời đặt trước bước sinh text
+ # Tầng 1: khớp chính xác theo prompt đã chuẩn hóa + tham số sinh (LRU, có TTL, có thể lưu ra file)
+ # Tầng 2 (tùy chọn): tìm câu hỏi gần giống bằng embedding của chính model GGUF và cosine trên NumPy
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_prompt(text):
+    # Chuẩn hóa Unicode, khoảng trắng cuối dòng và dòng trống ở đầu/cuối để các prompt chỉ khác nhau về cách gõ
+    # vẫn trùng khóa; xuống dòng và thụt lề bên trong được giữ nguyên vì với code chúng làm thay đổi ý nghĩa
+    lines = [line.rstrip() for line in unicodedata.normalize("NFC", text).splitlines()]
+    return "\n".join(lines).strip("\n")
+
+
+def _params_key(params):
+    # Tham số sinh làm tròn để 0.7 và 0.70000001 cho cùng một khóa; mỗi model có câu trả lời riêng
+    key = "m={}|t={:.3f}|p={:.3f}|n={}".format(
+        params.get("model", ""),
+        float(params.get("temperature", 0)), float(params.get("top_p", 0)), int(params.get("max_tokens", 0))
+    )
+    # Câu trả lời sinh theo grammar/JSON schema không dùng lẫn với câu trả lời tự do (khóa cũ giữ nguyên)
+    if params.get("grammar"):
+        key += "|g=" + params["grammar"]
+    return key
+
+
+def make_cache_key(prompt, params):
+    raw = _params_key(params) + "\n" + normalize_prompt(prompt)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LlamaEmbedder:
+    # Tính embedding câu hỏi bằng chính file GGUF đang dùng, tải riêng ở chế độ embedding=True
+    # (trọng số được mmap nên phần lớn bộ nhớ dùng chung với model sinh text)
+
+    def __init__(self, model_path, n_ctx=512, n_threads=2):
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.n_threads = n_threads
+        self._llama = None
+        self._lock = threading.Lock()
+        self._memo = OrderedDict()  # Câu hỏi vừa tính ở bước tra cứu sẽ được dùng lại khi lưu
+
+    def __call__(self, text):
+        import numpy as np
+
+        with self._lock:
+            if text in self._memo:
+                self._memo.move_to_end(text)
+                return self._memo[text]
+
+            if self._llama is None:
+                from llama_cpp import Llama
+                self._llama = Llama(model_path=self.model_path, embedding=True,
+                                    n_ctx=self.n_ctx, n_threads=self.n_threads, verbose=False)
+            vector = np.asarray(self._llama.embed(text), dtype=np.float32)
+
+            # Model không có pooling trả về embedding từng token: lấy trung bình
+            if vector.ndim == 2:
+                vector = vector.mean(axis=0)
+            norm = np.linalg.norm(vector)
+            if norm > 0:
+                vector = vector / norm
+
+            self._memo[text] = vector
+            if len(self._memo) > 64:
+                self._memo.popitem(last=False)
+            return vector
+
+
+class ResponseCache:
+    # LRU giới hạn số entry, mỗi entry: key -> {response, created_at, question, params, embedding}
+    # embed_fn(text) -> vector đã chuẩn hóa; None = chỉ dùng tầng khớp chính xác
+
+    def __init__(self, max_entries=1000, ttl=86400, path=None, embed_fn=None, similarity=0.92,
+                 max_temperature=0.5):
+        self.max_entries = max_entries
+        self.max_temperature = max_temperature
+        self.ttl = ttl
+        self.path = path
+        self.embed_fn = embed_fn
+        self.similarity = similarity
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Ma trận embedding dựng lại khi có thay đổi, dùng cho tìm kiếm cosine vector hóa
+        self._matrix = None
+        self._matrix_keys = []
+        self._matrix_params = None
+        self._dirty = True
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+        if self.path:
+            self._load()
+            atexit.register(self.save)
+
+    def cacheable(self, params):
+        # Temperature cao nghĩa là muốn câu trả lời đa dạng, không trả lại câu cũ
+        return float(params.get("temperature", 0)) <= self.max_temperature
+
+    def get(self, prompt, params, question=None):
+        # Trả về câu trả lời đã lưu hoặc None
+        # question: câu hỏi gốc, chỉ truyền khi prompt không có lịch sử (mới dùng được tầng ngữ nghĩa)
+        if not self.cacheable(params):
+            return None
+        key = make_cache_key(prompt, params)
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry["response"]
+
+        if question and self.embed_fn is not None:
+            try:
+                response = self._semantic_lookup(question, params)
+            except Exception as e:
+                print(f"Lỗi tra cứu cache ngữ nghĩa: {e}")
+                response = None
+            if response is not None:
+                return response
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, prompt, params, response, question=None):
+        if not response or not response.strip() or not self.cacheable(params):
+            return
+
+        embedding = None
+        if question and self.embed_fn is not None:
+            try:
+                embedding = self.embed_fn(normalize_prompt(question))
+            except Exception as e:
+                print(f"Lỗi tính embedding cho cache: {e}")
+
+        key = make_cache_key(prompt, params)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = {
+                "response": response,
+                "created_at": time.time(),
+                "question": question,
+                "params": _params_key(params),
+                "embedding": embedding,
+            }
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dirty = True
+
+    def _live_entry(self, key):
+        # Lấy entry còn hạn, entry hết hạn bị xóa luôn (gọi khi đang giữ lock)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl and time.time() - entry["created_at"] > self.ttl:
+            del self._entries[key]
+            self.expired += 1
+            self._dirty = True
+            return None
+        return entry
+
+    def _semantic_lookup(self, question, params):
+        import numpy as np
+
+        query = self.embed_fn(normalize_prompt(question))
+        with self._lock:
+            if self._dirty:
+                self._rebuild_matrix(np)
+            if self._matrix is None:
+                return None
+
+            # Cosine của mọi câu hỏi đã lưu trong một phép nhân ma trận, chỉ xét entry cùng tham số sinh
+            scores = self._matrix @ query
+            scores[self._matrix_params != _params_key(params)] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity:
+                return None
+
+            key = self._matrix_keys[best]
+            entry = self._live_entry(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.semantic_hits += 1
+            return entry["response"]
+
+    def _rebuild_matrix(self, np):
+        rows = [(k, e) for k, e in self._entries.items() if e["embedding"] is not None]
+        if rows:
+            self._matrix = np.vstack([e["embedding"] for _, e in rows]).astype(np.float32)
+            self._matrix_keys = [k for k, _ in rows]
+            self._matrix_params = np.array([e["params"] for _, e in rows], dtype=object)
+        else:
+            self._matrix, self._matrix_keys, self._matrix_params = None, [], None
+        self._dirty = False
+
+    def save(self):
+        # Ghi cache ra file (ghi file tạm rồi đổi tên để không làm hỏng file cũ nếu bị dừng giữa chừng)
+        if not self.path:
+            return
+        with self._lock:
+            entries = [
+                dict(e, key=k, embedding=None if e["embedding"] is None else [float(x) for x in e["embedding"]])
+                for k, e in self._entries.items()
+            ]
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"entries": entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Lỗi lưu cache câu trả lời: {e}")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Không đọc được file cache câu trả lời: {e}")
+            return
+
+        now = time.time()
+        for item in data.get("entries", []):
+            if self.ttl and now - item["created_at"] > self.ttl:
+                continue
+            embedding = item.get("embedding")
+            if embedding is not None:
+                import numpy as np
+                embedding = np.asarray(embedding, dtype=np.float32)
+            self._entries[item["key"]] = {
+                "response": item["response"],
+                "created_at": item["created_at"],
+                "question": item.get("question"),
+                "params": item["params"],
+                "embedding": embedding,
+            }
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        print(f"Đã nạp {len(self._entries)} câu trả lời từ cache")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expired": self.expired,
+                "semantic": self.embed_fn is not None,
+            }
+
+
+def create_response_cache(conf):
+    # Tạo cache theo cấu hình, trả về None nếu tắt (RESPONSE_CACHE_SIZE = 0)
+    size = conf.get("response_cache_size", 0)
+    if size <= 0:
+        return None
+
+    embed_fn = None
+    if conf.get("response_cache_semantic"):
+        embed_fn = LlamaEmbedder(conf["model_path"], n_threads=max(1, conf.get("n_threads", 4) // 2))
+
+    return ResponseCache(
+        max_entries=size,
+        ttl=conf.get("response_cache_ttl", 0),
+        path=conf.get("response_cache_path") or None,
+        embed_fn=embed_fn,
+        similarity=conf.get("response_cache_similarity", 0.92),
+        max_temperature=conf.get("response_cache_max_temperature", 0.5),
+    )
@@ -0,0 +1,352 @@
+ # Bộ lập lịch suy luận đặt trước ModelWrapper dùng chung
+ # Các luồng Flask chỉ xếp hàng request, một luồng worker riêng mới được gọi model
+import threading
+import time
+import queue
+from collections import OrderedDict, deque
+
+from core import metrics
+
+
+class QueueFullError(Exception):
+    # User đã có quá nhiều request đang chờ (trả về HTTP 429)
+    pass
+
+
+class SchedulerUnavailableError(Exception):
+    # Hàng đợi chung đã đầy hoặc bộ lập lịch đã dừng (trả về HTTP 503)
+    pass
+
+
+# Đánh dấu kết thúc luồng token của một job
+_END = object()
+
+
+class InferenceJob:
+    # Một request suy luận đang chờ hoặc đang chạy trong bộ lập lịch
+
+    def __init__(self, username, prompt, params, trace=None):
+        self.username = username
+        self.prompt = prompt
+        self.params = params
+        self.trace = trace if trace is not None else metrics.RequestTrace()
+        self.error = None
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self._chunks = queue.Queue()
+        self._parts = []
+        self._done = threading.Event()
+        self.cancel_event = threading.Event()  # Được truyền xuống model, đặt khi request bị hủy
+        self._waiter = None  # (event loop, asyncio.Event) của bên đọc bất đồng bộ
+
+    def _push(self, delta):
+        # Được gọi từ luồng worker mỗi khi model sinh thêm một đoạn text
+        self._parts.append(delta)
+        self._chunks.put(delta)
+        self._wake()
+
+    def _finish(self, error=None):
+        self.error = error
+        if self.finished_at is None:
+            self.finished_at = time.monotonic()
+        self._done.set()
+        self._chunks.put(_END)
+        self._wake()
+
+    def _wake(self):
+        # Báo cho bên đọc bất đồng bộ (nếu có) rằng có dữ liệu mới, an toàn khi gọi từ luồng worker
+        waiter = self._waiter
+        if waiter is not None:
+            loop, event = waiter
+            loop.call_soon_threadsafe(event.set)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def iter_tokens(self, timeout=None, heartbeat=None):
+        # Trả ra từng đoạn text ngay khi worker sinh được (dùng cho streaming)
+        # timeout: số giây tối đa chờ đoạn tiếp theo, hết hạn sẽ ném TimeoutError
+        # heartbeat: nếu đặt, trả ra None sau mỗi heartbeat giây chưa có dữ liệu (để bên gọi ghi gì đó
+        # ra kết nối và phát hiện client đã ngắt trong lúc request còn nằm trong hàng đợi)
+        idle = 0.0
+        while True:
+            wait = timeout
+            if heartbeat is not None:
+                wait = heartbeat if timeout is None else min(heartbeat, timeout - idle)
+            try:
+                item = self._chunks.get(timeout=wait)
+            except queue.Empty:
+                idle += wait
+                if timeout is not None and idle >= timeout:
+                    raise TimeoutError("Hết thời gian chờ phản hồi từ model")
+                yield None
+                continue
+            idle = 0.0
+            if item is _END:
+                if self.error:
+                    raise self.error
+                return
+            yield item
+
+    async def aiter_tokens(self, timeout=None):
+        # Giống iter_tokens nhưng chờ trên event loop (ASGI), không giữ một luồng cho mỗi stream
+        import asyncio
+        event = asyncio.Event()
+        self._waiter = (asyncio.get_running_loop(), event)
+        try:
+            while True:
+                try:
+                    item = self._chunks.get_nowait()
+                except queue.Empty:
+                    event.clear()
+                    if self._chunks.empty():
+                        try:
+                            await asyncio.wait_for(event.wait(), timeout)
+                        except asyncio.TimeoutError:
+                            raise TimeoutError("Hết thời gian chờ phản hồi từ model")
+                    continue
+                if item is _END:
+                    if self.error:
+                        raise self.error
+                    return
+                yield item
+        finally:
+            self._waiter = None
+
+    def result(self, timeout=None):
+        # Chờ job chạy xong và trả về toàn bộ câu trả lời
+        if not self._done.wait(timeout):
+            raise TimeoutError("Hết thời gian chờ phản hồi từ model")
+        if self.error:
+            raise self.error
+        return "".join(self._parts).strip()
+
+    def is_done(self):
+        return self._done.is_set()
+
+    @property
+    def queue_wait(self):
+        # Thời gian nằm trong hàng đợi (giây)
+        if self.started_at is None:
+            return time.monotonic() - self.enqueued_at
+        return self.started_at - self.enqueued_at
+
+    @property
+    def service_time(self):
+        # Thời gian model thực sự xử lý job (giây)
+        if self.started_at is None:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+
+class _TimingStats:
+    # Thống kê thời gian đơn giản: tổng, max và cửa sổ các mẫu gần nhất để tính percentile
+
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=window)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def snapshot(self):
+        ordered = sorted(self.samples)
+
+        def pct(p):
+            if not ordered:
+                return 0.0
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 4)
+
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 4) if self.count else 0.0,
+            "max": round(self.max, 4),
+            "p50": pct(0.50),
+            "p95": pct(0.95),
+            "p99": pct(0.99),
+        }
+
+
+class InferenceScheduler:
+    # Hàng đợi có giới hạn, chia lượt công bằng (round-robin) giữa các username
+    # backend: đối tượng có hàm generate(prompt, stream=True, ...) như ModelWrapper
+
+    def __init__(self, backend, max_queue_depth=16, max_per_user=2, num_workers=1):
+        self.backend = backend
+        self.max_queue_depth = max_queue_depth
+        self.max_per_user = max_per_user
+
+        # key là username, value là deque các job đang chờ của user đó
+        # Thứ tự trong OrderedDict chính là thứ tự lượt phục vụ
+        self._queues = OrderedDict()
+        self._pending = 0
+        self._running = True
+        self._cond = threading.Condition()
+
+        self._queue_wait = _TimingStats()
+        self._service_time = _TimingStats()
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._cancelled = 0
+        self._in_service = 0
+        self._running_jobs = set()
+
+        self._workers = []
+        for i in range(max(1, num_workers)):
+            worker = threading.Thread(target=self._worker_loop, name=f"inference-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, username, prompt, trace=None, **params):
+        # Đưa một request vào hàng đợi, từ chối ngay nếu hàng đợi đã đầy
+        # trace: RequestTrace của bên gọi để nhận thêm các bước queue_wait/tokenize/eval/sample
+        with self._cond:
+            if not self._running:
+                raise SchedulerUnavailableError("Máy chủ đang dừng, vui lòng thử lại sau")
+
+            user_jobs = self._queues.get(username)
+            if user_jobs is not None and len(user_jobs) >= self.max_per_user:
+                self._rejected += 1
+                metrics.JOBS.inc(status="rejected")
+                raise QueueFullError("Bạn đang có quá nhiều câu hỏi chờ xử lý, vui lòng đợi")
+
+            if self._pending >= self.max_queue_depth:
+                self._rejected += 1
+                metrics.JOBS.inc(status="rejected")
+                raise SchedulerUnavailableError("Máy chủ đang quá tải, vui lòng thử lại sau")
+
+            job = InferenceJob(username, prompt, params, trace)
+            if user_jobs is None:
+                user_jobs = self._queues[username] = deque()
+            user_jobs.append(job)
+            self._pending += 1
+            self._cond.notify()
+        return job
+
+    def _next_job(self):
+        # Lấy job kế tiếp theo vòng round-robin, chờ nếu hàng đợi trống
+        with self._cond:
+            while self._running and self._pending == 0:
+                self._cond.wait()
+            if self._pending == 0:
+                return None
+
+            username, user_jobs = next(iter(self._queues.items()))
+            job = user_jobs.popleft()
+            if user_jobs:
+                # User còn job: xếp xuống cuối để nhường lượt cho user khác
+                self._queues.move_to_end(username)
+            else:
+                del self._queues[username]
+            self._pending -= 1
+            self._in_service += 1
+            self._running_jobs.add(job)
+            return job
+
+    def _worker_loop(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            self._run_job(job)
+
+    def _run_job(self, job):
+        job.started_at = time.monotonic()
+        error = None
+        try:
+            if not job.cancelled:
+                # Model kiểm tra cancel_event giữa các token; đóng stream sớm để trả model cho job khác
+                stream = self.backend.generate(job.prompt, stream=True, cancel=job.cancel_event, trace=job.trace,
+                                               **job.params)
+                try:
+                    for delta in stream:
+                        if job.cancelled:
+                            break
+                        job._push(delta)
+                finally:
+                    stream.close()
+        except Exception as e:
+            error = e if isinstance(e, RuntimeError) else RuntimeError(f"Lỗi khi sinh text: {e}")
+        finally:
+            job.finished_at = time.monotonic()
+            with self._cond:
+                self._in_service -= 1
+                self._running_jobs.discard(job)
+                self._queue_wait.add(job.queue_wait)
+                self._service_time.add(job.service_time)
+                if error:
+                    self._failed += 1
+                elif job.cancelled:
+                    self._cancelled += 1
+                else:
+                    self._completed += 1
+            job.trace.add("queue_wait", job.queue_wait)
+            metrics.QUEUE_WAIT.observe(job.queue_wait)
+            metrics.JOBS.inc(status="failed" if error else "cancelled" if job.cancelled else "completed")
+            metrics.observe_generation(job.trace)
+            job._finish(error)
+
+    def cancel(self, job):
+        # Hủy một job: job đang chờ được bỏ khỏi hàng đợi ngay, job đang chạy dừng ở token kế tiếp
+        # Trả về True nếu job chưa kết thúc lúc bị hủy
+        with self._cond:
+            if job.is_done():
+                return False
+            job.cancel_event.set()
+            user_jobs = self._queues.get(job.username)
+            queued = user_jobs is not None and job in user_jobs
+            if queued:
+                user_jobs.remove(job)
+                if not user_jobs:
+                    del self._queues[job.username]
+                self._pending -= 1
+                self._cancelled += 1
+        if queued:
+            job.trace.add("queue_wait", job.queue_wait)
+            metrics.JOBS.inc(status="cancelled")
+            job._finish()
+        return True
+
+    def cancel_user(self, username):
+        # Hủy mọi job đang chờ hoặc đang chạy của một user (nút dừng, cuộc trò chuyện mới, đăng xuất)
+        with self._cond:
+            jobs = list(self._queues.get(username, ()))
+            jobs += [job for job in self._running_jobs if job.username == username]
+        return sum(1 for job in jobs if self.cancel(job))
+
+    def stats(self):
+        # Số liệu để định cỡ hệ thống: độ dài hàng đợi, thời gian chờ và thời gian phục vụ
+        with self._cond:
+            return {
+                "queued": self._pending,
+                "in_service": self._in_service,
+                "max_queue_depth": self.max_queue_depth,
+                "max_per_user": self.max_per_user,
+                "workers": len(self._workers),
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "cancelled": self._cancelled,
+                "queue_wait_seconds": self._queue_wait.snapshot(),
+                "service_time_seconds": self._service_time.snapshot(),
+            }
+
+    def shutdown(self, timeout=None):
+        # Dừng nhận request mới, các worker chạy nốt các job đang có rồi thoát
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        # timeout tính chung cho cả nhóm worker; trả về True nếu mọi worker đã thoát
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return not any(worker.is_alive() for worker in self._workers)
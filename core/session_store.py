@@ -0,0 +1,188 @@
+ # Lưu trạng thái chat của từng user phía server (cuộc trò chuyện hiện tại, model đã chọn, context đưa vào prompt)
+ # Giới hạn số user giữ cùng lúc (LRU) và tự bỏ user không hoạt động quá SESSION_IDLE_TTL giây
+ # Backend "sqlite" cho phép nhiều tiến trình web (gunicorn worker) dùng chung trạng thái
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class UserContext:
+    # Trạng thái chat của một user
+
+    def __init__(self, conv_id, manager, model=None):
+        self.conv_id = conv_id
+        self.manager = manager
+        self.model = model
+
+    def to_dict(self):
+        return {"conv_id": self.conv_id, "model": self.model, "conversation": self.manager.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data, manager_loader):
+        # manager_loader(dict) -> ConversationManager (gắn lại tokenizer và summarizer không lưu được)
+        return cls(data["conv_id"], manager_loader(data.get("conversation") or {}), data.get("model"))
+
+
+class MemorySessionStore:
+    # Giữ đối tượng trong RAM của tiến trình, thứ tự OrderedDict là thứ tự dùng gần nhất
+
+    def __init__(self, max_entries=1000, idle_ttl=3600):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self._entries = OrderedDict()  # key -> (value, lần truy cập cuối)
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key):
+        with self._lock:
+            self._purge_expired()
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries[key] = (entry[0], time.monotonic())
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _purge_expired(self):
+        # Các entry cũ nhất nằm ở đầu nên chỉ cần xét từ đầu cho tới entry còn hạn đầu tiên
+        if not self.idle_ttl:
+            return
+        deadline = time.monotonic() - self.idle_ttl
+        while self._entries:
+            key, (_, last_access) = next(iter(self._entries.items()))
+            if last_access >= deadline:
+                break
+            del self._entries[key]
+            self.expired += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "idle_ttl": self.idle_ttl,
+                "evictions": self.evictions,
+                "expired": self.expired,
+            }
+
+
+class SQLiteSessionStore:
+    # Lưu trạng thái dạng JSON trong một file SQLite (WAL) dùng chung giữa các tiến trình trên cùng máy
+    # encode(value) -> dict, decode(key, dict) -> value: chuyển đối tượng sang dạng lưu được và ngược lại
+
+    def __init__(self, db_path="logs/sessions.db", max_entries=1000, idle_ttl=3600, encode=None, decode=None,
+                 purge_interval=60):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda key, data: data)
+        self.purge_interval = purge_interval
+        self._local = threading.local()
+        self._last_purge = 0.0
+        self.evictions = 0
+        self.expired = 0
+
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "key TEXT PRIMARY KEY, data TEXT NOT NULL, last_access REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions(last_access)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        self._maybe_purge(conn)
+        row = conn.execute("SELECT data, last_access FROM sessions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if self.idle_ttl and now - row[1] > self.idle_ttl:
+            with conn:
+                conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+            self.expired += 1
+            return None
+        with conn:
+            conn.execute("UPDATE sessions SET last_access = ? WHERE key = ?", (now, key))
+        return self.decode(key, json.loads(row[0]))
+
+    def set(self, key, value):
+        conn = self._conn()
+        data = json.dumps(self.encode(value), ensure_ascii=False)
+        with conn:
+            conn.execute(
+                "INSERT INTO sessions (key, data, last_access) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET data = excluded.data, last_access = excluded.last_access",
+                (key, data, time.time()))
+        self._maybe_purge(conn)
+
+    def delete(self, key):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    def _maybe_purge(self, conn, force=False):
+        # Dọn entry hết hạn và entry vượt giới hạn, tối đa một lần mỗi purge_interval giây
+        now = time.time()
+        if not force and now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        with conn:
+            if self.idle_ttl:
+                self.expired += conn.execute(
+                    "DELETE FROM sessions WHERE last_access < ?", (now - self.idle_ttl,)).rowcount
+            self.evictions += conn.execute(
+                "DELETE FROM sessions WHERE key IN "
+                "(SELECT key FROM sessions ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)).rowcount
+
+    def stats(self):
+        conn = self._conn()
+        return {
+            "backend": "sqlite",
+            "entries": conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0],
+            "max_entries": self.max_entries,
+            "idle_ttl": self.idle_ttl,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
+
+
+def create_session_store(conf, encode=None, decode=None):
+    # Chọn backend theo SESSION_BACKEND trong config.py
+    backend = conf.get("session_backend", "memory")
+    max_entries = conf.get("session_max_entries", 1000)
+    idle_ttl = conf.get("session_idle_ttl", 3600)
+
+    if backend == "memory":
+        return MemorySessionStore(max_entries=max_entries, idle_ttl=idle_ttl)
+    if backend == "sqlite":
+        return SQLiteSessionStore(conf.get("session_sqlite_path", "logs/sessions.db"), max_entries=max_entries,
+                                  idle_ttl=idle_ttl, encode=encode, decode=decode)
+    raise ValueError(f"SESSION_BACKEND không hợp lệ: {backend}")
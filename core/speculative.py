@@ -0,0 +1,160 @@
+ # Giải mã suy đoán (speculative decoding) cho ModelWrapper
+ # Model nháp đề xuất k token, model chính kiểm tra cả k token trong một lần decode
+ # llama-cpp-python lấy mẫu từ logits của model chính và chỉ nhận token nháp trùng với token đã lấy mẫu,
+ # nên kết quả giống hệt khi sinh bình thường (với temperature = 0 là trùng từng token)
+import threading
+
+import numpy as np
+import llama_cpp
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+from core.kv_cache import common_prefix_length
+
+# Đoạn văn bản mẫu để so cách tách token của model nháp với model chính
+_PROBE_TEXT = "Xin chào! def main():\n    return [1, 2, 3]  # Hello, world.".encode("utf-8")
+
+
+class GGUFDraftModel(LlamaDraftModel):
+    # Dùng một model GGUF nhỏ cùng bộ từ vựng (ví dụ bản 0.5B/1B của cùng họ model) để đề xuất token
+
+    def __init__(self, model_path, num_pred_tokens=8, n_ctx=2048, n_threads=2):
+        self.num_pred_tokens = num_pred_tokens
+        self.llama = llama_cpp.Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads, verbose=False)
+        self.eos = self.llama.token_eos()
+
+    def incompatibility(self, target):
+        # Lý do model nháp không dùng được cho model chính target, None nếu cùng bộ từ vựng
+        # Token id nháp chỉ có nghĩa khi hai model tokenize giống nhau (cùng số token, token đặc biệt và cách tách từ)
+        draft = self.llama
+        if draft.n_vocab() != target.n_vocab():
+            return f"có bộ từ vựng khác ({draft.n_vocab()} token, model chính {target.n_vocab()} token)"
+        for name in ("token_bos", "token_eos"):
+            if getattr(draft, name)() != getattr(target, name)():
+                return f"có {name} khác ({getattr(draft, name)()}, model chính {getattr(target, name)()})"
+        if draft.tokenize(_PROBE_TEXT, add_bos=False) != target.tokenize(_PROBE_TEXT, add_bos=False):
+            return "tách token khác model chính"
+        return None
+
+    def close(self):
+        if hasattr(self.llama, "close"):
+            self.llama.close()
+
+    def __call__(self, input_ids, **kwargs):
+        tokens = input_ids.tolist()
+        draft = self.llama
+        if len(tokens) + self.num_pred_tokens > draft.n_ctx():
+            return np.array([], dtype=np.intc)
+
+        # Chỉ đánh giá phần token mới so với lần trước (các token đã có vẫn nằm trong KV của model nháp)
+        prefix = common_prefix_length(draft.input_ids[:draft.n_tokens].tolist(), tokens)
+        prefix = min(prefix, len(tokens) - 1)  # Luôn đánh giá lại token cuối để có logits
+        draft.n_tokens = prefix
+        draft.eval(tokens[prefix:])
+
+        n_vocab = draft.n_vocab()
+        proposed = []
+        for _ in range(self.num_pred_tokens):
+            logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits(draft.ctx), shape=(n_vocab,))
+            token = int(np.argmax(logits))
+            if token == self.eos:
+                break
+            proposed.append(token)
+            draft.eval([token])
+        return np.array(proposed, dtype=np.intc)
+
+
+class MeteredDraftModel(LlamaDraftModel):
+    # Bọc model nháp để đo tỉ lệ token nháp được chấp nhận
+    # Mỗi lần llama-cpp gọi model nháp tương ứng một lần model chính kiểm tra nháp; số token tăng thêm
+    # giữa hai lần gọi liên tiếp = số token nháp được nhận + 1 token model chính tự lấy mẫu
+
+    def __init__(self, inner):
+        self.inner = inner
+        self._lock = threading.Lock()
+        self._last_len = None
+        self._last_proposed = 0
+        self.calls = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.generated = 0
+        self.verify_passes = 0
+
+    def __call__(self, input_ids, **kwargs):
+        draft = self.inner(input_ids, **kwargs)
+        with self._lock:
+            n = len(input_ids)
+            if self._last_len is not None and n > self._last_len:
+                # Cùng một lượt sinh: đối chiếu với lần đề xuất trước
+                advanced = n - self._last_len
+                self.accepted += min(self._last_proposed, advanced - 1)
+                self.generated += advanced
+                self.verify_passes += 1
+            self._last_len = n
+            self._last_proposed = len(draft)
+            self.calls += 1
+            self.proposed += len(draft)
+        return draft
+
+    def reset_sequence(self):
+        # Gọi trước mỗi lượt sinh mới để không so sánh với prompt của lượt trước
+        with self._lock:
+            self._last_len = None
+            self._last_proposed = 0
+
+    def incompatibility(self, target):
+        # Nháp từ n-gram trong prompt luôn dùng token của chính model chính
+        check = getattr(self.inner, "incompatibility", None)
+        return check(target) if check is not None else None
+
+    def close(self):
+        if hasattr(self.inner, "close"):
+            self.inner.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "draft_calls": self.calls,
+                "proposed_tokens": self.proposed,
+                "accepted_tokens": self.accepted,
+                "acceptance_rate": round(self.accepted / self.proposed, 4) if self.proposed else 0.0,
+                # Số token sinh được trên mỗi lần chạy model chính (1.0 = không có lợi ích)
+                "tokens_per_main_pass": round(self.generated / self.verify_passes, 3) if self.verify_passes else 1.0,
+            }
+
+
+def create_draft_model(conf):
+    # Tạo model nháp theo SPECULATIVE_MODE, trả về None nếu tắt
+    mode = conf.get("speculative_mode", "off")
+    num_tokens = conf.get("draft_num_tokens", 8)
+
+    if mode == "draft":
+        draft_path = conf.get("draft_model_path")
+        if not draft_path:
+            raise ValueError("SPECULATIVE_MODE = 'draft' cần DRAFT_MODEL_PATH")
+        print(f"Đang tải model nháp từ: {draft_path}")
+        inner = GGUFDraftModel(
+            draft_path,
+            num_pred_tokens=num_tokens,
+            n_ctx=conf.get("n_ctx", 2048),
+            n_threads=max(1, conf.get("n_threads", 4) // 2),
+        )
+    elif mode == "prompt_lookup":
+        # Lấy n-gram trùng trong prompt (lịch sử chat, code người dùng dán vào) làm nháp, không cần model phụ
+        inner = LlamaPromptLookupDecoding(num_pred_tokens=num_tokens)
+    elif mode == "off":
+        return None
+    else:
+        raise ValueError(f"SPECULATIVE_MODE không hợp lệ: {mode}")
+
+    return MeteredDraftModel(inner)
+
+
+def check_draft_model(draft_model, target, model_path=None):
+    # Trả về draft_model nếu dùng được cho model chính target; khác bộ từ vựng thì giải phóng và trả về None
+    # (một DRAFT_MODEL_PATH được gắn cho mọi model trong MODELS, model khác họ sẽ chạy không có nháp)
+    reason = draft_model.incompatibility(target)
+    if reason is None:
+        return draft_model
+    print(f"Tắt speculative decoding cho {model_path or 'model'}: model nháp {reason}")
+    draft_model.close()
+    return None
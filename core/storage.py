@@ -0,0 +1,121 @@
+ # Giao diện chung cho tầng lưu trữ tài khoản và lịch sử chat
+ # MongoDBManager (core/database_utils.py) và SQLiteManager (core/database_sqlite.py) cùng cài đặt giao diện này
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+import config
+
+
+class StorageBackend(ABC):
+    # Các hàm web app và GUI dùng để đọc/ghi dữ liệu, không phụ thuộc database cụ thể
+
+    @abstractmethod
+    def register_user(self, username, password):
+        """Đăng ký user mới, trả về (thành công, thông báo)"""
+
+    @abstractmethod
+    def login_user(self, username, password):
+        """Kiểm tra đăng nhập, trả về True/False"""
+
+    @abstractmethod
+    def save_message(self, user_msg, assistant_resp, conv_id, username):
+        """Lưu một lượt hỏi/đáp (được phép ghi nền, không chờ database)"""
+
+    @abstractmethod
+    def get_conversation_list(self, username):
+        """Danh sách cuộc trò chuyện của user: [{id, title, last_activity, message_count}]"""
+
+    @abstractmethod
+    def get_messages_by_conversation_id(self, conv_id, username):
+        """Toàn bộ tin nhắn của một cuộc trò chuyện theo thứ tự thời gian"""
+
+    @abstractmethod
+    def get_messages_page(self, conv_id, username, before=None, limit=20):
+        """Một trang tin nhắn cũ dần, trả về (tin nhắn tăng dần theo thời gian, con trỏ trang kế tiếp)"""
+
+    @abstractmethod
+    def delete_all_conversations(self, username):
+        """Xóa toàn bộ lịch sử của user"""
+
+    def search_messages(self, username, query, limit=20):
+        """Tìm tin nhắn theo nội dung, mặc định không hỗ trợ"""
+        return []
+
+    def flush(self):
+        """Chờ các thao tác ghi nền hoàn tất (các hàm đọc không cần gọi, chúng tự ghép phần chưa ghi)"""
+
+    def close(self):
+        """Ghi nốt dữ liệu và đóng kết nối"""
+
+
+# Ghép tin nhắn còn trong bộ đệm ghi nền (WriteBehindBuffer.pending) vào kết quả đọc từ database,
+# để request đọc được dữ liệu vừa ghi mà không phải chờ lô ghi xong.
+# Danh sách pending được lấy TRƯỚC khi đọc database: tin nhắn không còn trong đó đã được ghi trước lúc đọc;
+# tin nhắn vừa được ghi trong lúc đọc có thể xuất hiện ở cả hai phía nên được lọc trùng theo key(doc).
+
+
+def merge_pending_messages(docs, pending, key):
+    """docs: tin nhắn đọc từ database (tăng dần theo thời gian), pending: tin nhắn chưa ghi xong (mới hơn)"""
+    seen = {key(doc) for doc in docs}
+    return docs + [doc for doc in pending if key(doc) not in seen]
+
+
+def merge_pending_page(docs, next_before, pending, limit, key):
+    """Ghép vào trang mới nhất, trả về (tin nhắn, con trỏ trang kế tiếp).
+
+    Trả về None nếu tin nhắn chưa ghi chiếm cả trang mà không có _id để làm con trỏ trang kế tiếp."""
+    combined = merge_pending_messages(docs, pending, key)
+    if len(combined) <= limit:
+        return combined, next_before
+    kept = combined[-limit:]
+    oldest = kept[0]
+    if oldest.get("_id") is None:
+        return None
+    return kept, f"{oldest['timestamp'].isoformat()}|{oldest['_id']}"
+
+
+def merge_pending_search(results, pending, query, limit, key):
+    """Tin nhắn chưa ghi có chứa query (không phân biệt hoa thường) được xếp trước, mới nhất trước"""
+    needle = query.strip().casefold()
+    seen = {key(doc) for doc in results}
+    matches = [
+        doc for doc in reversed(pending)
+        if key(doc) not in seen and (needle in (doc.get("user_message") or "").casefold()
+                                     or needle in (doc.get("assistant_response") or "").casefold())
+    ]
+    return (matches + list(results))[:limit]
+
+
+def merge_pending_conversations(conversations, pending):
+    """Cộng tin nhắn chưa ghi vào danh sách cuộc trò chuyện (số tin nhắn, lần hoạt động cuối, cuộc trò chuyện mới).
+
+    Bản tóm tắt không lọc trùng được nên pending ở đây lấy SAU khi đọc database (tin nhắn vừa ghi xong không bị cộng hai lần)."""
+    if not pending:
+        return conversations
+    by_id = {conv["id"]: conv for conv in conversations}
+    for doc in pending:
+        conv = by_id.get(doc["conversation_id"])
+        if conv is None:
+            conv = by_id[doc["conversation_id"]] = {
+                "id": doc["conversation_id"],
+                "title": (doc.get("user_message") or "")[:40],
+                "last_activity": doc["timestamp"],
+                "message_count": 0
+            }
+        conv["message_count"] += 1
+        conv["last_activity"] = max(conv["last_activity"] or doc["timestamp"], doc["timestamp"])
+    return sorted(by_id.values(), key=lambda conv: conv["last_activity"] or datetime.min, reverse=True)
+
+
+def create_storage(conf=None):
+    # Chọn backend lưu trữ theo STORAGE_BACKEND trong config.py
+    conf = conf or config.get_config()
+    backend = conf.get("storage_backend", "mongo")
+
+    if backend == "sqlite":
+        from core.database_sqlite import SQLiteManager
+        return SQLiteManager(conf.get("sqlite_path", "chat_history.db"))
+    if backend == "mongo":
+        from core.database_utils import MongoDBManager
+        return MongoDBManager()
+    raise ValueError(f"STORAGE_BACKEND không hợp lệ: {backend}")
@@ -0,0 +1,38 @@
+ # Đếm số token bằng tokenizer thật của model GGUF
+ # Dùng để xếp lịch sử hội thoại vừa với cửa sổ ngữ cảnh N_CTX
+import threading
+
+
+class TokenCounter:
+    # Nếu truyền sẵn đối tượng Llama thì dùng luôn tokenizer của nó,
+    # nếu không thì tải model ở chế độ vocab_only (chỉ bảng từ vựng, không tải trọng số)
+
+    def __init__(self, model_path=None, llama=None):
+        self._llama = llama
+        self._lock = threading.Lock()
+        # Bảng từ vựng chỉ được tải ở lần đếm đầu tiên để không làm chậm lúc khởi động
+        self._model_path = model_path if llama is None else None
+
+    def _load_vocab(self):
+        # Gọi khi đang giữ lock
+        model_path, self._model_path = self._model_path, None
+        try:
+            from llama_cpp import Llama
+            self._llama = Llama(model_path=model_path, vocab_only=True, verbose=False)
+        except Exception as e:
+            print(f"Không tải được tokenizer, dùng ước lượng số token: {e}")
+
+    def count(self, text):
+        # Số token của một đoạn text (không tính token BOS)
+        if not text:
+            return 0
+        if self._model_path:
+            with self._lock:
+                if self._model_path:
+                    self._load_vocab()
+        if self._llama is None:
+            # Ước lượng thô khi không có tokenizer: khoảng 4 ký tự một token
+            return len(text) // 4 + 1
+        with self._lock:
+            # special=True: đếm token đặc biệt của chat template đúng như khi tokenize prompt
+            return len(self._llama.tokenize(text.encode("utf-8"), add_bos=False, special=True))
@@ -1,11 +1,12 @@
  # Các hàm tiện ích dùng chung cho ứng dụng chat
  # Bao gồm cấu hình ghi log và lưu lịch sử hội thoại ra file
 import os
-import json
 from datetime import datetime
 from typing import Dict, Any, List
 import logging
 
+from core.log_sink import get_log_sink
+
 
 def setup_logging(log_dir="logs"):
     # Thiết lập cấu hình ghi log cơ bản ra file và ra màn hình
@@ -23,21 +24,18 @@ def setup_logging(log_dir="logs"):
 
 
 def save_chat_log(user_message, assistant_message, log_dir="logs"):
-    # Lưu một cặp câu hỏi/tra lời vào file log dạng JSON dòng
-    os.makedirs(log_dir, exist_ok=True)
-    log_file = os.path.join(log_dir, f"chat_{datetime.now().strftime('%Y-%m-%d')}.jsonl")
-    
-    log_entry = {
+    # Lưu một cặp câu hỏi/tra lời vào file log dạng JSON dòng (logs/chat_<ngày>.jsonl)
+    # Chỉ đưa vào hàng đợi của luồng ghi nền, không chờ ghi đĩa
+    get_log_sink(log_dir, "chat").write({
         "timestamp": datetime.now().isoformat(),
         "user": user_message,
         "assistant": assistant_message
-    }
-    
-    try:
-        with open(log_file, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False) + '\n')
-    except Exception as e:
-        logging.error(f"Lỗi lưu log: {e}")
+    })
+
+
+def save_trace_log(trace, log_dir="logs"):
+    # Lưu trace thời gian các bước của một request (dict) vào logs/trace_<ngày>.jsonl, ghi nền như save_chat_log
+    get_log_sink(log_dir, "trace").write(dict(trace, timestamp=datetime.now().isoformat()))
 
 
  # Hàm validate_config cũ đã được chuyển sang xử lý trong config.py
@@ -0,0 +1,309 @@
+ # Nhóm tiến trình worker, mỗi tiến trình tự tải model GGUF và sinh text độc lập
+ # Web tier gửi prompt sang worker qua pipe stdin/stdout (mỗi dòng một message JSON)
+ # Model được llama.cpp mmap từ cùng một file nên page cache chỉ giữ một bản trọng số
+import os
+import sys
+import json
+import time
+import zlib
+import queue
+import threading
+import subprocess
+
+import config
+
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _WorkerHandle:
+    # Phía tiến trình chính: quản lý một tiến trình worker và pipe giao tiếp với nó
+
+    def __init__(self, worker_id, n_threads, model_path):
+        self.worker_id = worker_id
+        self.n_threads = n_threads
+        self.model_path = model_path
+        self.process = None
+        self.busy = False
+        self.restarts = 0
+        self.served = 0
+
+    def start(self):
+        # Khởi chạy tiến trình worker và chờ nó báo đã tải xong model
+        env = os.environ.copy()
+        env["PYTHONPATH"] = PROJECT_ROOT + os.pathsep + env.get("PYTHONPATH", "")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "core.worker_pool",
+             "--worker-id", str(self.worker_id), "--n-threads", str(self.n_threads),
+             "--model-path", self.model_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            cwd=os.getcwd(), env=env
+        )
+        message = self.recv()
+        if message is None or message.get("type") != "ready":
+            error = (message or {}).get("msg", "worker thoát khi đang tải model")
+            self.stop()
+            raise RuntimeError(f"Worker {self.worker_id} lỗi khi khởi động: {error}")
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def send(self, message):
+        line = json.dumps(message, ensure_ascii=False) + "\n"
+        self.process.stdin.write(line.encode("utf-8"))
+        self.process.stdin.flush()
+
+    def recv(self):
+        # Đọc một message từ worker, trả về None nếu worker đã chết (EOF)
+        line = self.process.stdout.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def stop(self, timeout=5):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout)
+        except Exception:
+            self.process.kill()
+
+
+class ModelWorkerPool:
+    # Nhóm N tiến trình model, có cùng giao diện generate/get_config như ModelWrapper
+    # Mỗi cuộc trò chuyện được ưu tiên định tuyến về cùng một worker (giữ được cache của worker đó)
+
+    def __init__(self, num_workers, n_threads=None, model_path=None):
+        self.config = config.get_config()
+        if model_path:
+            self.config['model_path'] = model_path
+        self.num_workers = max(1, num_workers)
+
+        # Chia đều tổng số luồng CPU cho các worker, mỗi worker ít nhất 1 luồng
+        total_threads = n_threads or self.config.get('n_threads', 4)
+        self.threads_per_worker = max(1, total_threads // self.num_workers)
+
+        self._cond = threading.Condition()
+        self._closed = False
+        self._workers = [
+            _WorkerHandle(i, self.threads_per_worker, self.config['model_path']) for i in range(self.num_workers)
+        ]
+
+        print(f"Đang khởi động {self.num_workers} worker, mỗi worker {self.threads_per_worker} luồng...")
+        for worker in self._workers:
+            worker.start()
+
+        # Luồng giám sát tự khởi động lại worker bị crash
+        self._monitor = threading.Thread(target=self._monitor_loop, name="worker-pool-monitor", daemon=True)
+        self._monitor.start()
+
+    def _preferred_index(self, conv_id):
+        # Băm ổn định conv_id để cùng cuộc trò chuyện luôn về cùng worker
+        if not conv_id:
+            return None
+        return zlib.crc32(conv_id.encode("utf-8")) % self.num_workers
+
+    def _acquire(self, conv_id):
+        # Chọn worker: ưu tiên worker của cuộc trò chuyện nếu đang rảnh,
+        # nếu không thì lấy worker rảnh bất kỳ, chờ khi tất cả đều bận
+        preferred = self._preferred_index(conv_id)
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Worker pool đã đóng")
+                candidates = [w for w in self._workers if not w.busy and w.is_alive()]
+                if candidates:
+                    worker = next((w for w in candidates if w.worker_id == preferred), candidates[0])
+                    worker.busy = True
+                    return worker
+                self._cond.wait(timeout=1.0)
+
+    def _release(self, worker):
+        with self._cond:
+            worker.busy = False
+            worker.served += 1
+            self._cond.notify_all()
+
+    def generate(self, prompt, max_tokens=None, temperature=None, top_p=None, stream=None, conv_id=None,
+                 cancel=None, trace=None, seed=None, grammar=None, json_schema=None):
+        # Gửi prompt sang một worker, giao diện giống ModelWrapper.generate
+        # cancel: threading.Event, khi được đặt thì worker được báo dừng sinh qua pipe
+        # trace: RequestTrace, nhận các bước worker đo được (gửi kèm message "done")
+        params = {
+            "max_tokens": max_tokens or self.config.get('max_tokens', 256),
+            "temperature": temperature if temperature is not None else self.config.get('temperature', 0.7),
+            "top_p": top_p or self.config.get('top_p', 0.9),
+            "conv_id": conv_id,
+            "seed": seed,
+            # Grammar gửi dạng văn bản, mỗi worker biên dịch và cache trong tiến trình của mình
+            "grammar": grammar,
+            "json_schema": json_schema,
+        }
+        stream = stream if stream is not None else self.config.get('stream', False)
+        if stream:
+            return self._generate_stream(prompt, params, cancel, trace)
+        return "".join(self._generate_stream(prompt, params, cancel, trace)).strip()
+
+    def _generate_stream(self, prompt, params, cancel=None, trace=None):
+        worker = self._acquire(params.get("conv_id"))
+        finished = False
+        try:
+            try:
+                worker.send({"op": "generate", "prompt": prompt, "params": params})
+            except OSError:
+                finished = True
+                raise RuntimeError(f"Worker {worker.worker_id} đã dừng đột ngột")
+
+            while True:
+                message = worker.recv()
+                if message is None:
+                    finished = True
+                    raise RuntimeError(f"Worker {worker.worker_id} đã dừng đột ngột")
+                if message["type"] == "token":
+                    if cancel is not None and cancel.is_set():
+                        return
+                    yield message["text"]
+                elif message["type"] == "done":
+                    finished = True
+                    if trace is not None and message.get("trace"):
+                        trace.update(message["trace"])
+                    return
+                elif message["type"] == "error":
+                    finished = True
+                    raise RuntimeError(message["msg"])
+        finally:
+            # Bên gọi dừng đọc giữa chừng hoặc request bị hủy: báo worker dừng sinh,
+            # rồi đọc bỏ phần còn lại để pipe sạch cho request sau
+            if not finished:
+                try:
+                    worker.send({"op": "cancel"})
+                except OSError:
+                    finished = True
+            while not finished:
+                message = worker.recv()
+                finished = message is None or message["type"] in ("done", "error")
+                if finished and trace is not None and message and message.get("trace"):
+                    trace.update(message["trace"])
+            self._release(worker)
+
+    def _monitor_loop(self):
+        while not self._closed:
+            time.sleep(1.0)
+            for worker in self._workers:
+                if self._closed:
+                    return
+                with self._cond:
+                    # Worker đang bận sẽ tự phát hiện EOF và được trả về trạng thái rảnh
+                    if worker.busy or worker.is_alive():
+                        continue
+                    worker.busy = True
+                print(f"Worker {worker.worker_id} đã dừng, đang khởi động lại...")
+                try:
+                    worker.start()
+                    worker.restarts += 1
+                except Exception as e:
+                    print(f"Lỗi khởi động lại worker {worker.worker_id}: {e}")
+                finally:
+                    with self._cond:
+                        worker.busy = False
+                        self._cond.notify_all()
+
+    def stats(self):
+        # Trạng thái từng worker (pid, bận/rảnh, số lần khởi động lại)
+        with self._cond:
+            return [{
+                "worker_id": w.worker_id,
+                "pid": w.process.pid if w.process else None,
+                "alive": w.is_alive(),
+                "busy": w.busy,
+                "served": w.served,
+                "restarts": w.restarts,
+                "n_threads": w.n_threads,
+            } for w in self._workers]
+
+    def get_config(self):
+        return self.config.copy()
+
+    def update_config(self, new_config):
+        # Tham số sinh văn bản được gửi kèm mỗi request nên chỉ cần cập nhật ở tiến trình chính
+        self.config.update(new_config)
+
+    def is_ready(self):
+        return any(w.is_alive() for w in self._workers)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.stop()
+
+
+def _worker_main(n_threads, model_path=None):
+    # Vòng lặp trong tiến trình worker: nhận prompt từ stdin, trả token ra stdout
+    # Giữ stdout gốc cho giao thức, mọi print/log khác (kể cả của llama.cpp) chuyển sang stderr
+    protocol_out = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def send(message):
+        protocol_out.write(json.dumps(message, ensure_ascii=False) + "\n")
+        protocol_out.flush()
+
+    try:
+        from core.model_llama_cpp import ModelWrapper
+        from core.metrics import RequestTrace
+        overrides = {"n_threads": n_threads}
+        if model_path:
+            overrides["model_path"] = model_path
+        model_wrapper = ModelWrapper(overrides=overrides)
+        if model_wrapper.config.get("model_warmup"):
+            model_wrapper.warm_up()
+    except Exception as e:
+        send({"type": "error", "msg": str(e)})
+        return
+
+    send({"type": "ready", "pid": os.getpid()})
+
+    # Luồng đọc stdin riêng để nhận được lệnh "cancel" trong lúc đang sinh
+    # Tiến trình chính chỉ gửi một request mỗi lần nên "cancel" luôn áp dụng cho request generate gần nhất
+    requests = queue.Queue()
+
+    def read_requests():
+        latest = None
+        for line in sys.stdin:
+            request = json.loads(line)
+            if request.get("op") == "cancel":
+                if latest is not None:
+                    latest.set()
+            elif request.get("op") == "generate":
+                latest = threading.Event()
+                requests.put((request, latest))
+        requests.put(None)  # Tiến trình chính đóng pipe: thoát
+
+    threading.Thread(target=read_requests, name="worker-stdin", daemon=True).start()
+
+    while True:
+        item = requests.get()
+        if item is None:
+            return
+        request, cancel = item
+        trace = RequestTrace()
+        try:
+            for delta in model_wrapper.generate(request["prompt"], stream=True, cancel=cancel, trace=trace,
+                                                **request["params"]):
+                send({"type": "token", "text": delta})
+            send({"type": "done", "trace": trace.to_dict()})
+        except Exception as e:
+            send({"type": "error", "msg": f"Lỗi khi sinh text: {e}"})
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Model worker process')
+    parser.add_argument('--worker-id', type=int, default=0)
+    parser.add_argument('--n-threads', type=int, default=1)
+    parser.add_argument('--model-path', default=None)
+    args = parser.parse_args()
+
+    _worker_main(args.n_threads, args.model_path)
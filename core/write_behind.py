@@ -0,0 +1,208 @@
+ # Bộ đệm ghi nền (write-behind) cho lịch sử chat
+ # Luồng request chỉ đưa document vào hàng đợi, một luồng nền gom lại và ghi theo lô
+ # Nếu database không ghi được, document được ghi tạm ra file spill và ghi lại khi kết nối trở lại
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+
+
+_STOP = object()
+
+
+class _FlushMarker:
+    # Yêu cầu luồng nền ghi ngay phần đang gom và báo lại khi xong
+    def __init__(self):
+        self.done = threading.Event()
+
+
+def _encode(value):
+    # datetime được giữ nguyên kiểu khi đọc lại, các kiểu khác (ví dụ ObjectId) lưu dạng chuỗi
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    return str(value)
+
+
+def _decode(obj):
+    if set(obj) == {"$date"}:
+        return datetime.fromisoformat(obj["$date"])
+    return obj
+
+
+class WriteBehindBuffer:
+    # flush_fn(docs): hàm ghi một lô document, ném exception nếu ghi thất bại
+
+    def __init__(self, flush_fn, batch_size=50, flush_interval=1.0, max_pending=1000,
+                 spill_path=None, put_timeout=0.5, retry_interval=10.0, name="write-behind"):
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.put_timeout = put_timeout
+        self.retry_interval = retry_interval
+
+        # Hàng đợi có giới hạn: khi đầy, bên ghi bị chặn tối đa put_timeout giây (backpressure)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._spill_lock = threading.Lock()
+        self._last_retry = 0.0
+        self._closed = False
+        # Document đã nhận nhưng chưa ghi xong (kể cả lô đang ghi): bên đọc ghép vào kết quả đọc từ database
+        # để đọc được dữ liệu vừa ghi mà không phải chờ luồng nền
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+        self.written = 0
+        self.spilled = 0
+        self.failed_flushes = 0
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, doc):
+        # Đưa một document vào hàng đợi ghi, không chờ database
+        if self._closed:
+            self._spill([doc])
+            return
+        with self._pending_lock:
+            self._pending[id(doc)] = doc
+        try:
+            self._queue.put(doc, timeout=self.put_timeout)
+        except queue.Full:
+            # Database không theo kịp: ghi tạm ra file để không làm chậm request
+            self._forget([doc])
+            self._spill([doc])
+
+    def pending(self, **fields):
+        # Bản sao các document chưa ghi xong có đúng các trường đã cho (theo thứ tự nhận), không chờ database
+        with self._pending_lock:
+            docs = list(self._pending.values())
+        return [dict(doc) for doc in docs if all(doc.get(k) == v for k, v in fields.items())]
+
+    def _forget(self, docs):
+        with self._pending_lock:
+            for doc in docs:
+                self._pending.pop(id(doc), None)
+
+    def flush(self, timeout=5.0):
+        # Chờ các document đang gom được ghi xong (đảm bảo đọc được dữ liệu vừa ghi)
+        # Trả về False nếu hết timeout (kể cả khi hàng đợi đầy, không chèn được yêu cầu flush)
+        if self._closed or not self._thread.is_alive():
+            return False
+        deadline = time.monotonic() + timeout
+        marker = _FlushMarker()
+        try:
+            self._queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.done.wait(max(0.0, deadline - time.monotonic()))
+
+    def close(self, timeout=10.0):
+        # Ghi nốt mọi thứ còn trong hàng đợi rồi dừng luồng nền
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            wait = self.retry_interval if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=wait)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._write(batch)
+                return
+
+            if isinstance(item, _FlushMarker):
+                self._write(batch)
+                batch, deadline = [], None
+                item.done.set()
+                continue
+
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if len(batch) >= self.batch_size or (deadline is not None and time.monotonic() >= deadline):
+                self._write(batch)
+                batch, deadline = [], None
+            elif not batch:
+                # Rảnh: thử ghi lại phần đã spill ra file
+                self._replay_spill()
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            self.flush_fn(batch)
+            self.written += len(batch)
+        except Exception as e:
+            self.failed_flushes += 1
+            print(f"Lỗi ghi lô {len(batch)} tin nhắn, lưu tạm ra file: {e}")
+            self._spill(batch)
+            return
+        finally:
+            # Chỉ bỏ khỏi danh sách chờ sau khi đã ghi xong (hoặc đã lưu tạm ra file)
+            self._forget(batch)
+        self._replay_spill()
+
+    def _spill(self, docs):
+        if not self.spill_path:
+            print(f"Bỏ qua {len(docs)} tin nhắn do không ghi được database")
+            return
+        with self._spill_lock:
+            os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for doc in docs:
+                    f.write(json.dumps(doc, ensure_ascii=False, default=_encode) + "\n")
+            self.spilled += len(docs)
+
+    def _replay_spill(self):
+        # Ghi lại các document trong file spill, giới hạn tần suất thử khi database còn lỗi
+        if not self.spill_path:
+            return
+        replay_path = self.spill_path + ".replay"
+        if not os.path.exists(self.spill_path) and not os.path.exists(replay_path):
+            return
+        if time.monotonic() - self._last_retry < self.retry_interval:
+            return
+        self._last_retry = time.monotonic()
+
+        with self._spill_lock:
+            # File .replay còn sót từ lần trước thì ghi nó trước, phần spill mới để lần sau
+            if not os.path.exists(replay_path):
+                os.replace(self.spill_path, replay_path)
+
+        with open(replay_path, "r", encoding="utf-8") as f:
+            docs = [json.loads(line, object_hook=_decode) for line in f if line.strip()]
+        for i in range(0, len(docs), self.batch_size):
+            try:
+                self.flush_fn(docs[i:i + self.batch_size])
+            except Exception as e:
+                # Chỉ giữ lại phần chưa ghi được để lần sau không ghi trùng
+                print(f"Chưa ghi lại được dữ liệu tạm: {e}")
+                with open(replay_path, "w", encoding="utf-8") as f:
+                    for doc in docs[i:]:
+                        f.write(json.dumps(doc, ensure_ascii=False, default=_encode) + "\n")
+                return
+        os.remove(replay_path)
+        self.written += len(docs)
+        print(f"Đã ghi lại {len(docs)} tin nhắn từ file tạm")
+
+    def stats(self):
+        return {
+            "pending": self._queue.qsize(),
+            "written": self.written,
+            "spilled": self.spilled,
+            "failed_flushes": self.failed_flushes,
+        }
@@ -0,0 +1,162 @@
+ # Chạy web app cho môi trường thật, thay cho server phát triển của Flask (python web_app.py)
+ #   python serve.py                                       gunicorn (Linux/macOS) hoặc waitress (Windows)
+ #   python serve.py --server gunicorn --workers 2 --threads 8
+ #   python serve.py --server gunicorn --asgi --workers 2  stream bất đồng bộ qua web_asgi.py
+ #   python serve.py --server uvicorn                      một tiến trình ASGI
+ # Giá trị mặc định lấy từ các tham số SERVER_* trong config.py
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import _thread
+
+import config
+from core.model_llama_cpp import prefetch_file
+from core.log_sink import compress_leftover_logs
+
+
+def _prefetch_models():
+    # Nạp trước file model mặc định vào page cache ở tiến trình chính (trước khi fork)
+    # Các worker mở cùng file bằng mmap nên dùng chung các trang này, không mỗi worker đọc lại từ đĩa
+    if config.USE_MMAP:
+        path = config.MODELS.get(config.DEFAULT_MODEL, config.MODEL_PATH)
+        print(f"Nạp trước model vào page cache: {path}")
+        prefetch_file(path)
+
+
+def _check_multi_process(workers):
+    if workers > 1 and config.SESSION_BACKEND == "memory":
+        print("Cảnh báo: SESSION_BACKEND = 'memory' với nhiều worker, mỗi worker giữ trạng thái chat riêng; "
+              "nên dùng SESSION_BACKEND = 'sqlite'")
+
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    # Chia số luồng CPU của llama.cpp cho các worker để không tranh nhau lõi
+    threads_per_worker = max(1, config.N_THREADS // args.workers)
+
+    def post_fork(server, worker):
+        # Chạy trong worker vừa fork, trước khi import web_app (model và các luồng nền được tạo sau fork)
+        config.N_THREADS = threads_per_worker
+
+    def worker_exit(server, worker):
+        # gunicorn đã chờ các request đang mở; xử lý nốt hàng đợi rồi giải phóng model
+        web_app = sys.modules.get("web_app")
+        if web_app is not None:
+            web_app.shutdown(args.graceful_timeout)
+
+    options = {
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers,
+        # Không preload: luồng nền và model không sống sót qua fork nên phải được tạo trong từng worker
+        "preload_app": False,
+        "graceful_timeout": args.graceful_timeout,
+        # Request chờ model lâu hơn mặc định 30s của gunicorn
+        "timeout": max(config.QUEUE_TIMEOUT, args.graceful_timeout) + 30,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit,
+    }
+    if args.asgi:
+        options["worker_class"] = "uvicorn.workers.UvicornWorker"
+        app_uri = "web_asgi:app"
+    else:
+        options["worker_class"] = "gthread"
+        options["threads"] = args.threads
+        app_uri = "web_app:app"
+
+    class ChatApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            module, attr = app_uri.split(":")
+            return getattr(__import__(module), attr)
+
+    _prefetch_models()
+    _check_multi_process(args.workers)
+    ChatApplication().run()
+
+
+def run_waitress(args):
+    from waitress import create_server
+    import web_app
+
+    if args.workers > 1:
+        print("Waitress chạy một tiến trình, bỏ qua --workers (tăng --threads để phục vụ nhiều request hơn)")
+
+    server = create_server(web_app.app, host=args.host, port=args.port, threads=args.threads)
+
+    def drain():
+        # Ngừng nhận câu hỏi mới, chờ các request đang chạy (kể cả stream) xong rồi mới đóng server
+        web_app.begin_drain()
+        deadline = time.monotonic() + args.graceful_timeout
+        while server.task_dispatcher.active_count and time.monotonic() < deadline:
+            time.sleep(0.2)
+        web_app.shutdown(max(1.0, deadline - time.monotonic()))
+        _thread.interrupt_main()
+
+    stopping = threading.Event()
+
+    def on_signal(signum, frame):
+        if stopping.is_set():
+            # Tín hiệu lần hai (hoặc drain đã xong và gọi interrupt_main): thoát ngay
+            raise KeyboardInterrupt
+        stopping.set()
+        print("Nhận tín hiệu dừng, đang tắt server (Ctrl+C lần nữa để thoát ngay)...")
+        threading.Thread(target=drain, name="drain", daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    print(f"Waitress đang lắng nghe tại http://{args.host}:{args.port} ({args.threads} luồng)")
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+def run_uvicorn(args):
+    import uvicorn
+
+    if args.workers > 1:
+        print("Uvicorn chạy một tiến trình; dùng --server gunicorn --asgi để chạy nhiều worker")
+
+    uvicorn.run(
+        "web_asgi:app",
+        host=args.host,
+        port=args.port,
+        timeout_graceful_shutdown=args.graceful_timeout,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chạy web app với WSGI/ASGI server")
+    parser.add_argument("--server", choices=["gunicorn", "waitress", "uvicorn"],
+                        default="waitress" if os.name == "nt" else "gunicorn")
+    parser.add_argument("--host", default=config.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=config.SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=config.SERVER_WORKERS, help="Số tiến trình (gunicorn)")
+    parser.add_argument("--threads", type=int, default=config.SERVER_THREADS, help="Số luồng mỗi tiến trình")
+    parser.add_argument("--graceful-timeout", type=int, default=config.SERVER_GRACEFUL_TIMEOUT,
+                        help="Số giây chờ các câu trả lời đang sinh khi tắt")
+    parser.add_argument("--asgi", action="store_true", help="Dùng web_asgi.py với worker uvicorn (gunicorn)")
+    args = parser.parse_args()
+
+    # Dọn log của các lần chạy trước một lần ở tiến trình chính, không để các worker tranh nhau
+    compress_leftover_logs(config.LOG_DIR)
+
+    if args.server == "gunicorn":
+        run_gunicorn(args)
+    elif args.server == "waitress":
+        run_waitress(args)
+    else:
+        run_uvicorn(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,25 @@
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
 import threading
+import queue
 from datetime import datetime
 import uuid # Cần thiết cho việc tạo ID phiên
 import time # Cần thiết cho việc tạo ID phiên
+import getpass
 
 import config
 from core.model_llama_cpp import ModelWrapper
-from core.conversation import ConversationManager
+from core.conversation import ConversationManager, make_summarizer
+from core.tokenizer import TokenCounter
 from core.utils import save_chat_log, get_model_info
-from core.database_utils import MongoDBManager
+from core.storage import create_storage
+
+
+# Nhịp chèn text stream vào khung chat (ms): các token tới trong khoảng này được chèn một lần
+STREAM_FLUSH_MS = 50
+
+# Đánh dấu kết thúc một câu trả lời trong hàng đợi stream
+_STREAM_END = object()
 
 
 class SimpleChatGUI:
@@ -77,16 +87,31 @@ class SimpleChatGUI:
         self.model_wrapper = None
         self.conversation_manager = None
         self.is_processing = False
+        self.cancel_event = threading.Event() # Được đặt khi bấm nút Dừng, model dừng ở token kế tiếp
+
+        # Luồng sinh text đưa (stream_id, đoạn text) vào hàng đợi, luồng giao diện lấy ra theo nhịp STREAM_FLUSH_MS
+        self._stream_queue = queue.Queue()
+        self._stream_id = 0
+        self._active_stream = None  # stream_id của câu trả lời đang hiển thị, None nếu không có
+        self._stream_has_text = False
+        self._drain_scheduled = False
+
+        # Các nút ở Sidebar: conv_id -> (nút, (tiêu đề, đang mở)), giữ lại giữa các lần cập nhật
+        self._conv_rows = {}
+        self._conv_order = []
+        self._conv_list = []
         
         # Biến trạng thái mới
         self.current_conv_id = str(uuid.uuid4()) # ID phiên hiện tại, tạo ID duy nhất
+        self.username = getpass.getuser() # Bản desktop dùng tên người dùng hệ điều hành làm chủ sở hữu lịch sử
+        self._next_before = None # Con trỏ trang tin nhắn cũ hơn của cuộc trò chuyện đang mở
         
-        # Khởi tạo MongoDB Manager
-        self.mongo_manager = None
+        # Khởi tạo backend lưu trữ (MongoDB hoặc SQLite theo config.py)
+        self.db_manager = None
         try:
-            self.mongo_manager = MongoDBManager()
-        except ConnectionError as e:
-            messagebox.showwarning("Cảnh báo Database", f"Không thể kết nối MongoDB. Lịch sử chat sẽ không được lưu vào DB. Lỗi: {e}")
+            self.db_manager = create_storage(self.config)
+        except Exception as e:
+            messagebox.showwarning("Cảnh báo Database", f"Không thể kết nối database. Lịch sử chat sẽ không được lưu vào DB. Lỗi: {e}")
 
         # Tạo cửa sổ dark theme đơn giản
         self.root = tk.Tk()
@@ -157,6 +182,8 @@ class SimpleChatGUI:
 
         self.conv_list_frame = tk.Frame(self.sidebar_canvas, bg='#252525')
         self.sidebar_canvas.create_window((0, 0), window=self.conv_list_frame, anchor="nw", width=260)
+        # Cập nhật vùng cuộn khi danh sách đổi kích thước (thêm/bớt nút), không cần ép layout ngay
+        self.conv_list_frame.bind('<Configure>', lambda e: self.sidebar_canvas.configure(scrollregion = self.sidebar_canvas.bbox("all")))
         
         # Button tạo cuộc trò chuyện mới với icon
         new_chat_btn = tk.Button(sidebar, text="➕ Cuộc trò chuyện mới", command=self._start_new_conversation,
@@ -176,6 +203,9 @@ class SimpleChatGUI:
             selectforeground='#ffffff'
         )
         self.chat_text.pack(fill=tk.BOTH, expand=True)
+        for sequence in ('<MouseWheel>', '<Button-4>', '<ButtonRelease-1>'):
+            self.chat_text.bind(sequence, lambda e: self.root.after(50, self._on_chat_scroll), add='+')
+            self.chat_text.vbar.bind(sequence, lambda e: self.root.after(50, self._on_chat_scroll), add='+')
         
         # Configure text tags đơn giản
         self.chat_text.tag_configure("user", foreground='#e0e0e0', font=("Segoe UI", 11))
@@ -207,6 +237,13 @@ class SimpleChatGUI:
                   font=("Segoe UI", 11), cursor='hand2', bd=0,
                   activebackground='#505050', activeforeground='#ffffff')
         send_btn.pack(side=tk.RIGHT, padx=(0, 5))
+
+        # Nút dừng câu trả lời đang sinh
+        stop_btn = tk.Button(input_frame, text="■ Dừng", command=self._on_stop,
+                  bg='#404040', fg='#e0e0e0', relief='flat', padx=15, pady=12,
+                  font=("Segoe UI", 11), cursor='hand2', bd=0,
+                  activebackground='#505050', activeforeground='#ffffff')
+        stop_btn.pack(side=tk.RIGHT, padx=(0, 5))
         
         # Status bar tối
         status_frame = tk.Frame(self.root, bg='#1a1a1a', height=30)
@@ -226,7 +263,11 @@ class SimpleChatGUI:
 
     def _start_new_conversation(self):
         """Bắt đầu một cuộc trò chuyện mới."""
+        if self.is_processing:
+            self.cancel_event.set() # Câu trả lời của cuộc trò chuyện cũ không cần sinh tiếp
+        self._active_stream = None # Bỏ các đoạn text còn lại của câu trả lời cũ
         self.current_conv_id = str(uuid.uuid4()) # Tạo ID mới
+        self._next_before = None
         self.conversation_manager.clear_history() # Xóa bộ nhớ đệm
         self._clear_chat_display() # Xóa giao diện
         self.status_var.set("🟢 Bắt đầu cuộc trò chuyện mới")
@@ -234,92 +275,129 @@ class SimpleChatGUI:
         self._load_conversation_list() # Cập nhật danh sách
 
     def _load_conversation(self, conv_id):
-        """Tải lịch sử của một cuộc trò chuyện cũ."""
+        """Tải lịch sử của một cuộc trò chuyện cũ (chỉ trang mới nhất, trang cũ hơn tải khi cuộn lên)."""
         if self.is_processing or conv_id == self.current_conv_id:
             return
             
         self.current_conv_id = conv_id
+        self._next_before = None
         self.conversation_manager.clear_history()
         self._clear_chat_display()
+        if self.model_wrapper:
+            # Lượt tiếp theo nạp lại trạng thái KV từ đĩa thay vì đánh giá lại cả lịch sử: đọc trước file đó
+            self.model_wrapper.prefetch_state(conv_id)
         
-        if not self.mongo_manager:
+        if not self.db_manager:
             return
             
-        messages = self.mongo_manager.get_messages_by_conversation_id(conv_id)
+        messages, self._next_before = self.db_manager.get_messages_page(
+            conv_id, self.username, limit=self.config.get('load_chat_page_size', 10))
         
         # Tải lại lịch sử vào bộ nhớ đệm (dùng cho ConversationManager)
-        # và hiển thị ra giao diện
+        for msg in messages:
+            self.conversation_manager.add_user_message(msg.get("user_message", ""))
+            self.conversation_manager.add_assistant_message(msg.get("assistant_response", ""))
+
+        # Hiển thị ra giao diện
         self.chat_text.config(state=tk.NORMAL)
+        self._insert_history(messages, tk.END)
+        self.chat_text.config(state=tk.DISABLED)
+        self.chat_text.see(tk.END)
+        self.status_var.set(f"📂 Đã tải cuộc trò chuyện: {conv_id[:8]}...")
+        self._render_conversation_list(self._conv_list) # Chỉ đổi kiểu nút active, không cần đọc lại database
+
+    def _insert_history(self, messages, index):
+        # Chèn các tin nhắn lịch sử vào khung chat tại vị trí index (tk.END hoặc đầu khung)
+        # Dùng mark có gravity RIGHT để các đoạn chèn liên tiếp giữ đúng thứ tự
+        self.chat_text.mark_set("history_insert", index)
+        self.chat_text.mark_gravity("history_insert", tk.RIGHT)
         for msg in messages:
             user_msg = msg.get("user_message", "")
             ai_resp = msg.get("assistant_response", "")
             timestamp = msg.get("timestamp", datetime.now()).strftime("%H:%M")
             
-            # Tải lại lịch sử cho model context
-            self.conversation_manager.add_user_message(user_msg)
-            self.conversation_manager.add_assistant_message(ai_resp)
-            
-            # Hiển thị đơn giản
-            self.chat_text.insert(tk.END, f"[{timestamp}] ", "timestamp")
-            self.chat_text.insert(tk.END, "Bạn: ", "user_label")
-            self.chat_text.insert(tk.END, f"{user_msg}\n\n", "user")
-            
-            self.chat_text.insert(tk.END, f"[{timestamp}] ", "timestamp")
-            self.chat_text.insert(tk.END, "AI: ", "ai_label")
-            self.chat_text.insert(tk.END, f"{ai_resp}\n\n", "ai")
+            self.chat_text.insert("history_insert", f"[{timestamp}] ", "timestamp")
+            self.chat_text.insert("history_insert", "Bạn: ", "user_label")
+            self.chat_text.insert("history_insert", f"{user_msg}\n\n", "user")
             
+            self.chat_text.insert("history_insert", f"[{timestamp}] ", "timestamp")
+            self.chat_text.insert("history_insert", "AI: ", "ai_label")
+            self.chat_text.insert("history_insert", f"{ai_resp}\n\n", "ai")
+        self.chat_text.mark_unset("history_insert")
+
+    def _on_chat_scroll(self, event=None):
+        # Cuộn lên tới đầu khung chat thì tải thêm trang tin nhắn cũ hơn
+        if not self._next_before or not self.db_manager:
+            return
+        if self.chat_text.yview()[0] > 0.0:
+            return
+
+        messages, self._next_before = self.db_manager.get_messages_page(
+            self.current_conv_id, self.username, before=self._next_before,
+            limit=self.config.get('load_chat_page_size', 10))
+        if not messages:
+            return
+
+        # Giữ nguyên dòng đang xem sau khi chèn thêm nội dung phía trên
+        old_lines = int(self.chat_text.index("end-1c").split(".")[0])
+        self.chat_text.config(state=tk.NORMAL)
+        self._insert_history(messages, "1.0")
         self.chat_text.config(state=tk.DISABLED)
-        self.chat_text.see(tk.END)
-        self.status_var.set(f"📂 Đã tải cuộc trò chuyện: {conv_id[:8]}...")
-        self._load_conversation_list() # Cập nhật trạng thái active button
+        added_lines = int(self.chat_text.index("end-1c").split(".")[0]) - old_lines
+        self.chat_text.yview(f"{added_lines + 1}.0")
 
     def _load_conversation_list(self):
-        """Hiển thị danh sách cuộc trò chuyện ở Sidebar."""
-        if not self.mongo_manager:
+        """Đọc danh sách cuộc trò chuyện từ database rồi cập nhật Sidebar."""
+        if not self.db_manager:
             return
+        self._render_conversation_list(self.db_manager.get_conversation_list(self.username))
 
-        # Xóa các nút cũ
-        for widget in self.conv_list_frame.winfo_children():
-            widget.destroy()
+    def _render_conversation_list(self, conv_list):
+        """Cập nhật Sidebar theo danh sách mới: chỉ tạo, xóa hoặc đổi kiểu các nút có thay đổi."""
+        self._conv_list = conv_list
+        new_order = [conv['id'] for conv in conv_list]
+
+        # Xóa nút của các cuộc trò chuyện không còn trong danh sách
+        for conv_id in set(self._conv_rows) - set(new_order):
+            self._conv_rows.pop(conv_id)[0].destroy()
 
-        conv_list = self.mongo_manager.get_conversation_list()
-        
         for conv in conv_list:
-            title = conv['title'].strip() or "Untitled Chat"
             conv_id = conv['id']
-            
+            title = conv['title'].strip() or "Untitled Chat"
             # Kiểm tra xem đây có phải là cuộc trò chuyện hiện tại không
             is_active = (conv_id == self.current_conv_id)
-            
-            # Tạo nút cho mỗi cuộc trò chuyện với icon
-            btn_bg = '#404040' if is_active else '#252525'  # Tối hơn khi active
-            btn_fg = '#e0e0e0' if is_active else '#b0b0b0'  # Sáng hơn khi active
-            btn_active_bg = '#505050'
-            
-            btn = tk.Button(self.conv_list_frame, 
-                            text=f"💬 {title}", 
-                            anchor="w", 
-                            relief='flat', 
-                            bg=btn_bg,
-                            activebackground=btn_active_bg,
-                            fg=btn_fg,
-                            font=("Segoe UI", 10) if is_active else ("Segoe UI", 10),
-                            wraplength=240, 
-                            justify=tk.LEFT,
-                            cursor='hand2',
-                            padx=12,
-                            pady=8,
-                            command=lambda id=conv_id: self._load_conversation(id),
-                            bd=0)
-            
-            if is_active:
-                btn.config(font=("Segoe UI", 10, "bold"))
-            
-            btn.pack(fill=tk.X, pady=2, padx=5)
-            
-        # Cập nhật scrollbar sau khi thêm nút
-        self.conv_list_frame.update_idletasks()
-        self.sidebar_canvas.config(scrollregion=self.sidebar_canvas.bbox("all"))
+            state = (title, is_active)
+
+            btn, old_state = self._conv_rows.get(conv_id, (None, None))
+            if btn is None:
+                btn = tk.Button(self.conv_list_frame, 
+                                anchor="w", 
+                                relief='flat', 
+                                activebackground='#505050',
+                                wraplength=240, 
+                                justify=tk.LEFT,
+                                cursor='hand2',
+                                padx=12,
+                                pady=8,
+                                command=lambda id=conv_id: self._load_conversation(id),
+                                bd=0)
+            if state != old_state:
+                btn.config(text=f"💬 {title}",
+                           bg='#404040' if is_active else '#252525',  # Tối hơn khi active
+                           fg='#e0e0e0' if is_active else '#b0b0b0',  # Sáng hơn khi active
+                           font=("Segoe UI", 10, "bold") if is_active else ("Segoe UI", 10))
+            self._conv_rows[conv_id] = (btn, state)
+
+        # Sắp lại thứ tự: chỉ pack lại các nút từ vị trí đầu tiên khác thứ tự cũ
+        # (thường chỉ là cuộc trò chuyện vừa có tin nhắn mới được đưa lên đầu)
+        first_diff = next((i for i, (old, new) in enumerate(zip(self._conv_order, new_order)) if old != new),
+                          min(len(self._conv_order), len(new_order)))
+        for conv_id in self._conv_order[first_diff:]:
+            if conv_id in self._conv_rows:
+                self._conv_rows[conv_id][0].pack_forget()
+        for conv_id in new_order[first_diff:]:
+            self._conv_rows[conv_id][0].pack(fill=tk.X, pady=2, padx=5)
+        self._conv_order = new_order
 
     def _clear_chat_display(self):
         """Chỉ xóa nội dung hiển thị trên khung chat."""
@@ -335,11 +413,11 @@ class SimpleChatGUI:
 
     def _clear_current_chat(self):
         """
-        Xóa TOÀN BỘ lịch sử chat khỏi MongoDB và reset giao diện.
+        Xóa TOÀN BỘ lịch sử chat khỏi database và reset giao diện.
         (Thực hiện hành vi XÓA TẤT CẢ)
         """
-        if not self.mongo_manager:
-            messagebox.showwarning("Cảnh báo", "Không có kết nối MongoDB. Không thể xóa lịch sử.")
+        if not self.db_manager:
+            messagebox.showwarning("Cảnh báo", "Không có kết nối database. Không thể xóa lịch sử.")
             return
 
         # Xác nhận với người dùng trước khi xóa vĩnh viễn
@@ -349,8 +427,8 @@ class SimpleChatGUI:
         )
         
         if confirmation:
-            # 1. Thực hiện Xóa TẤT CẢ khỏi MongoDB
-            self.mongo_manager.delete_all_conversations()
+            # 1. Thực hiện Xóa TẤT CẢ khỏi database
+            self.db_manager.delete_all_conversations(self.username)
             
             # 2. Xóa bộ nhớ đệm, giao diện và khởi tạo phiên mới
             # Hàm _start_new_conversation sẽ xử lý việc reset giao diện và cập nhật Sidebar
@@ -384,7 +462,19 @@ class SimpleChatGUI:
                     return
                 
                 self.model_wrapper = ModelWrapper()
-                self.conversation_manager = ConversationManager(self.config)
+                if self.config.get('model_warmup'):
+                    self.status_var.set("⏳ Đang làm nóng model...")
+                    self.model_wrapper.warm_up()
+                summarizer = None
+                if self.config.get('history_summarize'):
+                    summarizer = make_summarizer(lambda p, n: self.model_wrapper.generate(p, max_tokens=n),
+                                                 template=self.model_wrapper.chat_template)
+                self.conversation_manager = ConversationManager(
+                    self.config,
+                    token_counter=TokenCounter(llama=self.model_wrapper.model),
+                    summarizer=summarizer,
+                    template=self.model_wrapper.chat_template
+                )
                 
                 self.root.after(0, self._on_model_ready)
                 
@@ -410,8 +500,16 @@ class SimpleChatGUI:
         self.input_entry.delete(0, tk.END)
         self._add_message("user", user_input)
         
-        threading.Thread(target=self._process_message, args=(user_input,), daemon=True).start()
+        self.is_processing = True # Đặt ngay để Enter bấm liên tiếp không gửi hai lần
+        stream_id = self._begin_ai_stream()
+        threading.Thread(target=self._process_message, args=(user_input, stream_id), daemon=True).start()
     
+    def _on_stop(self):
+        # Dừng câu trả lời đang sinh (phần đã sinh vẫn được hiển thị)
+        if self.is_processing:
+            self.cancel_event.set()
+            self.status_var.set("⏹ Đang dừng...")
+
     def _add_message(self, sender, message):
         # add message to chat display đơn giản
         self.chat_text.config(state=tk.NORMAL)
@@ -429,36 +527,112 @@ class SimpleChatGUI:
         self.chat_text.config(state=tk.DISABLED)
         self.chat_text.see(tk.END)
 
-    def _process_message(self, user_input):
-        # process user message and get AI response
-        response = None
+    def _begin_ai_stream(self):
+        # Chèn nhãn "AI:" cho câu trả lời sắp sinh và đặt mark để các đoạn text stream được chèn tiếp vào đó
+        self._stream_id += 1
+        self._active_stream = self._stream_id
+        self._stream_has_text = False
+
+        self.chat_text.config(state=tk.NORMAL)
+        timestamp = datetime.now().strftime("%H:%M")
+        self.chat_text.insert(tk.END, f"[{timestamp}] ", "timestamp")
+        self.chat_text.insert(tk.END, "AI: ", "ai_label")
+        self.chat_text.mark_set("ai_stream", "end-1c")
+        self.chat_text.mark_gravity("ai_stream", tk.RIGHT)
+        self.chat_text.config(state=tk.DISABLED)
+        self.chat_text.see(tk.END)
+
+        self._schedule_drain()
+        return self._stream_id
+
+    def _schedule_drain(self):
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            self.root.after(STREAM_FLUSH_MS, self._drain_stream)
+
+    def _drain_stream(self):
+        # Gom mọi đoạn text đang chờ thành một lần chèn vào khung chat, thay vì một sự kiện Tk cho mỗi token
+        self._drain_scheduled = False
+        chunks, finished = [], False
+        while True:
+            try:
+                stream_id, item = self._stream_queue.get_nowait()
+            except queue.Empty:
+                break
+            if stream_id != self._active_stream:
+                continue  # Câu trả lời của cuộc trò chuyện đã rời đi
+            if item is _STREAM_END:
+                finished = True
+                break
+            chunks.append(item)
+
+        text = "".join(chunks)
+        if not self._stream_has_text:
+            text = text.lstrip()
+        if text or finished:
+            # Chỉ tự cuộn xuống khi người dùng đang xem cuối khung chat
+            at_bottom = self.chat_text.yview()[1] >= 0.999
+            self.chat_text.config(state=tk.NORMAL)
+            if text:
+                self.chat_text.insert("ai_stream", text, "ai")
+                self._stream_has_text = True
+            if finished:
+                self.chat_text.insert("ai_stream", "\n\n", "ai")
+                self.chat_text.mark_unset("ai_stream")
+                self._active_stream = None
+            self.chat_text.config(state=tk.DISABLED)
+            if at_bottom:
+                self.chat_text.see(tk.END)
+
+        if self._active_stream is not None:
+            self._schedule_drain()
+
+    def _process_message(self, user_input, stream_id):
+        # Chạy trên luồng nền: sinh câu trả lời dạng stream, từng đoạn text được đưa vào hàng đợi
+        # để luồng giao diện chèn theo lô (_drain_stream)
+        parts = []
+        conv_id = self.current_conv_id
         try:
             self.is_processing = True
+            self.cancel_event.clear()
             self.root.after(0, lambda: self.status_var.set("🔄 AI đang suy nghĩ..."))
             
             prompt = self.conversation_manager.build_prompt(user_input)
-            response = self.model_wrapper.generate(prompt)
+            stream = self.model_wrapper.generate(prompt, stream=True, conv_id=conv_id, cancel=self.cancel_event)
+            for delta in stream:
+                parts.append(delta)
+                self._stream_queue.put((stream_id, delta))
+            response = "".join(parts).strip()
+            
+            # Người dùng đã chuyển sang cuộc trò chuyện mới trong lúc chờ: bỏ câu trả lời
+            if conv_id != self.current_conv_id:
+                return
+            if self.cancel_event.is_set():
+                self._stream_queue.put((stream_id, " ⏹ (đã dừng)" if response else "⏹ Đã dừng"))
+                if not response:
+                    return
             
             self.conversation_manager.add_user_message(user_input)
             self.conversation_manager.add_assistant_message(response)
             
-            self.root.after(0, lambda: self._add_message("ai", response))
-            
             # Lưu lịch sử chat vào file log cũ (giữ lại)
             save_chat_log(user_input, response, self.config.get('log_dir', 'logs')) 
             
-            # LƯU VÀO MONGODB
-            if response and self.mongo_manager:
-                self.mongo_manager.save_message(user_input, response, self.current_conv_id) 
-                # Cập nhật danh sách sidebar sau khi lưu
-                self.root.after(0, self._load_conversation_list)
-            
+            # LƯU VÀO DATABASE
             if self.conversation_manager.is_history_full():
-                self.conversation_manager.trim_history(keep_turns=3)
+                self.conversation_manager.trim_history()
+
+            if response and self.db_manager:
+                self.db_manager.save_message(user_input, response, self.current_conv_id, self.username)
+                # Đọc danh sách ngay trên luồng này (không chặn giao diện), tin nhắn vừa lưu đã được ghép vào
+                # dù lô ghi nền chưa xong; sidebar chỉ cập nhật các nút thay đổi
+                conv_list = self.db_manager.get_conversation_list(self.username)
+                self.root.after(0, lambda: self._render_conversation_list(conv_list))
             
         except Exception as e:
-            self.root.after(0, lambda: self._add_message("ai", f"❌ Lỗi: {e}"))
+            self._stream_queue.put((stream_id, ("\n" if parts else "") + f"❌ Lỗi: {e}"))
         finally:
+            self._stream_queue.put((stream_id, _STREAM_END))
             self.is_processing = False
             self.root.after(0, lambda: self.status_var.set("🟢 Sẵn sàng"))
             
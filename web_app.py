@@ -1,9 +1,23 @@
 import re
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+import json
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, Response, stream_with_context
 import config
 from core.model_llama_cpp import ModelWrapper
-from core.conversation import ConversationManager
-from core.database_utils import MongoDBManager
+from core.conversation import ConversationManager, PromptTooLongError, make_summarizer
+from core.tokenizer import TokenCounter
+from core.storage import create_storage
+from core.scheduler import InferenceScheduler, QueueFullError, SchedulerUnavailableError
+from core.worker_pool import ModelWorkerPool
+from core.batch_engine import BatchedModelWrapper
+from core.response_cache import create_response_cache
+from core.grammar import grammar_key, get_grammar_cache
+from core.chat_template import load_chat_template
+from core.model_loader import BackgroundLoader
+from core.model_registry import ModelRegistry
+from core.session_store import UserContext, create_session_store
+from core.utils import save_trace_log
+from core.log_sink import close_log_sinks, compress_leftover_logs
+from core import metrics
 import uuid
 import webbrowser
 import threading
@@ -15,28 +29,318 @@ app.secret_key = "bat_ky_chuoi_bi_mat_nao_ban_thich_o_day"  # Bắt buộc phả
 
 # Khởi tạo các thành phần dùng chung cho web app
 conf = config.get_config()
-model_wrapper = ModelWrapper()
+pool_size = conf.get("worker_pool_size", 0)
 
+if conf.get("inference_mode") == "batched":
+    # Chế độ batch: các request đồng thời được gộp vào cùng một lần decode của llama.cpp
+    num_inference_workers = conf.get("batch_max_sequences", 4)
+elif pool_size > 1:
+    num_inference_workers = pool_size
+else:
+    num_inference_workers = 1
+
+
+def _create_model(model_path):
+    """Tải một file GGUF theo chế độ suy luận trong config.py và làm nóng nếu được bật."""
+    if conf.get("inference_mode") == "batched":
+        wrapper = BatchedModelWrapper(overrides={"model_path": model_path})
+    elif pool_size > 1:
+        # Chế độ nhiều tiến trình: mỗi worker giữ một bản Llama riêng (trọng số dùng chung qua mmap)
+        # và tự làm nóng trước khi báo sẵn sàng
+        wrapper = ModelWorkerPool(pool_size, model_path=model_path)
+    else:
+        wrapper = ModelWrapper(overrides={"model_path": model_path})
+
+    if conf.get("model_warmup") and not isinstance(wrapper, ModelWorkerPool):
+        wrapper.warm_up()
+    return wrapper
+
+
+# Các model trong MODELS được tải khi có request cần tới, vượt ngân sách RAM thì bỏ model ít dùng nhất
+model_registry = ModelRegistry(
+    conf["models"],
+    conf["default_model"],
+    _create_model,
+    budget_mb=conf.get("model_ram_budget_mb", 0),
+    base_config=conf
+)
+
+# llama_cpp.Llama không an toàn khi gọi từ nhiều luồng, nên mọi request sinh text
+# đều đi qua hàng đợi của bộ lập lịch, mỗi luồng worker chỉ giữ một request tại một thời điểm
+scheduler = InferenceScheduler(
+    model_registry,
+    max_queue_depth=conf.get("queue_max_depth", 16),
+    max_per_user=conf.get("queue_max_per_user", 2),
+    num_workers=num_inference_workers
+)
+
+# Model mặc định được tải trên luồng nền, trong lúc chờ các route cần model trả 503
+model_loader = BackgroundLoader(model_registry.warm_up).start()
+
+# Tokenizer riêng (chỉ tải vocab) để đếm token lịch sử ngay trên luồng request,
+# không phải chờ tới lượt trong hàng đợi model (dùng vocab của model mặc định cho mọi model)
+token_counter = TokenCounter(conf["model_path"])
+
+# Cache câu trả lời (RESPONSE_CACHE_SIZE = 0 thì tắt): câu hỏi lặp lại được trả ngay, không vào hàng đợi model
+response_cache = create_response_cache(conf)
+
+# Backend lưu trữ (MongoDB hoặc SQLite) chọn theo STORAGE_BACKEND trong config.py
 try:
-    mongo_manager = MongoDBManager()
-    print("✅ Đã kết nối MongoDB")
-except Exception:
-    mongo_manager = None
+    db_manager = create_storage(conf)
+    print(f"✅ Đã khởi tạo lưu trữ: {conf.get('storage_backend')}")
+except Exception as e:
+    print(f"Lỗi khởi tạo lưu trữ: {e}")
+    db_manager = None
+
+# Được đặt khi server bắt đầu tắt: /readyz trả 503 để load balancer ngừng gửi request,
+# request chat mới bị từ chối trong lúc các lượt sinh đang chạy được xử lý nốt
+draining = threading.Event()
+_shutdown_lock = threading.Lock()
+_shutdown_done = False
+
+
+def begin_drain():
+    """Ngừng nhận request chat mới (các request đang chạy vẫn tiếp tục)."""
+    if not draining.is_set():
+        draining.set()
+        print("Đang dừng nhận request mới, chờ các câu trả lời đang sinh hoàn tất...")
+
+
+def shutdown(timeout=30):
+    """Tắt êm: chờ tối đa timeout giây cho các job còn trong hàng đợi, rồi ghi nốt dữ liệu và giải phóng model."""
+    global _shutdown_done
+    with _shutdown_lock:
+        if _shutdown_done:
+            return
+        _shutdown_done = True
+    begin_drain()
+    drained = scheduler.shutdown(timeout)
+    if db_manager:
+        db_manager.close()
+    close_log_sinks()
+    if drained:
+        model_registry.close()
+    else:
+        # Còn job chưa xong sau timeout: không đóng model đang được dùng, tiến trình thoát sẽ giải phóng
+        print(f"Cảnh báo: còn câu trả lời chưa sinh xong sau {timeout}s, bỏ qua")
+
+
+def _chat_template(model=None):
+    """Định dạng prompt của một model trong MODELS (đọc từ metadata file GGUF, có cache)."""
+    return load_chat_template(conf["models"][model_registry.resolve(model)], conf.get("chat_template", "auto"))
+
+
+def _new_manager(username, data=None):
+    """Tạo ConversationManager cho user, nạp lại lịch sử từ data nếu có (session lấy từ SQLite)."""
+    summarizer = None
+    if conf.get("history_summarize"):
+        # Bản tóm tắt được sinh bằng model mặc định nên dùng định dạng prompt của model đó
+        summarizer = make_summarizer(
+            lambda p, n: scheduler.submit(username, p, max_tokens=n).result(timeout=conf.get("queue_timeout")),
+            template=_chat_template(),
+        )
+    if data is not None:
+        return ConversationManager.from_dict(conf, data, token_counter=token_counter, summarizer=summarizer,
+                                             template=_chat_template())
+    return ConversationManager(conf, token_counter=token_counter, summarizer=summarizer, template=_chat_template())
+
+
+# Trạng thái chat của mỗi người dùng (ID cuộc trò chuyện hiện tại, model đã chọn, ConversationManager)
+# Dạng: key là username, value là UserContext; user không hoạt động quá SESSION_IDLE_TTL giây bị xóa
+session_store = create_session_store(
+    conf,
+    encode=lambda ctx: ctx.to_dict(),
+    decode=lambda username, data: UserContext.from_dict(data, lambda d: _new_manager(username, d)),
+)
+
+
+# Số liệu đọc lúc Prometheus lấy /metrics
+metrics.REGISTRY.callback("chat_active_sessions", "Số user đang được giữ trạng thái chat",
+                          lambda: session_store.stats()["entries"])
+metrics.REGISTRY.callback("chat_queue_depth", "Số request đang chờ trong hàng đợi", lambda: scheduler.stats()["queued"])
+metrics.REGISTRY.callback("chat_in_service", "Số request model đang xử lý", lambda: scheduler.stats()["in_service"])
+metrics.REGISTRY.callback("llm_models_loaded_bytes", "Tổng dung lượng các model đang nằm trong bộ nhớ",
+                          lambda: model_registry.stats()["used_mb"] * 1024 * 1024)
+
+
+def get_user_context(username):
+    """Lấy trạng thái chat của user, nếu chưa có (hoặc đã hết hạn) thì tạo phiên chat mới."""
+    ctx = session_store.get(username)
+    if ctx is None:
+        ctx = UserContext(str(uuid.uuid4()), _new_manager(username))
+        session_store.set(username, ctx)
+    return ctx
+
+
+def save_user_context(username, ctx):
+    """Ghi lại trạng thái sau khi thay đổi (cần cho backend SQLite, với RAM chỉ cập nhật thời điểm dùng)."""
+    session_store.set(username, ctx)
+
+
+def _model_unavailable():
+    """Trả về (body, 503) nếu model chưa tải xong, tải lỗi hoặc server đang tắt, ngược lại trả về None."""
+    if draining.is_set():
+        return {"response": "⏳ Máy chủ đang khởi động lại, vui lòng thử lại sau giây lát", "status": "draining"}, 503
+    if model_loader.is_ready():
+        return None
+    status = model_loader.status()
+    if status["status"] == "error":
+        msg = f"❌ Không tải được model: {status['error']}"
+    else:
+        msg = "⏳ Model đang được tải, vui lòng thử lại sau giây lát"
+    return {"response": msg, **status}, 503
+
+
+def _generation_config(model=None):
+    """Tham số sinh hiện tại kèm model người dùng đã chọn."""
+    return dict(model_registry.get_config(), model=model_registry.resolve(model))
+
+
+def _cache_question(manager, user_input):
+    """Câu hỏi dùng cho tra cứu gần giống: chỉ ở lượt đầu, khi prompt chưa có lịch sử làm thay đổi ngữ cảnh."""
+    if manager.get_history_count() == 0 and not manager.summary:
+        return user_input
+    return None
+
+
+class ChatTurn:
+    """Một lượt hỏi đáp đang xử lý: prompt đã dựng, câu trả lời trong cache hoặc job trong hàng đợi."""
+
+    def __init__(self, username, ctx, user_input, prompt, gen_cfg, question, trace):
+        self.username = username
+        self.ctx = ctx
+        self.user_input = user_input
+        self.prompt = prompt
+        self.gen_cfg = gen_cfg
+        self.question = question
+        self.cached = None
+        self.job = None
+        self.trace = trace  # RequestTrace: thời gian từng bước, scheduler và model ghi thêm các bước của mình
+
+
+def _output_constraint(data):
+    """Ràng buộc định dạng câu trả lời trong body request: {"json_schema": {...}} hoặc {"grammar": "<GBNF>"}.
+
+    Trả về dict tham số truyền cho model (rỗng nếu không có ràng buộc), ném ValueError nếu không hợp lệ."""
+    schema = data.get("json_schema")
+    grammar = data.get("grammar")
+    if schema is not None and grammar is not None:
+        raise ValueError("Chỉ dùng một trong hai: json_schema hoặc grammar")
+    if schema is not None:
+        if not isinstance(schema, dict):
+            raise ValueError("json_schema phải là một object JSON")
+        return {"json_schema": schema}
+    if grammar is not None:
+        if not isinstance(grammar, str) or not grammar.strip():
+            raise ValueError("grammar phải là chuỗi GBNF")
+        return {"grammar": grammar}
+    return {}
+
+
+def begin_turn(username, user_input, constraint=None):
+    """Dựng prompt từ lịch sử của user, tra cache rồi xếp hàng request.
+
+    constraint: kết quả của _output_constraint (model chỉ được sinh câu trả lời đúng grammar/JSON schema).
+    Trả về (turn, None), hoặc (None, (body, status)) nếu tin nhắn quá dài hoặc hàng đợi từ chối request."""
+    constraint = constraint or {}
+    trace = metrics.RequestTrace()
+    ctx = get_user_context(username)
+    gen_cfg = _generation_config(ctx.model)
+    if constraint:
+        # Câu trả lời có ràng buộc được cache riêng theo hash của grammar
+        gen_cfg["grammar"] = grammar_key(**constraint)
+    with trace.span("build_prompt"):
+        # Prompt theo định dạng của model đang chọn (người dùng có thể đổi model giữa cuộc trò chuyện)
+        ctx.manager.set_template(_chat_template(gen_cfg["model"]))
+        try:
+            prompt = ctx.manager.build_prompt(user_input, max_tokens=gen_cfg.get("max_tokens"))
+        except PromptTooLongError as e:
+            metrics.CHAT_TURNS.inc(outcome="rejected")
+            return None, ({"response": str(e)}, 413)
+    turn = ChatTurn(username, ctx, user_input, prompt, gen_cfg, _cache_question(ctx.manager, user_input), trace)
+
+    if response_cache:
+        turn.cached = response_cache.get(prompt, gen_cfg, turn.question)
+    if turn.cached is None:
+        try:
+            turn.job = scheduler.submit(username, prompt, trace=trace, conv_id=ctx.conv_id, model=gen_cfg["model"],
+                                        **constraint)
+        except QueueFullError as e:
+            metrics.CHAT_TURNS.inc(outcome="rejected")
+            return None, ({"response": str(e)}, 429)
+        except SchedulerUnavailableError as e:
+            metrics.CHAT_TURNS.inc(outcome="rejected")
+            return None, ({"response": str(e)}, 503)
+    return turn, None
+
+
+def finish_turn(turn, ai_response):
+    """Lưu câu trả lời đầy đủ: cache, lịch sử hội thoại riêng của user và database.
+
+    Câu trả lời bị dừng giữa chừng vẫn được lưu vào lịch sử (nếu có nội dung) nhưng không đưa vào cache."""
+    cancelled = turn.job is not None and turn.job.cancelled
+    if cancelled and not ai_response:
+        record_turn(turn, "cancelled")
+        return
+    if turn.job is not None and not cancelled and response_cache:
+        response_cache.put(turn.prompt, turn.gen_cfg, ai_response, turn.question)
+
+    with turn.trace.span("persist"):
+        manager = turn.ctx.manager
+        manager.add_user_message(turn.user_input)
+        manager.add_assistant_message(ai_response)
+        if manager.is_history_full():
+            manager.trim_history()
+        save_user_context(turn.username, turn.ctx)
+
+        if db_manager:
+            # Lưu nội dung hội thoại kèm theo username để phân biệt người dùng
+            db_manager.save_message(turn.user_input, ai_response, turn.ctx.conv_id, turn.username)
+
+    record_turn(turn, "cache_hit" if turn.job is None else "cancelled" if cancelled else "generated")
+
+
+def record_turn(turn, outcome):
+    """Ghi số liệu của một lượt chat đã kết thúc (generated, cache_hit, cancelled, error) và trace nếu bật TRACE_LOG."""
+    metrics.CHAT_TURNS.inc(outcome=outcome)
+    metrics.observe_spans(turn.trace)
+    if conf.get("trace_log"):
+        entry = dict(turn.trace.to_dict(), username=turn.username, conv_id=turn.ctx.conv_id, outcome=outcome)
+        save_trace_log(entry, conf.get("log_dir", "logs"))
+
+
+def _wants_trace():
+    """Client yêu cầu trả kèm trace các bước (?trace=1 hoặc header X-Trace: 1)."""
+    return request.args.get("trace") == "1" or request.headers.get("X-Trace") == "1"
 
-# Lưu ID phiên chat tạm thời cho mỗi người dùng trong bộ nhớ RAM của server
-# Dạng: key là username, value là conversation_id hiện tại
-user_sessions = {}
 
-# Quản lý ConversationManager riêng cho từng người dùng
-# Dạng: key là username, value là đối tượng ConversationManager
-user_managers = {}
+def _sse(event, data):
+    # Đóng gói một sự kiện Server-Sent Events (event + data dạng JSON)
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
+ # Kiểm tra sức khỏe cho load balancer / orchestrator
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """Tiến trình còn sống (trả lời ngay cả khi model đang tải)."""
+    return jsonify({"status": "ok"})
 
-def get_user_manager(username):
-    """Lấy ConversationManager riêng cho từng user, nếu chưa có thì tạo mới."""
-    if username not in user_managers:
-        user_managers[username] = ConversationManager(conf)
-    return user_managers[username]
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """Sẵn sàng nhận request chat: model đã tải xong, có kết nối lưu trữ và server không đang tắt."""
+    status = model_loader.status()
+    status["storage"] = db_manager is not None
+    status["draining"] = draining.is_set()
+    ready = model_loader.is_ready() and db_manager is not None and not draining.is_set()
+    return jsonify(status), 200 if ready else 503
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Số liệu vận hành theo định dạng text của Prometheus (METRICS_ENABLED = False thì trả 404)."""
+    if not conf.get("metrics_enabled", True):
+        return "Not Found", 404
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
  # Các route liên quan đến đăng nhập / đăng ký / đăng xuất
 @app.route("/login", methods=["GET", "POST"])
@@ -46,12 +350,11 @@ def login():
         username = data.get("username")
         password = data.get("password")
         
-        if mongo_manager and mongo_manager.login_user(username, password):
+        if db_manager and db_manager.login_user(username, password):
             session['user'] = username # Lưu trạng thái đăng nhập
             
             # Tạo session chat mới nếu chưa có
-            if username not in user_sessions:
-                user_sessions[username] = str(uuid.uuid4())
+            get_user_context(username)
                 
             return jsonify({"status": "success"})
         return jsonify({"status": "fail", "msg": "Sai tài khoản hoặc mật khẩu!"})
@@ -82,9 +385,9 @@ def register():
     if len(password) < 6 or not re.search(r"[a-zA-Z]", password) or not re.search(r"\d", password):
         return jsonify({"status": "fail", "msg": "Mật khẩu yếu! Cần ít nhất 6 ký tự, bao gồm cả chữ và số."})
         
-    # Bước 5: Gọi lớp làm việc với MongoDB để tạo tài khoản
-    if mongo_manager:
-        success, msg = mongo_manager.register_user(username, password)
+    # Bước 5: Gọi lớp lưu trữ (MongoDB/SQLite) để tạo tài khoản
+    if db_manager:
+        success, msg = db_manager.register_user(username, password)
         return jsonify({"status": "success" if success else "fail", "msg": msg})
     
     return jsonify({"status": "fail", "msg": "Lỗi kết nối Database"})
@@ -94,9 +397,9 @@ def logout():
     """Đăng xuất và xóa dữ liệu phiên đang lưu trong RAM cho user đó."""
     username = session.get('user')
     if username:
-        # Xóa thông tin phiên chat và ConversationManager khỏi bộ nhớ
-        user_sessions.pop(username, None)
-        user_managers.pop(username, None)
+        # Dừng các câu trả lời đang sinh, xóa thông tin phiên chat và ConversationManager khỏi bộ nhớ
+        scheduler.cancel_user(username)
+        session_store.delete(username)
     session.pop('user', None)
     return redirect(url_for('login'))
 
@@ -113,54 +416,184 @@ def get_bot_response():
     """Xử lý câu hỏi từ giao diện web và trả về câu trả lời của mô hình cho đúng user."""
     if 'user' not in session:
         return jsonify({"response": "Vui lòng đăng nhập lại!"})
-    
+
+    unavailable = _model_unavailable()
+    if unavailable:
+        return unavailable
+
     username = session['user']
     user_input = request.json.get("msg")
-    
-    # Lấy ConversationManager riêng của user này
-    manager = get_user_manager(username)
-    
-    # Lấy ID phiên chat hiện tại của người dùng
-    current_conv_id = user_sessions.get(username, str(uuid.uuid4()))
+    try:
+        constraint = _output_constraint(request.json)
+    except ValueError as e:
+        return jsonify({"response": str(e)}), 400
 
-    # Xây dựng prompt từ lịch sử của riêng user
-    prompt = manager.build_prompt(user_input)
-    
-    # Gọi model để sinh câu trả lời
-    ai_response = model_wrapper.generate(prompt)
-    
-    # Cập nhật lịch sử hội thoại riêng cho user
-    manager.add_user_message(user_input)
-    manager.add_assistant_message(ai_response)
-    
-    if mongo_manager:
-        # Lưu nội dung hội thoại kèm theo username để phân biệt người dùng
-        mongo_manager.save_message(user_input, ai_response, current_conv_id, username)
+    # Dựng prompt từ lịch sử riêng của user và xếp hàng (hoặc lấy câu trả lời trong cache)
+    turn, rejected = begin_turn(username, user_input, constraint)
+    if rejected:
+        return rejected
+
+    ai_response = turn.cached
+    if turn.job is not None:
+        # Chờ worker sinh câu trả lời (có thể bị dừng qua /api/cancel)
+        try:
+            ai_response = turn.job.result(timeout=conf.get("queue_timeout"))
+        except (RuntimeError, TimeoutError) as e:
+            scheduler.cancel(turn.job)
+            record_turn(turn, "error")
+            return jsonify({"response": f"❌ {e}"}), 500
+
+    # Cập nhật lịch sử hội thoại riêng cho user và lưu vào database
+    finish_turn(turn, ai_response)
+    cancelled = turn.job is not None and turn.job.cancelled
+    body = {"response": ai_response, "cancelled": cancelled}
+    if _wants_trace():
+        body["trace"] = turn.trace.to_dict()
+    return jsonify(body)
 
-    return jsonify({"response": ai_response})
+@app.route("/get_response_stream", methods=["POST"])
+def get_bot_response_stream():
+    """Sinh câu trả lời dạng stream (Server-Sent Events): gửi từng đoạn token ngay khi mô hình tạo ra."""
+    if 'user' not in session:
+        return jsonify({"response": "Vui lòng đăng nhập lại!"}), 401
+
+    unavailable = _model_unavailable()
+    if unavailable:
+        return unavailable
+
+    username = session['user']
+    user_input = request.json.get("msg")
+    try:
+        constraint = _output_constraint(request.json)
+    except ValueError as e:
+        return jsonify({"response": str(e)}), 400
+
+    # Xếp hàng trước khi mở stream để có thể trả 429/503 ngay lập tức
+    turn, rejected = begin_turn(username, user_input, constraint)
+    if rejected:
+        return rejected
+    wants_trace = _wants_trace()
+
+    def event_stream():
+        try:
+            if turn.job is None:
+                # Trúng cache: gửi cả câu trả lời trong một sự kiện
+                ai_response = turn.cached
+                yield _sse("token", {"delta": ai_response})
+            else:
+                parts = []
+                try:
+                    tokens = turn.job.iter_tokens(timeout=conf.get("queue_timeout"),
+                                                  heartbeat=conf.get("stream_heartbeat"))
+                    for delta in tokens:
+                        if delta is None:
+                            # Chưa có token (đang chờ trong hàng đợi): ghi dòng giữ kết nối,
+                            # client đã đóng tab thì lần ghi này thất bại và stream bị đóng
+                            yield ": keepalive\n\n"
+                            continue
+                        parts.append(delta)
+                        yield _sse("token", {"delta": delta})
+                except Exception as e:
+                    record_turn(turn, "error")
+                    yield _sse("error", {"msg": str(e)})
+                    return
+                ai_response = "".join(parts).strip()
+
+            # Stream kết thúc (hoặc người dùng bấm dừng): lưu câu trả lời giống như /get_response
+            finish_turn(turn, ai_response)
+            done = {"response": ai_response, "cancelled": turn.job is not None and turn.job.cancelled}
+            if wants_trace:
+                done["trace"] = turn.trace.to_dict()
+            yield _sse("done", done)
+        finally:
+            # Client ngắt kết nối giữa chừng: hủy job để model được giải phóng ngay cho request khác
+            if turn.job is not None and not turn.job.is_done():
+                scheduler.cancel(turn.job)
+
+    # Tắt cache/buffer của proxy để token tới trình duyệt ngay lập tức
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(event_stream()), mimetype="text/event-stream", headers=headers)
+
+@app.route("/api/cancel", methods=["POST"])
+def cancel_response():
+    """Dừng các câu trả lời đang chờ hoặc đang sinh của user (nút dừng trên giao diện)."""
+    if 'user' not in session:
+        return jsonify({"status": "fail", "msg": "Vui lòng đăng nhập lại."}), 401
+    cancelled = scheduler.cancel_user(session['user'])
+    return jsonify({"status": "success", "cancelled": cancelled})
 
 @app.route("/api/history", methods=["GET"])
 def get_history_list():
     if 'user' not in session: return jsonify([])
-    if mongo_manager:
-        return jsonify(mongo_manager.get_conversation_list(session['user']))
+    if db_manager:
+        return jsonify(db_manager.get_conversation_list(session['user']))
     return jsonify([])
 
 
+@app.route("/api/search", methods=["GET"])
+def search_history():
+    """Tìm tin nhắn cũ của user theo nội dung."""
+    if 'user' not in session: return jsonify([])
+    query = request.args.get("q", "").strip()
+    if not query or not db_manager:
+        return jsonify([])
+    results = db_manager.search_messages(session['user'], query, limit=20)
+    return jsonify([{
+        "conversation_id": m.get("conversation_id"),
+        "user_message": m.get("user_message"),
+        "assistant_response": m.get("assistant_response"),
+        "timestamp": m.get("timestamp")
+    } for m in results])
+
+
+@app.route("/api/queue_stats", methods=["GET"])
+def get_queue_stats():
+    """Số liệu hàng đợi suy luận (thời gian chờ, thời gian phục vụ) để định cỡ hệ thống."""
+    if not model_loader.is_ready():
+        return jsonify({"model": model_loader.status()})
+    stats = scheduler.stats()
+    stats["model"] = model_loader.status()
+    stats["models"] = model_registry.stats()
+    stats["sessions"] = session_store.stats()
+
+    # Chi tiết của model mặc định (nếu đang nằm trong bộ nhớ)
+    wrapper = model_registry.loaded_wrapper()
+    if isinstance(wrapper, (ModelWorkerPool, BatchedModelWrapper)):
+        stats["workers_detail"] = wrapper.stats()
+    elif wrapper is not None:
+        if wrapper.state_cache is not None:
+            stats["kv_cache"] = wrapper.state_cache.stats()
+        if wrapper.draft_model is not None:
+            stats["speculative"] = wrapper.speculative_stats()
+    return jsonify(stats)
+
+
+@app.route("/api/cache_stats", methods=["GET"])
+def get_cache_stats():
+    """Số lần trúng/trượt của cache câu trả lời và cache grammar đã biên dịch."""
+    stats = dict(response_cache.stats(), enabled=True) if response_cache is not None else {"enabled": False}
+    # Ở chế độ nhiều tiến trình model, grammar được biên dịch và cache trong từng worker
+    stats["grammar"] = get_grammar_cache().stats()
+    return jsonify(stats)
+
+
 @app.route("/api/settings", methods=["GET"])
 def get_settings():
-    """Trả về các tham số sinh văn bản hiện tại của mô hình cho giao diện web."""
-    cfg = model_wrapper.get_config()
+    """Trả về các tham số sinh văn bản hiện tại và model người dùng đang chọn cho giao diện web."""
+    username = session.get('user')
+    cfg = _generation_config(get_user_context(username).model if username else None)
     return jsonify({
         "temperature": cfg.get("temperature"),
         "max_tokens": cfg.get("max_tokens"),
-        "top_p": cfg.get("top_p")
+        "top_p": cfg.get("top_p"),
+        "model": cfg.get("model"),
+        "models": model_registry.list_models()
     })
 
 
 @app.route("/api/settings", methods=["POST"])
 def update_settings():
-    """Cập nhật tham số sinh văn bản (temperature, max_tokens, top_p) từ giao diện web."""
+    """Cập nhật tham số sinh văn bản (temperature, max_tokens, top_p) và model của user từ giao diện web."""
     if 'user' not in session:
         return jsonify({"status": "fail", "msg": "Vui lòng đăng nhập lại."}), 401
 
@@ -172,8 +605,17 @@ def update_settings():
     except (TypeError, ValueError):
         return jsonify({"status": "fail", "msg": "Giá trị tham số không hợp lệ."}), 400
 
+    model = data.get("model")
+    if model is not None:
+        if model not in model_registry.models:
+            return jsonify({"status": "fail", "msg": f"Không có model '{model}'."}), 400
+        # Model riêng của user, được tải ở request tiếp theo nếu chưa có trong bộ nhớ
+        ctx = get_user_context(session['user'])
+        ctx.model = model
+        save_user_context(session['user'], ctx)
+
     # Cập nhật cấu hình runtime của model
-    model_wrapper.update_config({
+    model_registry.update_config({
         "temperature": new_temp,
         "max_tokens": new_max_tokens,
         "top_p": new_top_p
@@ -183,48 +625,67 @@ def update_settings():
 
 @app.route("/api/load_chat/<conv_id>", methods=["GET"])
 def load_chat_content(conv_id):
-    """Tải nội dung một cuộc trò chuyện cũ cho đúng user và nạp lại context vào manager riêng."""
+    """Tải nội dung một cuộc trò chuyện cũ theo từng trang cho đúng user.
+
+    Không có tham số before: tải trang mới nhất, chuyển phiên chat sang cuộc trò chuyện này
+    và nạp lại context vào manager riêng. Có before: chỉ trả về trang cũ hơn để hiển thị."""
     if 'user' not in session:
-        return jsonify([])
+        return jsonify({"messages": [], "next_before": None})
     username = session['user']
-    
-    # Cập nhật ID phiên chat hiện tại khi người dùng chọn cuộc trò chuyện khác
-    user_sessions[username] = conv_id
-    
-    # Lấy ConversationManager riêng và xóa lịch sử cũ trong bộ nhớ
-    manager = get_user_manager(username)
-    manager.clear_history()
-    
-    messages = []
-    if mongo_manager:
-        raw_msgs = mongo_manager.get_messages_by_conversation_id(conv_id, username)
+
+    before = request.args.get("before")
+    limit = request.args.get("limit", type=int) or conf.get("load_chat_page_size", 10)
+    limit = max(1, min(limit, 100))
+
+    raw_msgs, next_before = [], None
+    if db_manager:
+        try:
+            raw_msgs, next_before = db_manager.get_messages_page(conv_id, username, before=before, limit=limit)
+        except ValueError:
+            return jsonify({"messages": [], "next_before": None, "msg": "Con trỏ trang không hợp lệ"}), 400
+
+    if not before:
+        # Cập nhật ID phiên chat hiện tại khi người dùng chọn cuộc trò chuyện khác
+        ctx = get_user_context(username)
+        ctx.conv_id = conv_id
+
+        # Xóa lịch sử cũ trong ConversationManager riêng và nạp lại các lượt gần nhất làm context
+        manager = ctx.manager
+        manager.clear_history()
         for m in raw_msgs:
-            u_msg = m.get("user_message")
-            a_resp = m.get("assistant_response")
+            manager.add_user_message(m.get("user_message"))
+            manager.add_assistant_message(m.get("assistant_response"))
+        save_user_context(username, ctx)
 
-            messages.append({"role": "user", "content": u_msg})
-            messages.append({"role": "bot", "content": a_resp})
-            
-            # Nạp lại context vào ConversationManager riêng
-            manager.add_user_message(u_msg)
-            manager.add_assistant_message(a_resp)
-            
-    return jsonify(messages)
+        # Trạng thái KV của cuộc trò chuyện (nếu đã lưu xuống đĩa) được đọc trước để lượt tiếp theo nạp lại nhanh
+        wrapper = model_registry.loaded_wrapper(ctx.model)
+        if hasattr(wrapper, "prefetch_state"):
+            wrapper.prefetch_state(conv_id)
+
+    messages = []
+    for m in raw_msgs:
+        messages.append({"role": "user", "content": m.get("user_message")})
+        messages.append({"role": "bot", "content": m.get("assistant_response")})
+
+    return jsonify({"messages": messages, "next_before": next_before})
 
 @app.route("/new_chat", methods=["POST"])
 def new_chat():
     if 'user' in session:
         username = session['user']
-        user_sessions[username] = str(uuid.uuid4())
-        # Xóa lịch sử hội thoại trong ConversationManager riêng nếu đã tồn tại
-        if username in user_managers:
-            user_managers[username].clear_history()
+        # Câu trả lời của cuộc trò chuyện cũ không còn ai đọc: dừng sinh
+        scheduler.cancel_user(username)
+        ctx = get_user_context(username)
+        ctx.conv_id = str(uuid.uuid4())
+        # Xóa lịch sử hội thoại trong ConversationManager riêng
+        ctx.manager.clear_history()
+        save_user_context(username, ctx)
     return jsonify({"status": "success"})
 
 @app.route("/clear_all", methods=["POST"])
 def clear_all_db():
-    if 'user' in session and mongo_manager:
-        mongo_manager.delete_all_conversations(session['user'])
+    if 'user' in session and db_manager:
+        db_manager.delete_all_conversations(session['user'])
     return new_chat()
 
 def open_browser():
@@ -232,5 +693,6 @@ def open_browser():
     webbrowser.open_new("http://localhost:5000")
 
 if __name__ == "__main__":
+    compress_leftover_logs(conf.get("log_dir", "logs"))
     threading.Thread(target=open_browser).start()
     app.run(host="0.0.0.0", port=5000, debug=False)
\ No newline at end of file
@@ -0,0 +1,169 @@
+ # Chạy web app dưới ASGI server (uvicorn): /get_response_stream được phục vụ bất đồng bộ nên
+ # mỗi kết nối đang stream không giữ một luồng hệ điều hành; các route còn lại đi qua Flask (WSGI) như cũ
+ #   python serve.py --server uvicorn            (một tiến trình)
+ #   python serve.py --server gunicorn --asgi    (nhiều tiến trình, worker uvicorn)
+import json
+import asyncio
+from http.cookies import SimpleCookie, CookieError
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+
+import web_app
+
+flask_app = web_app.app
+
+# Các route WSGI chạy trên thread pool riêng (/get_response chờ model nên cần đủ luồng)
+_wsgi = WSGIMiddleware(flask_app, workers=web_app.conf.get("server_threads", 8))
+
+
+def _session_user(scope):
+    """Đọc username từ cookie session đã ký của Flask (cùng secret_key với web_app)."""
+    cookie = SimpleCookie()
+    try:
+        for name, value in scope.get("headers", []):
+            if name == b"cookie":
+                cookie.load(value.decode("latin-1"))
+    except CookieError:
+        return None
+
+    morsel = cookie.get(flask_app.config["SESSION_COOKIE_NAME"])
+    if morsel is None:
+        return None
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        data = serializer.loads(morsel.value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    return data.get("user")
+
+
+def _wants_trace(scope):
+    """Giống web_app._wants_trace: ?trace=1 hoặc header X-Trace: 1."""
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    return query.get("trace") == ["1"] or (b"x-trace", b"1") in scope.get("headers", [])
+
+
+async def _read_json(receive):
+    """Đọc toàn bộ body của request và parse JSON (body lỗi thì trả về dict rỗng)."""
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return {}
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        return json.loads(body or b"{}")
+    except ValueError:
+        return {}
+
+
+async def _send_json(send, body, status):
+    payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())],
+    })
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def stream_response(scope, receive, send):
+    """Bản bất đồng bộ của /get_response_stream trong web_app.py (cùng định dạng sự kiện SSE)."""
+    username = _session_user(scope)
+    if not username:
+        return await _send_json(send, {"response": "Vui lòng đăng nhập lại!"}, 401)
+
+    unavailable = web_app._model_unavailable()
+    if unavailable:
+        return await _send_json(send, *unavailable)
+
+    data = await _read_json(receive)
+    try:
+        constraint = web_app._output_constraint(data)
+    except ValueError as e:
+        return await _send_json(send, {"response": str(e)}, 400)
+    loop = asyncio.get_running_loop()
+
+    # Dựng prompt (có thể phải chờ tóm tắt lịch sử) và lưu lượt chat chạy trên thread pool để không chặn event loop
+    turn, rejected = await loop.run_in_executor(None, web_app.begin_turn, username, data.get("msg"), constraint)
+    if rejected:
+        return await _send_json(send, *rejected)
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+
+    async def emit(event, payload, more_body=True):
+        await send({"type": "http.response.body", "body": web_app._sse(event, payload).encode("utf-8"),
+                    "more_body": more_body})
+
+    if turn.job is None:
+        # Trúng cache: gửi cả câu trả lời trong một sự kiện
+        ai_response = turn.cached
+        await emit("token", {"delta": ai_response})
+        await loop.run_in_executor(None, web_app.finish_turn, turn, ai_response)
+        done = {"response": ai_response, "cancelled": False}
+        if _wants_trace(scope):
+            done["trace"] = turn.trace.to_dict()
+        await emit("done", done, more_body=False)
+        return
+
+    async def watch_disconnect():
+        # Client đóng tab (kể cả khi request còn trong hàng đợi): hủy job để giải phóng model
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        web_app.scheduler.cancel(turn.job)
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    try:
+        parts = []
+        try:
+            async for delta in turn.job.aiter_tokens(timeout=web_app.conf.get("queue_timeout")):
+                parts.append(delta)
+                await emit("token", {"delta": delta})
+        except (TimeoutError, RuntimeError) as e:
+            web_app.record_turn(turn, "error")
+            await emit("error", {"msg": str(e)}, more_body=False)
+            return
+        ai_response = "".join(parts).strip()
+
+        await loop.run_in_executor(None, web_app.finish_turn, turn, ai_response)
+        done = {"response": ai_response, "cancelled": turn.job.cancelled}
+        if _wants_trace(scope):
+            done["trace"] = turn.trace.to_dict()
+        await emit("done", done, more_body=False)
+    finally:
+        watcher.cancel()
+        if not turn.job.is_done():
+            web_app.scheduler.cancel(turn.job)
+
+
+async def _lifespan(receive, send):
+    # Khi uvicorn tắt (sau khi đã chờ các kết nối đang mở), xử lý nốt hàng đợi rồi giải phóng model
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            timeout = web_app.conf.get("server_graceful_timeout", 60)
+            await asyncio.get_running_loop().run_in_executor(None, web_app.shutdown, timeout)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] == "http" and scope["path"] == "/get_response_stream" and scope["method"] == "POST":
+        return await stream_response(scope, receive, send)
+    return await _wsgi(scope, receive, send)